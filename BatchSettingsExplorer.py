@@ -1,7 +1,17 @@
 import argparse
 import json
 import os
+import queue
+import subprocess
+import tempfile
+import threading
+import time
+from datetime import datetime
+
 import numpy as np
+import json5
+
+from engine.workers import parse_workers, prd_device_args, run_points
 
 parser = argparse.ArgumentParser()
 parser.add_argument(
@@ -15,7 +25,45 @@ parser.add_argument(
 parser.add_argument(
     '-p',
     '--prd',
-    help='The PRD command to use (minus "python prd.py"). Put the *whole thing* in single quotes, using escaped double quotes within if needed. Example: -p=\'-s settings.json -p=\\"my prompt\\"\''
+    help='The PRD command to use (minus "python prd.py"). Put the *whole thing* in single quotes, using escaped double quotes within if needed. Example: -p=\'-s settings.json -p=\\"my prompt\\"\'. '
+         'Giving this runs every point as a separate prd.py process instead of rendering them all in this one.'
+)
+
+parser.add_argument(
+    '-b',
+    '--base',
+    action='append',
+    required=False,
+    default=[],
+    help='Settings file(s) to layer over settings.json before each point\'s settings, like prd.py -s. Can be given more than once.'
+)
+
+parser.add_argument(
+    '-c',
+    '--cpu',
+    action='store_true',
+    help='Render on the CPU (very slow).'
+)
+
+parser.add_argument(
+    '--cuda',
+    default='0',
+    help='Which CUDA device to render on. (default: 0)'
+)
+
+parser.add_argument(
+    '-w',
+    '--workers',
+    required=False,
+    help='Render points in parallel, one worker per entry. Numbers are CUDA devices and "cpu" is a CPU worker '
+         '(CPU workers split the cores between them). Example: -w 0,1'
+)
+
+parser.add_argument(
+    '-o',
+    '--output',
+    default='images_out',
+    help='Where to save the images, in a subfolder named after batch_name. (default: images_out)'
 )
 
 parser.add_argument("-x", '--xDimension', action='store_true',
@@ -23,16 +71,6 @@ parser.add_argument("-x", '--xDimension', action='store_true',
 
 args = parser.parse_args()
 
-print(args)
-# open the json file from the command line
-try:
-    with open(args.settings) as json_file:
-        data = json.load(json_file)
-
-except FileNotFoundError:
-    print("File not found")
-    exit()
-
 
 def ConvertBooleanToFloat(value):
     if value:
@@ -76,15 +114,82 @@ def LerpDictionary(dict1, dict2, t):
     return result
 
 
-def ExecuteProgrockdiffusionWith(temporarySetting):
-    # write a temporary setting file to override the base setting
+def ExecuteProgrockdiffusionWith(temporarySetting, device_args=''):
+    # write a private temporary setting file to override the base setting, so that parallel workers
+    # (and other explorers) don't overwrite each other's settings
     print("\nCurrent Setting:" + temporarySetting.__str__() + "\n\n")
-    with open('tmp.json', 'w', encoding='utf-8') as f:
-        json.dump(temporarySetting, f, ensure_ascii=False, indent=4)
-    f.close()
-    temporarySetting.clear()
-    # Execute progrockdiffusion with the temporary setting file
-    os.system(f'python prd.py {args.prd} -s tmp.json')
+    fd, tmp_path = tempfile.mkstemp(prefix='explorer_', suffix='.json', dir='.')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(temporarySetting, f, ensure_ascii=False, indent=4)
+        # Execute progrockdiffusion with the temporary setting file
+        return subprocess.run(f'python prd.py {args.prd} -s {tmp_path} {device_args}', shell=True).returncode
+    finally:
+        os.remove(tmp_path)
+
+
+def LoadBaseSettings():
+    # settings.json plus any --base files layered on top, the same way prd.py layers -s files
+    base = {}
+    for settings_file in ['settings.json'] + args.base:
+        with open(settings_file, 'r', encoding='utf-8') as f:
+            base.update(json5.load(f))
+    return base
+
+
+def WorkerSpecs():
+    if args.workers:
+        return parse_workers(args.workers)
+    if args.cpu:
+        return [{'device': 'cpu', 'threads': None}]
+    return [{'device': f'cuda:{args.cuda}', 'threads': None}]
+
+
+def RunPrdWorkers(points, specs):
+    # One thread per worker, each feeding its device with prd.py processes from a shared queue
+    tasks = queue.Queue()
+    for i, point in enumerate(points):
+        tasks.put((i, point))
+    manifest = []
+
+    def worker(spec):
+        device_args = prd_device_args(spec)
+        while True:
+            try:
+                i, point = tasks.get_nowait()
+            except queue.Empty:
+                return
+            start = time.perf_counter()
+            returncode = ExecuteProgrockdiffusionWith(point, device_args)
+            manifest.append({
+                'index': i,
+                'device': spec['device'],
+                'settings': point,
+                'status': 'done' if returncode == 0 else 'failed',
+                'seconds': round(time.perf_counter() - start, 2),
+            })
+
+    threads = [threading.Thread(target=worker, args=(spec,)) for spec in specs]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sorted(manifest, key=lambda entry: entry['index'])
+
+
+def RunPoints(points):
+    run_id = datetime.now().strftime('%y%m%d-%H%M%S')
+    specs = WorkerSpecs()
+    if args.prd:
+        manifest = RunPrdWorkers(points, specs)
+    else:
+        base = LoadBaseSettings()
+        manifest = run_points([{**base, **point} for point in points], specs, args.output, run_id)
+    os.makedirs(args.output, exist_ok=True)
+    manifest_path = f'{args.output}/explorer-{run_id}_manifest.json'
+    with open(manifest_path, 'w', encoding='utf-8') as f:
+        json.dump({'settings_file': args.settings, 'workers': specs, 'points': manifest}, f, ensure_ascii=False, indent=4, default=str)
+    print(f'Results for {len(manifest)} of {len(points)} points are listed in {manifest_path}')
 
 
 def N_DimensionalSetting():
@@ -101,15 +206,17 @@ def N_DimensionalSetting():
     meshgridSettings = np.array(np.meshgrid(*jsonData)).T.reshape(-1, len(data["settings"]))
     print("\n\Settings to be performed:" + meshgridSettings.__str__())
 
+    points = []
     for i in range(0, len(meshgridSettings)):
         setting = meshgridSettings[i][0]
         for j in range(1, len(meshgridSettings[i])):
             setting = {**setting, **meshgridSettings[i][j]}
-        ExecuteProgrockdiffusionWith(setting)
+        points.append(setting)
+    RunPoints(points)
 
 
 def SequenceSettings():
-    interpolatedSetting = {}
+    points = []
     for dimension in range(len(data["settings"])):
         # get the settings
         setting = data["settings"][dimension]
@@ -119,19 +226,32 @@ def SequenceSettings():
             step_size = 1.0 / (steps - 1)
             current_step = step * step_size
             # Add the interpolated setting
+            interpolatedSetting = {}
             for key in setting["start"].keys():
                 start = setting["start"][key]
                 end = setting["end"][key]
                 current_value = lerp(start, end, current_step)
                 interpolatedSetting[key] = current_value
-            ExecuteProgrockdiffusionWith(interpolatedSetting)
+            points.append(interpolatedSetting)
+    RunPoints(points)
+
 
+if __name__ == '__main__':
+    print(args)
+    # open the json file from the command line
+    try:
+        with open(args.settings) as json_file:
+            data = json.load(json_file)
 
-if args.xDimension:
-    print("\n Batch every possible setting in multidimensionnal grid. \n")
-    N_DimensionalSetting()
-else:
-    print("\n Batch settings in sequence.\n")
-    SequenceSettings()
+    except FileNotFoundError:
+        print("File not found")
+        exit()
+
+    if args.xDimension:
+        print("\n Batch every possible setting in multidimensionnal grid. \n")
+        N_DimensionalSetting()
+    else:
+        print("\n Batch settings in sequence.\n")
+        SequenceSettings()
 
-quit()
+    quit()
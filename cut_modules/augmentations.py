@@ -0,0 +1,258 @@
+import torch
+from torch import nn
+from torch.nn import functional as F
+import torchvision.transforms.functional as TF
+
+
+# The T.Compose recipes the cut modules used to run one cut at a time, keyed by animation mode
+AUGMENTATION_RECIPES = {
+    'None': dict(
+        flip_p=0.5, degrees=10, translate=0.05, grayscale_p=0.1, noise_count=3,
+        jitter=(0.1, 0.1, 0.1, 0.1)
+    ),
+    'Video Input': dict(
+        flip_p=0.5, degrees=15, translate=0.1, perspective_p=0.7, distortion_scale=0.4,
+        grayscale_p=0.15, noise_count=4
+    ),
+    '2D': dict(
+        flip_p=0.4, degrees=10, translate=0.05, grayscale_p=0.1, noise_count=3,
+        jitter=(0.1, 0.1, 0.1, 0.3)
+    ),
+}
+AUGMENTATION_RECIPES['3D'] = AUGMENTATION_RECIPES['2D']
+
+
+def _uniform(size, low, high, generator=None):
+    return torch.rand(size, generator=generator) * (high - low) + low
+
+
+def _rgb_to_hsv(img):
+    r, g, b = img.unbind(dim=-3)
+    maxc = torch.max(img, dim=-3).values
+    minc = torch.min(img, dim=-3).values
+    eqc = maxc == minc
+    cr = maxc - minc
+    ones = torch.ones_like(maxc)
+    s = cr / torch.where(eqc, ones, maxc)
+    cr_divisor = torch.where(eqc, ones, cr)
+    rc = (maxc - r) / cr_divisor
+    gc = (maxc - g) / cr_divisor
+    bc = (maxc - b) / cr_divisor
+    hr = (maxc == r) * (bc - gc)
+    hg = ((maxc == g) & (maxc != r)) * (2.0 + rc - bc)
+    hb = ((maxc != g) & (maxc != r)) * (4.0 + gc - rc)
+    h = torch.fmod((hr + hg + hb) / 6.0 + 1.0, 1.0)
+    return torch.stack((h, s, maxc), dim=-3)
+
+
+def _hsv_to_rgb(img):
+    h, s, v = img.unbind(dim=-3)
+    i = torch.floor(h * 6.0)
+    f = h * 6.0 - i
+    i = i.to(dtype=torch.int32) % 6
+    p = torch.clamp(v * (1.0 - s), 0.0, 1.0)
+    q = torch.clamp(v * (1.0 - s * f), 0.0, 1.0)
+    t = torch.clamp(v * (1.0 - s * (1.0 - f)), 0.0, 1.0)
+    mask = i.unsqueeze(dim=-3) == torch.arange(6, device=i.device).view(-1, 1, 1)
+    a1 = torch.stack((v, q, p, p, t, v), dim=-3)
+    a2 = torch.stack((t, v, v, q, p, p), dim=-3)
+    a3 = torch.stack((p, p, t, v, v, q), dim=-3)
+    a4 = torch.stack((a1, a2, a3), dim=-4)
+    return torch.einsum('...ijk, ...xijk -> ...xjk', mask.to(dtype=img.dtype), a4)
+
+
+def _grayscale(x):
+    return TF.rgb_to_grayscale(x).expand_as(x)
+
+
+def _blend(x, other, ratio):
+    return (ratio * x + (1.0 - ratio) * other).clamp(0, 1)
+
+
+def _brightness(x, factor):
+    return _blend(x, torch.zeros_like(x), factor)
+
+
+def _contrast(x, factor):
+    mean = TF.rgb_to_grayscale(x).mean(dim=(-3, -2, -1), keepdim=True)
+    return _blend(x, mean, factor)
+
+
+def _saturation(x, factor):
+    return _blend(x, _grayscale(x), factor)
+
+
+def _hue(x, factor):
+    h, s, v = _rgb_to_hsv(x).unbind(dim=-3)
+    h = torch.fmod(h + factor.view(-1, 1, 1), 1.0)
+    return _hsv_to_rgb(torch.stack((h, s, v), dim=-3))
+
+
+class BatchAugment(nn.Module):
+    """
+    Augments a whole [N, 3, H, W] batch of cuts at once, drawing separate random parameters for
+    every cut. It follows the torchvision recipes the cut modules used per cut, with the work
+    fused: the flip, rotation, translation and perspective are folded into one homography per cut
+    and applied with a single grid_sample, and the separate noise adds become one add with the same
+    total variance. Color jitter applies its four adjustments in a random order per cut, as
+    ColorJitter does.
+    """
+
+    def __init__(
+            self,
+            flip_p=0.5,
+            degrees=10,
+            translate=0.05,
+            perspective_p=0.0,
+            distortion_scale=0.5,
+            grayscale_p=0.1,
+            noise_count=3,
+            noise_scale=0.01,
+            jitter=None
+    ):
+        super().__init__()
+        self.flip_p = flip_p
+        self.degrees = degrees
+        self.translate = translate
+        self.perspective_p = perspective_p
+        self.distortion_scale = distortion_scale
+        self.grayscale_p = grayscale_p
+        self.noise_std = noise_scale * noise_count ** 0.5
+        self.jitter = jitter
+
+    @classmethod
+    def for_animation_mode(cls, animation_mode):
+        return cls(**AUGMENTATION_RECIPES[animation_mode])
+
+    def draw(self, n, side_x, side_y, generator=None):
+        """
+        Draw the random parameters for augmenting n cuts of side_x by side_y, as CPU tensors. Pass a
+        generator to draw them away from the global random state, e.g. on another thread.
+        """
+        bound_x = int(self.distortion_scale * (side_x // 2)) + 1
+        bound_y = int(self.distortion_scale * (side_y // 2)) + 1
+        params = {
+            'flip': torch.rand(n, generator=generator) < self.flip_p,
+            'angle': torch.deg2rad(_uniform(n, -self.degrees, self.degrees, generator)),
+            'shift': (_uniform((n, 2), -1, 1, generator) * self.translate * torch.tensor([side_x, side_y])).round(),
+            # Perspective: how far each corner moves inwards, as RandomPerspective does
+            'perspective': torch.rand(n, generator=generator) < self.perspective_p,
+            'offsets': torch.stack([
+                torch.randint(0, bound_x, (n, 4), generator=generator),
+                torch.randint(0, bound_y, (n, 4), generator=generator)
+            ], dim=-1).float(),
+            'grey': torch.rand(n, generator=generator) < self.grayscale_p,
+        }
+        if self.jitter:
+            brightness, contrast, saturation, hue = self.jitter
+            params['jitter'] = torch.stack([
+                _uniform(n, 1 - brightness, 1 + brightness, generator),
+                _uniform(n, 1 - contrast, 1 + contrast, generator),
+                _uniform(n, 1 - saturation, 1 + saturation, generator),
+                _uniform(n, -hue, hue, generator),
+            ], dim=1)
+            params['jitter_order'] = torch.rand(n, 4, generator=generator).argsort(dim=1)
+        return params
+
+    def warp_matrices(self, params, side_x, side_y, device):
+        """
+        The [N, 3, 3] matrices mapping output pixel coordinates back to source pixels, in two parts:
+        the perspective, then the rotation, translation and flip. They're kept apart because the
+        perspective samples an already rotated image, which is blank outside the frame.
+        """
+        n = len(params['flip'])
+        matrices = torch.eye(3, device=device).repeat(n, 1, 1)
+        use_perspective = params['perspective'].to(device)
+        if use_perspective.any():
+            start = torch.tensor(
+                [[0, 0], [side_x - 1, 0], [side_x - 1, side_y - 1], [0, side_y - 1]],
+                dtype=torch.float32,
+                device=device
+            ).expand(n, 4, 2)
+            inwards = torch.tensor([[1, 1], [-1, 1], [-1, -1], [1, -1]], dtype=torch.float32, device=device)
+            end = start + params['offsets'].to(device) * inwards
+            perspective = self._homography(end, start)
+            matrices = torch.where(use_perspective.view(-1, 1, 1), perspective, matrices)
+
+        # Rotation about the center plus a whole pixel translation, undone for output -> source
+        angle = params['angle'].to(device)
+        shift_x, shift_y = params['shift'].to(device).unbind(dim=1)
+        center_x, center_y = (side_x - 1) / 2, (side_y - 1) / 2
+        cos, sin = torch.cos(angle), torch.sin(angle)
+        affine = torch.zeros(n, 3, 3, device=device)
+        affine[:, 0, 0] = cos
+        affine[:, 0, 1] = sin
+        affine[:, 1, 0] = -sin
+        affine[:, 1, 1] = cos
+        affine[:, 0, 2] = center_x - cos * (center_x + shift_x) - sin * (center_y + shift_y)
+        affine[:, 1, 2] = center_y + sin * (center_x + shift_x) - cos * (center_y + shift_y)
+        affine[:, 2, 2] = 1
+
+        flip = params['flip'].to(device)
+        flips = torch.eye(3, device=device).repeat(n, 1, 1)
+        flips[flip, 0, 0] = -1
+        flips[flip, 0, 2] = side_x - 1
+        return matrices, flips @ affine
+
+    @staticmethod
+    def _homography(points, targets):
+        # Solve for the [N, 3, 3] projective maps taking each set of 4 points onto its targets
+        x, y = points[..., 0], points[..., 1]
+        u, v = targets[..., 0], targets[..., 1]
+        zeros, ones = torch.zeros_like(x), torch.ones_like(x)
+        rows_u = torch.stack([x, y, ones, zeros, zeros, zeros, -u * x, -u * y], dim=-1)
+        rows_v = torch.stack([zeros, zeros, zeros, x, y, ones, -v * x, -v * y], dim=-1)
+        a = torch.cat([rows_u, rows_v], dim=1)
+        b = torch.cat([u, v], dim=1)
+        h = torch.linalg.solve(a, b.unsqueeze(-1)).squeeze(-1)
+        return torch.cat([h, torch.ones_like(h[:, :1])], dim=1).view(-1, 3, 3)
+
+    def warp(self, x, params):
+        n, _, side_y, side_x = x.shape
+        perspective, affine = self.warp_matrices(params, side_x, side_y, x.device)
+        ys, xs = torch.meshgrid(
+            torch.arange(side_y, dtype=torch.float32, device=x.device),
+            torch.arange(side_x, dtype=torch.float32, device=x.device),
+            indexing='ij'
+        )
+        points = torch.stack([xs, ys, torch.ones_like(xs)], dim=-1).view(1, -1, 3)
+        between = points @ perspective.transpose(1, 2)
+        between = between / between[..., 2:]
+        # Fade out points that the perspective takes outside the rotated image's frame, as sampling
+        # its zero padding would
+        inside = (
+            (between[..., 0] + 1).clamp(0, 1) * (side_x - between[..., 0]).clamp(0, 1)
+            * (between[..., 1] + 1).clamp(0, 1) * (side_y - between[..., 1]).clamp(0, 1)
+        ).view(n, 1, side_y, side_x)
+        source = between @ affine.transpose(1, 2)
+        source = source[..., :2]
+        scale = torch.tensor([2 / max(side_x - 1, 1), 2 / max(side_y - 1, 1)], device=x.device)
+        grid = (source * scale - 1).view(n, side_y, side_x, 2)
+        warped = F.grid_sample(x, grid.to(x.dtype), mode='bilinear', padding_mode='zeros', align_corners=True)
+        return warped * inside.to(x.dtype)
+
+    def color_jitter(self, x, params):
+        factors = params['jitter'].to(x.device)
+        order = params['jitter_order'].to(x.device)
+        adjustments = [_brightness, _contrast, _saturation, _hue]
+        for step in range(4):
+            for i, adjust in enumerate(adjustments):
+                idx = (order[:, step] == i).nonzero().flatten()
+                if len(idx):
+                    factor = factors[idx, i].view(-1, 1, 1, 1) if adjust is not _hue else factors[idx, i]
+                    x = x.index_copy(0, idx, adjust(x[idx], factor))
+        return x
+
+    def forward(self, x, params=None):
+        """
+        Augment x with params from draw(), or freshly drawn ones.
+        """
+        if params is None:
+            params = self.draw(x.shape[0], x.shape[-1], x.shape[-2])
+        x = self.warp(x, params)
+        grey = params['grey'].to(x.device).view(-1, 1, 1, 1)
+        x = torch.where(grey, _grayscale(x), x)
+        x = x + torch.randn_like(x) * self.noise_std
+        if self.jitter:
+            x = self.color_jitter(x, params)
+        return x
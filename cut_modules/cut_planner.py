@@ -0,0 +1,54 @@
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+
+import torch
+
+
+class CutPlanner(object):
+    """
+    Plans cuts on a background thread, so the random choices for the next cut batches are made
+    while the current batch runs through CLIP. Plans are made in the order they're submitted from
+    one generator seeded with seed, so a run cuts the same way every time regardless of how the
+    threads interleave.
+    """
+
+    def __init__(self, seed):
+        self.generator = torch.Generator().manual_seed(seed)
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='cut-planner')
+
+    def _plan(self, cut_module, side_x, side_y, batch_size, heatmap, pad_inner, skip_augs, config):
+        if config:
+            cut_module.configure(**config)
+        # Hold the heatmap while it's sampled and updated, so it can be read from other threads
+        with heatmap.lock if heatmap is not None else nullcontext():
+            plan = cut_module.plan(
+                side_x,
+                side_y,
+                batch_size,
+                heatmap=heatmap,
+                pad_inner=pad_inner,
+                skip_augs=skip_augs,
+                generator=self.generator
+            )
+            # The next plan for this heatmap has to see this one's cuts decayed
+            if heatmap is not None:
+                heatmap.decay()
+        return plan
+
+    def submit(self, cut_module, side_x, side_y, batch_size=1, heatmap=None, pad_inner=False, skip_augs=False,
+               config=None):
+        """
+        Queue a plan for cut_module, configured with config first if given. Returns a Future of the CutPlan.
+        """
+        return self.executor.submit(
+            self._plan, cut_module, side_x, side_y, batch_size, heatmap, pad_inner, skip_augs, config
+        )
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -1,17 +1,19 @@
 import math
-import random
 import logging
+import threading
+from collections import namedtuple
 
-import numpy as np
-from scipy.ndimage.filters import gaussian_filter
 import torch
-from resize_right import resize
 from torch import nn
 import torchvision.transforms as T
 from torch.nn import functional as F
 import torchvision.transforms.functional as TF
+from torchvision.ops import roi_align
 from PIL import ImageDraw
 
+from cut_modules.augmentations import BatchAugment
+from cut_modules.resampling import resize_separable
+
 
 logger = logging.getLogger(__name__)
 
@@ -37,69 +39,163 @@ def save_cut_image(cutout, f_name: str):
     )
 
 
-def sinc(x):
-    return torch.where(x != 0,
-                       torch.sin(math.pi * x) / (math.pi * x), x.new_ones([]))
+def resample(input, size):
+    """
+    Lanczos resample of an [N, C, H, W] batch, as two matmuls with cached matrices.
+    """
+    return resize_separable(input, size, method='lanczos')
 
 
-def lanczos(x, a):
-    cond = torch.logical_and(-a < x, x < a)
-    out = torch.where(cond, sinc(x) * sinc(x / a), x.new_zeros([]))
-    return out / out.sum()
+def center_to_bounds(center_x, center_y, cut_size, image_x, image_y):
+    pad_size = int(cut_size / 2)
+    left_bound = max((center_x - pad_size), 0)
+    right_bound = min((center_x + pad_size), image_x)
+    top_bound = max((center_y - pad_size), 0)
+    bottom_bound = min((center_y + pad_size), image_y)
+    return left_bound, right_bound, top_bound, bottom_bound
 
 
-def ramp(ratio, width):
-    n = math.ceil(width / ratio + 1)
-    out = torch.empty([n])
-    cur = 0
-    for i in range(out.shape[0]):
-        out[i] = cur
-        cur += ratio
-    return torch.cat([-out[1:].flip([0]), out])[1:-1]
+def extract_cuts(input, boxes, cut_size):
+    """
+    Crop every (left, right, top, bottom) box out of input and resample them all to cut_size in one
+    batched call. Each output pixel averages the source pixels under it, so large boxes are
+    antialiased the way resize() does it. Boxes may reach past the image edge; that part reads as
+    zeros, the same as cutting from a zero padded image. Returns the cuts box-major, one per image
+    in the input batch.
+    """
+    n, _, side_y, side_x = input.shape
+    # roi_align clamps samples within a pixel of the edge rather than zeroing them, so when a box
+    # reaches past the edge, pad once with a one pixel zero border for it to clamp to. Boxes inside
+    # the image are read straight from the input.
+    pad = int(any(left < 0 or top < 0 or right > side_x or bottom > side_y for left, right, top, bottom in boxes))
+    if pad:
+        input = F.pad(input, (pad, pad, pad, pad))
+    rois = torch.tensor(
+        [[b, left + pad, top + pad, right + pad, bottom + pad] for left, right, top, bottom in boxes for b in range(n)],
+        dtype=input.dtype,
+        device=input.device
+    )
+    return roi_align(input, rois, output_size=cut_size, sampling_ratio=-1, aligned=True)
+
+
+def build_pyramid(input, min_size=64):
+    """
+    A mip pyramid of input: input itself, then each level averaged down 2x2 from the one before,
+    until the next level's shorter side would drop below min_size. Built with differentiable ops,
+    so gradients flow back through every level to input.
+    """
+    levels = [input]
+    while min(levels[-1].shape[-2:]) // 2 >= min_size:
+        levels.append(F.avg_pool2d(levels[-1], 2, ceil_mode=True))
+    return levels
+
+
+def pyramid_level(box_size, cut_size, level_count):
+    # The coarsest level that still has at least cut_size pixels across the box
+    if box_size <= cut_size:
+        return 0
+    return min(int(math.log2(box_size / cut_size)), level_count - 1)
+
+
+def extract_pyramid_cuts(pyramid, boxes, cut_size):
+    """
+    extract_cuts, but each box is cut from the pyramid level closest to its scale rather than the
+    full resolution image, so big boxes average a few pixels per cut pixel instead of hundreds.
+    Boxes are in full resolution pixels. Returns the cuts in the same order as extract_cuts.
+    """
+    n = pyramid[0].shape[0]
+    levels = [pyramid_level(max(right - left, bottom - top), cut_size, len(pyramid)) for left, right, top, bottom in boxes]
+    cuts, order = [], []
+    for level in sorted(set(levels)):
+        picked = [i for i, box_level in enumerate(levels) if box_level == level]
+        scale = 0.5 ** level
+        cuts.append(extract_cuts(pyramid[level], [tuple(c * scale for c in boxes[i]) for i in picked], cut_size))
+        order += picked
+    cuts = torch.cat(cuts)
+    if len(cuts) > 1:
+        # Back to box order, keeping each box's n cuts together
+        position = torch.empty(len(order), dtype=torch.long)
+        position[torch.tensor(order)] = torch.arange(len(order))
+        rows = (position.view(-1, 1) * n + torch.arange(n)).flatten()
+        cuts = cuts[rows.to(cuts.device)]
+    return cuts
+
+
+def random_sample(side_x, side_y, inner_mask_size=0, generator=None):
+    return (
+        torch.randint(inner_mask_size, side_x - inner_mask_size, (), generator=generator),
+        torch.randint(inner_mask_size, side_y - inner_mask_size, (), generator=generator)
+    )
 
 
-def resample(input, size, align_corners=True):
-    n, c, h, w = input.shape
-    dh, dw = size
+def overview_base(input, cut_size, padargs={}):
+    """
+    The whole image padded towards square and resized to cut_size. Every overview cut starts from it.
+    """
+    side_y, side_x = input.shape[2:4]
+    max_size = min(side_x, side_y)
+    pad_input = F.pad(
+        input,
+        ((side_y - max_size) // 2, (side_y - max_size) // 2,
+        (side_x - max_size) // 2, (side_x - max_size) // 2),
+        **padargs
+    )
+    return resize_separable(pad_input, (cut_size, cut_size))
 
-    input = input.reshape([n * c, 1, h, w])
 
-    if dh < h:
-        kernel_h = lanczos(ramp(dh / h, 2), 2).to(input.device, input.dtype)
-        pad_h = (kernel_h.shape[0] - 1) // 2
-        input = F.pad(input, (0, 0, pad_h, pad_h), 'reflect')
-        input = F.conv2d(input, kernel_h[None, None, :, None])
+def take_cuts(cutouts, n, overview_total, overview_count, inner_count):
+    """
+    Pick the first overview_count overview cuts and inner_count inner cuts out of a cut batch that
+    has overview_total overview cuts, for a model that wants fewer cuts than the batch holds.
+    """
+    if overview_count == overview_total and (overview_total + inner_count) * n == len(cutouts):
+        return cutouts
+    overview_cuts = cutouts[:overview_count * n]
+    inner_cuts = cutouts[overview_total * n:(overview_total + inner_count) * n]
+    return torch.cat([overview_cuts, inner_cuts])
 
-    if dw < w:
-        kernel_w = lanczos(ramp(dw / w, 2), 2).to(input.device, input.dtype)
-        pad_w = (kernel_w.shape[0] - 1) // 2
-        input = F.pad(input, (pad_w, pad_w, 0, 0), 'reflect')
-        input = F.conv2d(input, kernel_w[None, None, None, :])
 
-    input = input.reshape([n, c, h, w])
-    return F.interpolate(input,
-                         size,
-                         mode='bicubic',
-                         align_corners=align_corners)
+def gaussian_kernel(sigma, truncate=4.0):
+    radius = int(truncate * sigma + 0.5)
+    x = torch.arange(-radius, radius + 1, dtype=torch.float32)
+    kernel = torch.exp(-0.5 * (x / sigma) ** 2)
+    return kernel / kernel.sum()
 
 
-def center_to_bounds(center_x, center_y, cut_size, image_x, image_y):
-    pad_size = int(cut_size / 2)
-    left_bound = max((center_x - pad_size), 0)
-    right_bound = min((center_x + pad_size), image_x)
-    top_bound = max((center_y - pad_size), 0)
-    bottom_bound = min((center_y + pad_size), image_y)
-    return left_bound, right_bound, top_bound, bottom_bound
+def reflect_indices(size, radius, device=None):
+    # Index map for padding an axis by mirroring it, edge included (scipy's 'reflect'), for any
+    # radius, even one longer than the axis
+    idx = torch.arange(-radius, size + radius, device=device) % (2 * size)
+    return torch.where(idx >= size, 2 * size - 1 - idx, idx)
 
 
-def random_sample(side_x, side_y, inner_mask_size=0):
-    return (
-        torch.randint(inner_mask_size, side_x - inner_mask_size, ()),
-        torch.randint(inner_mask_size, side_y - inner_mask_size, ())
-    )
+def gaussian_blur(image, sigma):
+    """
+    Separable gaussian blur of a 2D tensor, matching scipy.ndimage.gaussian_filter's defaults.
+    """
+    kernel = gaussian_kernel(sigma).to(image.device, image.dtype)
+    radius = (len(kernel) - 1) // 2
+    height, width = image.shape
+    image = image.index_select(0, reflect_indices(height, radius, image.device))
+    image = F.conv2d(image[None, None], kernel.view(1, 1, -1, 1))[0, 0]
+    image = image.index_select(1, reflect_indices(width, radius, image.device))
+    return F.conv2d(image[None, None], kernel.view(1, 1, 1, -1))[0, 0]
+
+
+# Every random choice for one batch of cuts, made by MakeCutoutsDango.plan()
+CutPlan = namedtuple(
+    'CutPlan',
+    ['overview_count', 'overview_kinds', 'overview_augment', 'bounds', 'boxes', 'grey_count', 'inner_augment']
+)
 
 
 class CutHeatmap(object):
+    """
+    Tracks which parts of the image recent inner cuts have covered, so new cuts favour the rest.
+    The map is a tensor on device. With resolution below 1 it is kept that much smaller than the
+    image, and each cell stands for a block of image pixels; centerpoints are then picked uniformly
+    within the chosen cell. A CutPlanner updates the map on its own thread while holding lock.
+    """
 
     def __init__(
             self,
@@ -107,49 +203,113 @@ class CutHeatmap(object):
             side_y,
             decay_scale=0.3,
             decay_gaussian_sigma=7,
-            overlap_penalty_coef=0.3
+            overlap_penalty_coef=0.3,
+            resolution=1.0,
+            device='cpu'
     ):
-        self.heatmap = np.ones((side_y, side_x), dtype=np.float32)
+        self.side_x = side_x
+        self.side_y = side_y
+        self.device = torch.device(device)
+        self.heatmap = torch.ones((max(1, round(side_y * resolution)), max(1, round(side_x * resolution))))
         self.decay_scale = decay_scale
         self.decay_gaussian_sigma = decay_gaussian_sigma
         self.overlap_penalty_coef = overlap_penalty_coef
+        self.lock = threading.Lock()
+
+    @property
+    def heatmap(self):
+        return self._heatmap
+
+    @heatmap.setter
+    def heatmap(self, value):
+        self._heatmap = torch.as_tensor(value, dtype=torch.float32, device=self.device)
+
+    @property
+    def cell_size(self):
+        # Image pixels per map cell, along x and y
+        return self.side_x / self.heatmap.shape[-1], self.side_y / self.heatmap.shape[-2]
 
     def add_cut(self, center_x, center_y, cut_size):
-        left, right, top, bottom = center_to_bounds(
-            center_x,
-            center_y,
-            cut_size,
-            image_x=self.heatmap.shape[-1],
-            image_y=self.heatmap.shape[-2]
-        )
-        self.heatmap[
-            top:bottom,
-            left:right
-        ] *= self.overlap_penalty_coef
+        self.add_cuts([center_x], [center_y], [cut_size])
+
+    def add_cuts(self, centers_x, centers_y, cut_sizes):
+        cell_x, cell_y = self.cell_size
+        for center_x, center_y, cut_size in zip(centers_x, centers_y, cut_sizes):
+            left, right, top, bottom = center_to_bounds(
+                int(center_x),
+                int(center_y),
+                int(cut_size),
+                image_x=self.side_x,
+                image_y=self.side_y
+            )
+            self.heatmap[
+                int(top // cell_y):math.ceil(bottom / cell_y),
+                int(left // cell_x):math.ceil(right / cell_x)
+            ] *= self.overlap_penalty_coef
 
     def decay(self):
-        self.heatmap = gaussian_filter(self.heatmap, sigma=self.decay_gaussian_sigma)
-        self.heatmap = (
-            np.ones(self.heatmap.shape, dtype=np.float32) * self.decay_scale + self.heatmap
-        ) / (1 + self.decay_scale)
+        cell_x, cell_y = self.cell_size
+        sigma = self.decay_gaussian_sigma / ((cell_x + cell_y) / 2)
+        self.heatmap = (gaussian_blur(self.heatmap, sigma) + self.decay_scale) / (1 + self.decay_scale)
 
     def sample_centerpoint(self, cut_size, padded=False):
-        cut_offset = int(cut_size / 2)
-        if padded:
-            # If we will pad the image, any centerpoint is valid
-            centerpoints = self.heatmap
-        else:
-            # Otherwise, only select points half a cut size away from the edge
-            centerpoints = self.heatmap[cut_offset:-cut_offset, cut_offset:-cut_offset]
-        linear_idx = np.random.choice(centerpoints.size, p=centerpoints.ravel() / float(centerpoints.sum()))
-        y, x = np.unravel_index(linear_idx, centerpoints.shape)
-        if not padded:
-            x += cut_offset
-            y += cut_offset
-        return x, y
+        x, y = self.sample_centerpoints([cut_size], padded=padded)
+        return x[0], y[0]
+
+    def sample_centerpoints(self, cut_sizes, padded=False, generator=None):
+        """
+        Draw one centerpoint per cut size, all from the current map. If the image will be padded any
+        centerpoint is valid; otherwise they're kept half a cut size away from the edge. Returns
+        lists of x and y in image pixels. Random numbers come from generator (a CPU generator) if
+        given.
+        """
+        map_y, map_x = self.heatmap.shape
+        cell_x, cell_y = self.cell_size
+        sizes = torch.as_tensor(cut_sizes, device=self.device).long()
+        cut_offsets = torch.zeros_like(sizes) if padded else torch.div(sizes, 2, rounding_mode='floor')
+        # Pixel range each centerpoint may fall in, then the map cells that overlap it
+        x_lo, x_hi = cut_offsets, self.side_x - cut_offsets
+        y_lo, y_hi = cut_offsets, self.side_y - cut_offsets
+        cx_lo = (x_lo / cell_x).floor().long()
+        cx_hi = (x_hi / cell_x).ceil().long().clamp(max=map_x)
+        cy_lo = (y_lo / cell_y).floor().long()
+        cy_hi = (y_hi / cell_y).ceil().long().clamp(max=map_y)
+
+        # Cumulative sums along each row give every cut's row masses, and then its column within
+        # the chosen row, with one searchsorted each
+        row_cumsum = F.pad(self.heatmap.cumsum(dim=1), (1, 0))
+        row_mass = row_cumsum[:, cx_hi].T - row_cumsum[:, cx_lo].T
+        rows = torch.arange(map_y, device=self.device)
+        row_mass = row_mass * ((rows >= cy_lo[:, None]) & (rows < cy_hi[:, None]))
+        row_cdf = row_mass.cumsum(dim=1)
+        u = torch.rand(len(sizes), 2, generator=generator).to(self.device)
+        target = (u[:, :1] * row_cdf[:, -1:]).contiguous()
+        cell_row = torch.searchsorted(row_cdf, target, right=True).squeeze(1).clamp(max=map_y - 1)
+
+        chosen = row_cumsum[cell_row]
+        start = chosen.gather(1, cx_lo[:, None])
+        end = chosen.gather(1, cx_hi[:, None])
+        target = (start + u[:, 1:] * (end - start)).contiguous()
+        cell_col = (torch.searchsorted(chosen, target, right=True).squeeze(1) - 1).clamp(0, map_x - 1)
+
+        # Then a pixel within the cell, inside the allowed range
+        x = self._pixel_in_cell(cell_col, cell_x, x_lo, x_hi, generator)
+        y = self._pixel_in_cell(cell_row, cell_y, y_lo, y_hi, generator)
+        return x.tolist(), y.tolist()
+
+    @staticmethod
+    def _pixel_in_cell(cell, cell_size, lo, hi, generator=None):
+        first = torch.max((cell * cell_size).ceil().long(), lo)
+        last = torch.min(((cell + 1) * cell_size).ceil().long(), hi)
+        span = (last - first).clamp(min=1)
+        pixel = first + (torch.rand(len(cell), generator=generator).to(cell.device) * span).long()
+        # With cells a fractional number of pixels wide, the chosen cell can start at or past hi
+        return torch.minimum(pixel, torch.maximum(hi - 1, lo))
 
     def to_image(self):
-        return TF.to_pil_image(self.heatmap * 255).convert("RGB")
+        with self.lock:
+            heatmap = self.heatmap.cpu().numpy()
+        return TF.to_pil_image(heatmap * 255).convert("RGB")
 
     def save_image(self, name="cut_heatmap.jpg"):
         self.to_image().save(name, quality=99)
@@ -161,41 +321,32 @@ class MakeCutouts(nn.Module):
         self.cut_size = cut_size
         self.cutn = cutn
         self.skip_augs = skip_augs
-        self.augs = T.Compose([
-            T.RandomHorizontalFlip(p=0.5),
-            T.Lambda(lambda x: x + torch.randn_like(x) * 0.01),
-            T.RandomAffine(degrees=15, translate=(0.1, 0.1)),
-            T.Lambda(lambda x: x + torch.randn_like(x) * 0.01),
-            T.RandomPerspective(distortion_scale=0.4, p=0.7),
-            T.Lambda(lambda x: x + torch.randn_like(x) * 0.01),
-            T.RandomGrayscale(p=0.15),
-            T.Lambda(lambda x: x + torch.randn_like(x) * 0.01),
-            # T.ColorJitter(brightness=0.1, contrast=0.1, saturation=0.1, hue=0.1),
-        ])
+        self.augs = BatchAugment.for_animation_mode('Video Input')
 
     def forward(self, input):
-        input = T.Pad(input.shape[2] // 4, fill=0)(input)
-        sideY, sideX = input.shape[2:4]
-        max_size = min(sideX, sideY)
+        """
+        Take the whole batch of cutn cuts in one pass: square cuts with sizes drawn around 0.8 of the
+        image, and a few views of the whole image, all from the image padded by a quarter of its
+        height. The padding is never built; boxes just reach past the edge, which reads as zeros.
+        """
+        pad = input.shape[2] // 4
+        side_y, side_x = input.shape[2] + 2 * pad, input.shape[3] + 2 * pad
+        max_size = min(side_x, side_y)
 
-        cutouts = []
-        for ch in range(self.cutn):
-            if ch > self.cutn - self.cutn // 4:
-                cutout = input.clone()
-            else:
-                size = int(max_size * torch.zeros(1, ).normal_(
-                    mean=.8, std=.3).clip(float(self.cut_size / max_size), 1.))
-                offsetx = torch.randint(0, abs(sideX - size + 1), ())
-                offsety = torch.randint(0, abs(sideY - size + 1), ())
-                cutout = input[:, :, offsety:offsety + size,
-                         offsetx:offsetx + size]
-
-            if not self.skip_augs:
-                cutout = self.augs(cutout)
-            cutouts.append(resample(cutout, (self.cut_size, self.cut_size)))
-            del cutout
-
-        cutouts = torch.cat(cutouts, dim=0)
+        # The last few cuts are the whole padded image
+        full_count = max(self.cutn // 4 - 1, 0)
+        count = self.cutn - full_count
+        sizes = (max_size * torch.empty(count).normal_(mean=.8, std=.3).clip(float(self.cut_size / max_size), 1.)).long()
+        offsets_x = (torch.rand(count) * (side_x - sizes + 1)).long()
+        offsets_y = (torch.rand(count) * (side_y - sizes + 1)).long()
+        boxes = [
+            (x - pad, x + size - pad, y - pad, y + size - pad)
+            for x, y, size in zip(offsets_x.tolist(), offsets_y.tolist(), sizes.tolist())
+        ]
+        boxes += [(-pad, side_x - pad, -pad, side_y - pad)] * full_count
+        cutouts = extract_cuts(input, boxes, self.cut_size)
+        if not self.skip_augs:
+            cutouts = self.augs(cutouts)
         # For parity with MakeCutoutsDango, return an empty innercut bound list
         return cutouts, []
 
@@ -215,48 +366,17 @@ class MakeCutoutsDango(nn.Module):
         self.inner_cut_count = InnerCrop
         self.inner_cut_size_exponent = IC_Size_Pow
         self.inner_cut_grey_exponent = IC_Grey_P
-        if animation_mode == 'None':
-            self.augs = T.Compose([
-                T.RandomHorizontalFlip(p=0.5),
-                T.Lambda(lambda x: x + torch.randn_like(x) * 0.01),
-                T.RandomAffine(degrees=10,
-                               translate=(0.05, 0.05),
-                               interpolation=T.InterpolationMode.BILINEAR),
-                T.Lambda(lambda x: x + torch.randn_like(x) * 0.01),
-                T.RandomGrayscale(p=0.1),
-                T.Lambda(lambda x: x + torch.randn_like(x) * 0.01),
-                T.ColorJitter(brightness=0.1,
-                              contrast=0.1,
-                              saturation=0.1,
-                              hue=0.1),
-            ])
-        elif animation_mode == 'Video Input':
-            self.augs = T.Compose([
-                T.RandomHorizontalFlip(p=0.5),
-                T.Lambda(lambda x: x + torch.randn_like(x) * 0.01),
-                T.RandomAffine(degrees=15, translate=(0.1, 0.1)),
-                T.Lambda(lambda x: x + torch.randn_like(x) * 0.01),
-                T.RandomPerspective(distortion_scale=0.4, p=0.7),
-                T.Lambda(lambda x: x + torch.randn_like(x) * 0.01),
-                T.RandomGrayscale(p=0.15),
-                T.Lambda(lambda x: x + torch.randn_like(x) * 0.01),
-                # T.ColorJitter(brightness=0.1, contrast=0.1, saturation=0.1, hue=0.1),
-            ])
-        elif animation_mode == '2D' or animation_mode == '3D':
-            self.augs = T.Compose([
-                T.RandomHorizontalFlip(p=0.4),
-                T.Lambda(lambda x: x + torch.randn_like(x) * 0.01),
-                T.RandomAffine(degrees=10,
-                               translate=(0.05, 0.05),
-                               interpolation=T.InterpolationMode.BILINEAR),
-                T.Lambda(lambda x: x + torch.randn_like(x) * 0.01),
-                T.RandomGrayscale(p=0.1),
-                T.Lambda(lambda x: x + torch.randn_like(x) * 0.01),
-                T.ColorJitter(brightness=0.1,
-                              contrast=0.1,
-                              saturation=0.1,
-                              hue=0.3),
-            ])
+        self.augs = BatchAugment.for_animation_mode(animation_mode)
+
+    def configure(self, Overview=4, InnerCrop=0, IC_Size_Pow=0.5, IC_Grey_P=0.2):
+        """
+        Change the cut counts and inner cut settings, so one module can be reused from step to step.
+        """
+        self.overview_cut_count = Overview
+        self.inner_cut_count = InnerCrop
+        self.inner_cut_size_exponent = IC_Size_Pow
+        self.inner_cut_grey_exponent = IC_Grey_P
+        return self
 
     def forward(
             self,
@@ -265,65 +385,138 @@ class MakeCutoutsDango(nn.Module):
             heatmap=None,
             padargs={},
             pad_inner=False,
-            fix_size=False
+            fix_size=False,
+            overview=None,
+            plan=None,
+            pyramid=None,
+            out=None
     ):
+        """
+        Cut input according to plan, a CutPlan from plan(). Without one, the cuts are planned here.
+        If pyramid, a build_pyramid() of input, is given the inner cuts are taken from it. The cuts
+        are written into out if given (see CutBuffer), else concatenated into a new tensor. Returns
+        the cuts and the bounds of the inner cuts.
+        """
         cutouts = []
         gray = T.Grayscale(3)
         side_y, side_x = input.shape[2:4]
-
-        max_size = min(side_x, side_y)
-        min_size = min(side_x, side_y, self.cut_size)
-        output_shape = [1, 3, self.cut_size, self.cut_size]
-
-        pad_input = F.pad(
-            input,
-            ((side_y - max_size) // 2, (side_y - max_size) // 2,
-            (side_x - max_size) // 2, (side_x - max_size) // 2),
-            **padargs
-        )
-        cutout = resize(pad_input, out_shape=output_shape)
-
-        # create a list of 1 to 4 in random order, then do the matching overview cut
-        # This way even with less than 4 overview cuts, you still get a mix of all of them
-        if 0 < self.overview_cut_count <= 4:
-            li = [1, 1, 2, 3, 4] # give a slight edge to the normal, full color cut
-            ri = random.sample(li, self.overview_cut_count)
-            ri.sort()
-            for i in range(self.overview_cut_count):
-                if ri[i] == 1:
+        if plan is None:
+            plan = self.plan(side_x, side_y, input.shape[0], heatmap, pad_inner, fix_size, skip_augs)
+
+        if plan.overview_count > 0:
+            cutout = overview if overview is not None else overview_base(input, self.cut_size, padargs)
+        if plan.overview_kinds:
+            for kind in plan.overview_kinds:
+                if kind == 1:
                     cutouts.append(cutout)
-                if ri[i] == 2:
+                if kind == 2:
                     cutouts.append(gray(cutout))
-                if ri[i] == 3:
+                if kind == 3:
                     cutouts.append(TF.hflip(cutout))
-                if ri[i] == 4:
+                if kind == 4:
                     cutouts.append(gray(TF.hflip(cutout)))
-        elif self.overview_cut_count > 4:
-            cutout = resize(pad_input, out_shape=output_shape)
-            for _ in range(self.overview_cut_count):
-                if not skip_augs:
-                    cutouts.append(self.augs(cutout))
-                else:
-                    cutouts.append(cutout)
-
-        innercut_bound_list = []
-        for i in range(self.inner_cut_count):
-            if fix_size:
-                size = min_size
+        elif plan.overview_count > 0:
+            cutout = cutout.repeat(plan.overview_count, 1, 1, 1)
+            if plan.overview_augment is not None:
+                cutout = self.augs(cutout, plan.overview_augment)
+            cutouts.append(cutout)
+
+        if plan.boxes:
+            if pyramid is not None:
+                inner_cuts = extract_pyramid_cuts(pyramid, plan.boxes, self.cut_size)
             else:
-                size = int(
-                    torch.rand([]) ** self.inner_cut_size_exponent * (max_size - min_size) + min_size
+                inner_cuts = extract_cuts(input, plan.boxes, self.cut_size)
+            inner_cuts = torch.cat([gray(inner_cuts[:plan.grey_count]), inner_cuts[plan.grey_count:]])
+            if plan.inner_augment is not None:
+                inner_cuts = self.augs(inner_cuts, plan.inner_augment)
+            cutouts.append(inner_cuts)
+        if out is None:
+            return torch.cat(cutouts), plan.bounds
+        start = 0
+        for cutout in cutouts:
+            out[start:start + len(cutout)].copy_(cutout)
+            start += len(cutout)
+        return out, plan.bounds
+
+    def plan(
+            self,
+            side_x,
+            side_y,
+            batch_size=1,
+            heatmap=None,
+            pad_inner=False,
+            fix_size=False,
+            skip_augs=False,
+            generator=None
+    ):
+        """
+        Make every random choice for one batch of cuts from a side_x by side_y image, without
+        touching any pixels: which overview cuts to take, where the inner cuts go, which are grey
+        and how each is augmented. Random numbers come from generator (a CPU generator) if given,
+        so cuts can be planned away from the global random state.
+        """
+        overview_kinds = []
+        overview_augment = None
+        # create a list of 1 to 4 in random order, then do the matching overview cut
+        # This way even with less than 4 overview cuts, you still get a mix of all of them
+        if 0 < self.overview_cut_count <= 4:
+            li = [1, 1, 2, 3, 4] # give a slight edge to the normal, full color cut
+            picks = torch.randperm(len(li), generator=generator)[:self.overview_cut_count]
+            overview_kinds = sorted(li[i] for i in picks)
+        elif self.overview_cut_count > 4 and not skip_augs:
+            overview_augment = self.augs.draw(
+                self.overview_cut_count * batch_size, self.cut_size, self.cut_size, generator
+            )
+
+        bounds, boxes = self.plan_inner_cuts(side_x, side_y, heatmap, pad_inner, fix_size, generator)
+        grey_count = min(int(self.inner_cut_grey_exponent * self.inner_cut_count) + 1, len(boxes))
+        inner_augment = None
+        if boxes and not skip_augs:
+            inner_augment = self.augs.draw(len(boxes) * batch_size, self.cut_size, self.cut_size, generator)
+        return CutPlan(
+            overview_count=self.overview_cut_count,
+            overview_kinds=overview_kinds,
+            overview_augment=overview_augment,
+            bounds=bounds,
+            boxes=boxes,
+            grey_count=grey_count * batch_size,
+            inner_augment=inner_augment
+        )
+
+    def plan_inner_cuts(self, side_x, side_y, heatmap=None, pad_inner=False, fix_size=False, generator=None):
+        """
+        Pick the size and position of every inner cut before any pixels are touched. Returns the
+        bounds of each cut and the box to extract for it, both as (left, right, top, bottom) in
+        image coordinates. They only differ for padded cuts, whose boxes are clipped to the padded
+        image.
+        """
+        max_size = min(side_x, side_y)
+        min_size = min(side_x, side_y, self.cut_size)
+        if fix_size:
+            sizes = [min_size] * self.inner_cut_count
+        else:
+            sizes = (
+                torch.rand([self.inner_cut_count], generator=generator) ** self.inner_cut_size_exponent * (max_size - min_size) + min_size
+            ).int().tolist()
+
+        if heatmap:
+            centers = heatmap.sample_centerpoints(sizes, padded=pad_inner, generator=generator)
+            heatmap.add_cuts(*centers, sizes)
+        else:
+            centers = [[], []]
+            for size in sizes:
+                inner_mask_size = 0 if pad_inner else int(size / 2)
+                center_x, center_y = random_sample(
+                    side_x, side_y, inner_mask_size=inner_mask_size, generator=generator
                 )
+                centers[0].append(center_x)
+                centers[1].append(center_y)
+
+        innercut_bound_list = []
+        boxes = []
+        for size, center_x, center_y in zip(sizes, *centers):
             pad_size = int(size / 2) if pad_inner else 0
-            if heatmap:
-                center_x, center_y = heatmap.sample_centerpoint(size, padded=pad_inner)
-                heatmap.add_cut(center_x, center_y, size)
-            else:
-                inner_mask_size = 0 if pad_inner else int(size / 2)
-                center_x, center_y = random_sample(side_x, side_y, inner_mask_size=inner_mask_size)
             if pad_inner:
-                pad = T.Pad(pad_size)
-                padded = pad(input)
                 left, right, top, bottom = center_to_bounds(
                     center_x + pad_size,
                     center_y + pad_size,
@@ -331,18 +524,82 @@ class MakeCutoutsDango(nn.Module):
                     side_x + size,
                     side_y + size
                 )
-                innercut_bound_list.append((left - pad_size, right - pad_size, top - pad_size, bottom - pad_size))
-                cutout = padded[:, :, top:bottom, left:right]
-            else:
-                left, right, top, bottom = center_to_bounds(center_x, center_y, size, side_x, side_y)
-                innercut_bound_list.append((left, right, top, bottom))
-                cutout = input[:, :, top:bottom, left:right]
-            if i <= int(self.inner_cut_grey_exponent * self.inner_cut_count):
-                cutout = gray(cutout)
-            cutout = resize(cutout, out_shape=output_shape)
-            if not skip_augs:
-                cutouts.append(self.augs(cutout))
+                bounds = (left - pad_size, right - pad_size, top - pad_size, bottom - pad_size)
+                innercut_bound_list.append(bounds)
+                boxes.append((
+                    bounds[0],
+                    min(bounds[1], side_x + pad_size),
+                    bounds[2],
+                    min(bounds[3], side_y + pad_size)
+                ))
             else:
-                cutouts.append(cutout)
-        cutouts = torch.cat(cutouts)
-        return cutouts, innercut_bound_list
+                bounds = center_to_bounds(center_x, center_y, size, side_x, side_y)
+                innercut_bound_list.append(bounds)
+                boxes.append(bounds)
+        return innercut_bound_list, [tuple(int(v) for v in box) for box in boxes]
+
+
+class CutBuffer(object):
+    """
+    Storage that cut batches are written into, kept from batch to batch and step to step so long
+    runs don't allocate a new batch every time. reserve() it for the most rows a run will need
+    up front; take() grows it if a batch needs more.
+    """
+
+    def __init__(self):
+        self.buffer = None
+
+    def reserve(self, rows, cut_size, device, dtype=torch.float32):
+        buffer = self.buffer
+        if (
+            buffer is None or len(buffer) < rows or buffer.shape[-1] != cut_size
+            or buffer.device != torch.device(device) or buffer.dtype != dtype
+        ):
+            self.buffer = torch.empty((rows, 3, cut_size, cut_size), device=device, dtype=dtype)
+        return self.buffer
+
+    def take(self, rows, cut_size, device, dtype=torch.float32):
+        """
+        The first rows of the buffer. Writing cuts into it records the copies in autograd, so each
+        take detaches from whatever graph the last batch left on the buffer.
+        """
+        return self.reserve(rows, cut_size, device, dtype).detach()[:rows]
+
+
+class CutContext(object):
+    """
+    Cut work shared by every cut batch taken from one image in one guidance step: the image scaled
+    to [0, 1], the overview base for each cut size, the image pyramid inner cuts are taken from
+    (unless use_pyramid is False) and the cut modules. The modules dict can be passed in again each
+    step so modules are only built once per cut size.
+
+    The overview bases and pyramid stay part of the autograd graph of every batch cut from them, so
+    gradients taken per batch need retain_graph=True.
+    """
+
+    def __init__(self, x_in, modules=None, use_pyramid=True):
+        self.input = x_in.add(1).div(2)
+        self.modules = {} if modules is None else modules
+        self.overviews = {}
+        self.use_pyramid = use_pyramid
+        self._pyramid = None
+
+    def pyramid(self):
+        if not self.use_pyramid:
+            return None
+        if self._pyramid is None:
+            self._pyramid = build_pyramid(self.input)
+        return self._pyramid
+
+    def overview(self, cut_size):
+        if cut_size not in self.overviews:
+            self.overviews[cut_size] = overview_base(self.input, cut_size)
+        return self.overviews[cut_size]
+
+    def cut_module(self, cut_fn, cut_size, **kwargs):
+        key = (cut_fn, cut_size)
+        if key not in self.modules:
+            self.modules[key] = cut_fn(cut_size, **kwargs)
+        elif kwargs:
+            self.modules[key].configure(**kwargs)
+        return self.modules[key]
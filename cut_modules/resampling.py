@@ -0,0 +1,79 @@
+import math
+from collections import OrderedDict
+
+import torch
+from resize_right import resize
+from torch.nn import functional as F
+
+RESAMPLING_METHODS = ('cubic', 'lanczos')
+
+# Matrices for the sizes in use. A run only resizes between a handful of sizes, so this stays small
+_matrix_cache = OrderedDict()
+MATRIX_CACHE_SIZE = 64
+
+
+def sinc(x):
+    return torch.where(x != 0,
+                       torch.sin(math.pi * x) / (math.pi * x), x.new_ones([]))
+
+
+def lanczos(x, a):
+    cond = torch.logical_and(-a < x, x < a)
+    out = torch.where(cond, sinc(x) * sinc(x / a), x.new_zeros([]))
+    return out / out.sum()
+
+
+def ramp(ratio, width):
+    n = math.ceil(width / ratio + 1)
+    out = torch.arange(n, dtype=torch.float32) * ratio
+    return torch.cat([-out[1:].flip([0]), out])[1:-1]
+
+
+def _lanczos_resample_1d(input, out_size):
+    # The legacy resample along the last but one axis: a lanczos lowpass when shrinking, then bicubic
+    n, c, h, w = input.shape
+    if out_size < h:
+        kernel = lanczos(ramp(out_size / h, 2), 2).to(input.device, input.dtype)
+        pad = (kernel.shape[0] - 1) // 2
+        input = F.pad(input, (0, 0, pad, pad), 'reflect')
+        input = F.conv2d(input, kernel[None, None, :, None])
+    return F.interpolate(input, (out_size, w), mode='bicubic', align_corners=True)
+
+
+def _build_matrix(in_size, out_size, method):
+    # Both methods are linear and separable, so resizing the identity gives their weights exactly
+    if method == 'cubic':
+        identity = torch.eye(in_size, dtype=torch.float64).view(1, 1, in_size, in_size)
+        return resize(identity, out_shape=(1, 1, out_size, in_size)).view(out_size, in_size).float()
+    columns = torch.eye(in_size).view(in_size, 1, in_size, 1)
+    return _lanczos_resample_1d(columns, out_size).view(in_size, out_size).T.contiguous()
+
+
+def resampling_matrix(in_size, out_size, method='cubic', device='cpu', dtype=torch.float32):
+    """
+    The [out_size, in_size] matrix that resizes one axis. 'cubic' matches resize_right's default
+    antialiased cubic, 'lanczos' the legacy resample(). Matrices are cached by size, method,
+    device and dtype.
+    """
+    if method not in RESAMPLING_METHODS:
+        raise ValueError(f'Unknown resampling method {method}, use one of {RESAMPLING_METHODS}')
+    key = (in_size, out_size, method, str(device), dtype)
+    if key in _matrix_cache:
+        _matrix_cache.move_to_end(key)
+        return _matrix_cache[key]
+    matrix = _build_matrix(in_size, out_size, method).to(device=device, dtype=dtype)
+    _matrix_cache[key] = matrix
+    if len(_matrix_cache) > MATRIX_CACHE_SIZE:
+        _matrix_cache.popitem(last=False)
+    return matrix
+
+
+def resize_separable(input, size, method='cubic'):
+    """
+    Resize an [..., H, W] tensor to size (height, width) with two matmuls against cached matrices.
+    """
+    out_h, out_w = size
+    in_h, in_w = input.shape[-2:]
+    rows = resampling_matrix(in_h, out_h, method, input.device, input.dtype)
+    columns = resampling_matrix(in_w, out_w, method, input.device, input.dtype)
+    return rows @ input @ columns.T
@@ -0,0 +1,333 @@
+import logging
+
+import torch
+import torchvision.transforms.functional as TF
+from torch.nn import functional as F
+
+from cut_modules.cut_planner import CutPlanner
+from cut_modules.make_cutouts import CutContext, take_cuts
+from engine.guidance_pool import GuidancePool
+from helpers.precision import full_precision, mixed_precision
+from helpers.vram_helpers import available_memory
+from model_managers.secondary_model import alpha_sigma_to_t
+
+logger = logging.getLogger(__name__)
+
+# The share of free memory "auto" lets cut chunks use, leaving room for the rest of the step
+AUTO_CUT_MEMORY_FRACTION = 0.8
+
+
+def tv_loss(input):
+    """L2 total variation loss, as in Mahendran et al."""
+    input = F.pad(input, (0, 1, 0, 1), 'replicate')
+    x_diff = input[..., :-1, 1:] - input[..., :-1, :-1]
+    y_diff = input[..., 1:, :-1] - input[..., :-1, :-1]
+    return (x_diff**2 + y_diff**2).mean([1, 2, 3])
+
+
+def range_loss(input):
+    return (input - input.clamp(-1, 1)).pow(2).mean([1, 2, 3])
+
+
+def symm_loss_v(im, lpm):
+    h = int(im.shape[3]/2)
+    h1, h2 = im[:, :, :, :h], im[:, :, :, h:]
+    h2 = TF.hflip(h2)
+    return lpm(h1, h2)
+
+
+def symm_loss_h(im, lpm):
+    w = int(im.shape[2]/2)
+    w1, w2 = im[:, :, :w, :], im[:, :, w:, :]
+    w2 = TF.vflip(w2)
+    return lpm(w1, w2)
+
+
+def plan_cut_passes(cutn_batches, cut_counts, chunk_sizes):
+    """
+    How to run cutn_batches batches of cuts through a group of CLIP models that score cut_counts
+    cuts a batch each, when each can encode and backpropagate at most chunk_sizes cuts at once (None
+    when that isn't known). Returns how many batches to cut per pass, and how many cuts each model
+    should score at once. Models with room merge batches into fewer passes; models short of it
+    split each batch into chunks. A model without a chunk size keeps the batches as they are.
+    """
+    merge = cutn_batches
+    for cuts, chunk in zip(cut_counts, chunk_sizes):
+        merge = min(merge, chunk // cuts if chunk is not None else 1)
+    merge = max(merge, 1)
+    chunks = [
+        min(chunk, cuts * merge) if chunk is not None else cuts * merge
+        for cuts, chunk in zip(cut_counts, chunk_sizes)
+    ]
+    return merge, chunks
+
+
+class Guidance:
+    """
+    The CLIP guided cond_fn, with the state it needs held on the object instead of in globals.
+
+    settings is a namespace carrying the resolved run settings (the schedules are Schedule objects
+    indexed by 1000 - t). The caller keeps cur_t and run_step up to date as sampling progresses, and
+    can swap init between images.
+    """
+
+    def __init__(self, diffusion, model, clip_managers, settings, cut_model, lpips_model,
+                 secondary_model=None, init=None, rmask=None, cut_debug=False):
+        self.diffusion = diffusion
+        self.model = model
+        self.clip_managers = clip_managers
+        self.settings = settings
+        self.cut_model = cut_model
+        self.lpips_model = lpips_model
+        self.secondary_model = secondary_model
+        self.init = init
+        self.rmask = rmask
+        self.cut_debug = cut_debug
+        self.cur_t = None
+        self.run_step = 0
+        self.loss_values = []
+        self.cut_modules = {}
+        # Cut geometry is planned on its own thread from the seed the caller set before creating this
+        self.planner = CutPlanner(torch.initial_seed())
+        self.pool = None
+        for clip_manager in clip_managers:
+            clip_manager.set_activation_checkpointing(settings.clip_checkpointing)
+
+    def close(self):
+        """
+        Shut down the planner's thread and any guidance pool once the image is done. Guidance can
+        also be used as a context manager that does this.
+        """
+        self.planner.close()
+        if self.pool is not None:
+            self.pool.close()
+            self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def cut_memory_budget(self, device):
+        """
+        The bytes CLIP may use for one chunk of cuts, from the cut_memory_budget setting: "auto" for
+        most of what's free on device right now, a number of GiB, or "off" to keep cutn_batches as
+        given.
+        """
+        budget = self.settings.cut_memory_budget
+        if budget in (None, False, 'off'):
+            return None
+        if budget == 'auto':
+            available = available_memory(device)
+            budget = None if available is None else int(available * AUTO_CUT_MEMORY_FRACTION)
+        else:
+            budget = int(float(budget) * 1024 ** 3)
+        # Concurrent workers each have a chunk in memory at once
+        if budget is not None and self.settings.guidance_workers > 1:
+            budget //= self.settings.guidance_workers
+        return budget
+
+    def guidance_pool(self, device):
+        # Made on first use, once the device is known
+        if self.settings.guidance_workers > 1 and self.pool is None:
+            self.pool = GuidancePool(self.settings.guidance_workers, device)
+        return self.pool
+
+    def chunk_jobs(self, context, groups, plans, x_in, n, t_int, scale):
+        """
+        Cut each group's batches a pass at a time and yield a (fn, args) job per chunk of cuts per
+        model. Jobs only need x_in, so they can run in any order or at once.
+        """
+        settings = self.settings
+        for (group, counts, o_total, i_total, merge, chunks), group_plans in zip(groups, plans):
+            batch_rows = (o_total + i_total) * n
+            for start in range(0, len(group_plans), merge):
+                pass_plans = group_plans[start:start + merge]
+                rows = batch_rows * len(pass_plans)
+                if self.pool is None:
+                    cutouts = group[0].cut_buffer.take(rows, group[0].input_resolution, x_in.device, x_in.dtype)
+                else:
+                    # Passes overlap when run concurrently, so each needs its own cuts
+                    cutouts = x_in.new_empty((rows, 3, group[0].input_resolution, group[0].input_resolution))
+                for i, plan in enumerate(pass_plans):
+                    group[0].make_cuts(
+                        context,
+                        o_total,
+                        i_total,
+                        settings.cut_ic_pow,
+                        settings.cut_icgray_p,
+                        t_int,
+                        self.cut_model,
+                        self.cut_debug,
+                        plan=plan,
+                        out=cutouts[i * batch_rows:(i + 1) * batch_rows]
+                    )
+                for clip_manager, (o_cuts, i_cuts), chunk in zip(group, counts, chunks):
+                    if (o_cuts, i_cuts) == (o_total, i_total):
+                        model_cuts = cutouts
+                    else:
+                        model_cuts = torch.cat([
+                            take_cuts(cutouts[i * batch_rows:(i + 1) * batch_rows], n, o_total, o_cuts, i_cuts)
+                            for i in range(len(pass_plans))
+                        ])
+                    for chunk_start in range(0, len(model_cuts), chunk * n):
+                        yield self.chunk_gradient, (
+                            clip_manager,
+                            model_cuts[chunk_start:chunk_start + chunk * n],
+                            n,
+                            o_cuts + i_cuts,
+                            scale,
+                            x_in
+                        )
+                    del model_cuts
+                del cutouts
+
+    def chunk_gradient(self, clip_manager, cutouts, n, cuts, scale, x_in):
+        """
+        One chunk's share of the CLIP gradient. Returns the loss of the chunk's cuts, summed over the
+        batches they're from, and the gradient.
+        """
+        # Entered here rather than in cond_fn, since this may run on a worker thread
+        with mixed_precision(x_in.device, self.settings.mixed_precision):
+            clip_losses = clip_manager.cut_loss_sums(cutouts, n) / cuts
+        # The context's overview bases are shared by every chunk, so keep their graph around
+        prompt_grad = torch.autograd.grad(clip_losses.sum() * scale, x_in, retain_graph=True)[0]
+        return clip_losses.sum().item(), prompt_grad
+
+    def cut_groups(self):
+        """
+        The CLIP models that cut together. Normally each model takes its own cuts; with
+        share_cut_batches set, models with the same input resolution share one cut batch, sized for
+        whichever wants the most cuts, and each scores as many of those cuts as it would have taken.
+        """
+        if not self.settings.share_cut_batches:
+            return [[clip_manager] for clip_manager in self.clip_managers]
+        groups = {}
+        for clip_manager in self.clip_managers:
+            groups.setdefault(clip_manager.input_resolution, []).append(clip_manager)
+        return list(groups.values())
+
+    def cond_fn(self, x, t, y=None):
+        settings = self.settings
+        diffusion = self.diffusion
+        cur_t = self.cur_t
+        device = x.device
+        # The sampling step runs under autocast, but only the model forwards below should: the cuts
+        # and the gradient math stay in float32
+        with torch.enable_grad(), full_precision(device):
+            x_is_NaN = False
+            x = x.detach().requires_grad_()
+            n = x.shape[0]
+            if self.secondary_model is not None:
+                alpha = torch.tensor(diffusion.sqrt_alphas_cumprod[cur_t], device=device, dtype=torch.float32)
+                sigma = torch.tensor(diffusion.sqrt_one_minus_alphas_cumprod[cur_t], device=device, dtype=torch.float32)
+                cosine_t = alpha_sigma_to_t(alpha, sigma)
+                with mixed_precision(device, settings.mixed_precision):
+                    out = self.secondary_model(x, cosine_t[None].repeat([n])).pred.float()
+                fac = diffusion.sqrt_one_minus_alphas_cumprod[cur_t]
+                x_in = out * fac + x * (1 - fac)
+                x_in_grad = torch.zeros_like(x_in)
+            else:
+                my_t = torch.ones([n], device=device, dtype=torch.long) * cur_t
+                with mixed_precision(device, settings.mixed_precision):
+                    out = diffusion.p_mean_variance(self.model, x, my_t, clip_denoised=False, model_kwargs={'y': y})
+                fac = diffusion.sqrt_one_minus_alphas_cumprod[cur_t]
+                x_in = out['pred_xstart'].float() * fac + x * (1 - fac)
+                x_in_grad = torch.zeros_like(x_in)
+
+            t_int = int(t.item()) + 1
+            cutn_batches = settings.cutn_batches[1000 - t_int]
+            context = CutContext(x_in, self.cut_modules, use_pyramid=settings.cut_pyramid)
+            budget = self.cut_memory_budget(device)
+            groups = []
+            for group in self.cut_groups():
+                counts = [clip_manager.cut_counts(settings.cut_overview, settings.cut_innercut, t_int) for clip_manager in group]
+                o_total = max(o_cuts for o_cuts, _ in counts)
+                i_total = max(i_cuts for _, i_cuts in counts)
+                chunk_sizes = [
+                    clip_manager.cut_chunk_size(budget, n, (o_total + i_total) * cutn_batches) for clip_manager in group
+                ]
+                merge, chunks = plan_cut_passes(cutn_batches, [o + i for o, i in counts], chunk_sizes)
+                groups.append((group, counts, o_total, i_total, merge, chunks))
+                # Size the group's cut buffer for the biggest pass in the run, so it's rarely reallocated.
+                # Concurrent passes cut into their own tensors instead.
+                if settings.guidance_workers <= 1:
+                    max_counts = [clip_manager.max_cut_counts(settings.cut_overview, settings.cut_innercut) for clip_manager in group]
+                    group[0].cut_buffer.reserve(
+                        (max(o for o, _ in max_counts) + max(i for _, i in max_counts)) * n * merge,
+                        group[0].input_resolution,
+                        x_in.device,
+                        x_in.dtype
+                    )
+            # Queue every batch's cut plan now, so the planner works ahead while CLIP runs
+            plans = [
+                [
+                    group[0].plan_cuts(
+                        self.planner,
+                        context,
+                        o_total,
+                        i_total,
+                        settings.cut_ic_pow,
+                        settings.cut_icgray_p,
+                        t_int,
+                        self.cut_model
+                    )
+                    for _ in range(cutn_batches)
+                ]
+                for group, counts, o_total, i_total, merge, chunks in groups
+            ]
+            # Every cut adds its loss / (cuts per batch * cutn_batches) to the gradient, so however the
+            # batches are merged into passes or split into chunks, it's the average over cutn_batches
+            scale = settings.clip_guidance_scale[1000 - t_int] / cutn_batches
+            pool = self.guidance_pool(device)
+            jobs = self.chunk_jobs(context, groups, plans, x_in, n, t_int, scale)
+            if pool is not None:
+                results = pool.map_ordered(jobs)
+            else:
+                results = (fn(*args) for fn, args in jobs)
+            clip_loss = 0
+            # Summed in job order, so concurrent runs add up the same as sequential ones
+            for loss, prompt_grad in results:
+                clip_loss += loss
+                #factor in render_mask
+                if self.rmask is not None:
+                    x_in_grad += self.rmask.mul(prompt_grad)
+                else:
+                    x_in_grad += prompt_grad
+                del prompt_grad
+            # One value per step, the CLIP loss of every cut batch, however they were split into passes
+            self.loss_values.append(clip_loss)
+
+            tv_losses = tv_loss(x_in)
+            if self.secondary_model is not None:
+                range_losses = range_loss(out)
+            else:
+                range_losses = range_loss(out['pred_xstart'])
+            sat_losses = torch.abs(x_in - x_in.clamp(min=-1, max=1)).mean()
+            logger.debug(f"tv_loss: {tv_losses.sum()}")
+            logger.debug(f"range_loss: {range_losses.sum()}")
+            logger.debug(f"sat_loss: {sat_losses.sum()}")
+            loss = tv_losses.sum() * settings.tv_scale + range_losses.sum() * settings.range_scale + sat_losses.sum() * settings.sat_scale
+            if self.init is not None and settings.init_scale:
+                with mixed_precision(device, settings.mixed_precision):
+                    init_losses = self.lpips_model(x_in, self.init)
+                loss = loss + init_losses.sum() * settings.init_scale
+            if settings.symmetry_loss_v and self.run_step <= settings.symm_switch:
+                with mixed_precision(device, settings.mixed_precision):
+                    sloss = symm_loss_v(x_in, self.lpips_model)
+                loss = loss + sloss.sum() * settings.sloss_scale
+            if settings.symmetry_loss_h and self.run_step <= settings.symm_switch:
+                with mixed_precision(device, settings.mixed_precision):
+                    sloss = symm_loss_h(x_in, self.lpips_model)
+                loss = loss + sloss.sum() * settings.sloss_scale
+            x_in_grad += torch.autograd.grad(loss, x_in)[0]
+            if torch.isnan(x_in_grad).any() == False:
+                grad = -torch.autograd.grad(x_in, x, x_in_grad)[0]
+            else:
+                x_is_NaN = True
+                grad = torch.zeros_like(x)
+        if settings.clamp_grad and x_is_NaN == False:
+            magnitude = grad.square().mean().sqrt()
+            return grad * magnitude.clamp(max=settings.clamp_max[1000 - t_int]) / magnitude
+        return grad
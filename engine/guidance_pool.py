@@ -0,0 +1,93 @@
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+
+def _record_stream(values, stream):
+    for value in values if isinstance(values, (tuple, list)) else (values,):
+        if isinstance(value, torch.Tensor) and value.is_cuda:
+            value.record_stream(stream)
+
+
+class GuidancePool(object):
+    """
+    Runs independent guidance jobs, like one chunk of cuts through one CLIP model and back, several
+    at a time. On CPU the worker threads split the intra-op threads between them, so several small
+    forwards fill a machine one of them can't, and close() puts the thread count back; on GPU each
+    worker queues its work on its own CUDA stream. Results are handed back in the order jobs were submitted, so anything summed from them
+    comes out the same on every run.
+    """
+
+    def __init__(self, workers, device):
+        self.workers = workers
+        self.device = torch.device(device)
+        self.local = threading.local()
+        self.num_threads = torch.get_num_threads()
+        self.executor = ThreadPoolExecutor(
+            max_workers=workers,
+            thread_name_prefix='guidance',
+            initializer=torch.set_num_threads,
+            initargs=(max(1, self.num_threads // workers),)
+        )
+
+    def _stream(self):
+        if not hasattr(self.local, 'stream'):
+            self.local.stream = torch.cuda.Stream(self.device)
+        return self.local.stream
+
+    def _run(self, ready, fn, args):
+        if ready is None:
+            return fn(*args), None
+        stream = self._stream()
+        # Start once everything queued before the submit, like the cuts, is done, and keep the
+        # memory of tensors passed in from being reused until this stream is done with them
+        stream.wait_event(ready)
+        _record_stream(args, stream)
+        with torch.cuda.stream(stream):
+            result = fn(*args)
+        done = torch.cuda.Event()
+        done.record(stream)
+        return result, done
+
+    def submit(self, fn, *args):
+        ready = None
+        if self.device.type == 'cuda':
+            ready = torch.cuda.Event()
+            ready.record()
+        return self.executor.submit(self._run, ready, fn, args)
+
+    def result(self, future):
+        """
+        Wait for a job from submit and return what it returned, safe to use on the current stream.
+        """
+        result, done = future.result()
+        if done is not None:
+            stream = torch.cuda.current_stream(self.device)
+            stream.wait_event(done)
+            _record_stream(result, stream)
+        return result
+
+    def map_ordered(self, jobs):
+        """
+        Run (fn, args) jobs with at most two per worker in flight, yielding their results in order.
+        """
+        pending = deque()
+        for fn, args in jobs:
+            pending.append(self.submit(fn, *args))
+            if len(pending) > 2 * self.workers:
+                yield self.result(pending.popleft())
+        while pending:
+            yield self.result(pending.popleft())
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        # With some parallel backends the workers' thread count is the whole process's
+        torch.set_num_threads(self.num_threads)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
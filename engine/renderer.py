@@ -0,0 +1,444 @@
+import gc
+import logging
+import random
+from types import SimpleNamespace
+
+import numpy as np
+import torch
+import torchvision.transforms.functional as TF
+from PIL import Image, ImageEnhance, ImageStat
+
+from cut_modules.make_cutouts import MakeCutoutsDango
+from engine.guidance import Guidance
+from helpers.perlin import gen_perlin
+from helpers.precision import mixed_precision_iter
+from helpers.schedules import Schedule, auto_clamp_max, auto_clip_guidance_scale, auto_eta
+from helpers.utils import fetch, get_resampling_mode
+from helpers.vram_helpers import track_model_vram
+from model_managers.clip_manager import CLIP_NAME_MAP, ClipManager, ImagePromptStore
+from model_managers.diffusion_manager import (
+    SECONDARY_MODEL_FILE,
+    create_diffusion,
+    create_model_config,
+    download_models,
+    load_diffusion_model,
+    read_diffusion_model,
+    set_model_steps,
+)
+from model_managers.secondary_model import load_secondary_model
+
+logger = logging.getLogger(__name__)
+
+# Defaults for every setting render() understands. Keys match settings.json, so a settings file can be
+# passed straight in. CLIP models default to off here; anything not listed is ignored.
+RENDER_DEFAULTS = {
+    'text_prompts': {},
+    'image_prompts': {},
+    'n_batches': 1,
+    'steps': 250,
+    'width': 832,
+    'height': 512,
+    'width_height_scale': 1,
+    'set_seed': 'random_seed',
+    'clip_guidance_scale': 'auto',
+    'tv_scale': 0,
+    'range_scale': 150,
+    'sat_scale': 0,
+    'cutn_batches': 4,
+    'cutn_batches_final': None,
+    'init_image': None,
+    'render_mask': None,
+    'skip_steps_ratio': 0.0,
+    'init_scale': 1000,
+    'skip_steps': 0,
+    'perlin_init': False,
+    'perlin_mode': 'mixed',
+    'skip_augs': False,
+    'randomize_class': True,
+    'clip_denoised': False,
+    'clamp_grad': True,
+    'clamp_max': 'auto',
+    'fuzzy_prompt': False,
+    'rand_mag': 0.05,
+    'eta': 'auto',
+    'diffusion_model': '512x512_diffusion_uncond_finetune_008100',
+    'use_secondary_model': True,
+    'sampling_mode': 'ddim',
+    'cut_overview': '[12]*400+[4]*600',
+    'cut_innercut': '[4]*400+[12]*600',
+    'cut_ic_pow': '[1]*500+[10]*500',
+    'cut_ic_pow_final': None,
+    'cut_icgray_p': '[0.2]*400+[0]*600',
+    'smooth_schedules': False,
+    'stop_early': 0,
+    'fix_brightness_contrast': True,
+    'adjustment_interval': 10,
+    'high_contrast_threshold': 80,
+    'high_contrast_adjust_amount': 0.85,
+    'high_contrast_start': 20,
+    'high_contrast_adjust': True,
+    'low_contrast_threshold': 20,
+    'low_contrast_adjust_amount': 2,
+    'low_contrast_start': 20,
+    'low_contrast_adjust': True,
+    'high_brightness_threshold': 180,
+    'high_brightness_adjust_amount': 0.85,
+    'high_brightness_start': 0,
+    'high_brightness_adjust': True,
+    'low_brightness_threshold': 40,
+    'low_brightness_adjust_amount': 1.15,
+    'low_brightness_start': 0,
+    'low_brightness_adjust': True,
+    'symmetry_loss_v': False,
+    'symmetry_loss_h': False,
+    'symm_loss_scale': 2400,
+    'symm_switch': 45,
+    'image_prompt_refresh_steps': 0,
+    'share_cut_batches': False,
+    'cut_pyramid': True,
+    'cut_memory_budget': 'auto',
+    'guidance_workers': 1,
+    'mixed_precision': False,
+    'clip_checkpointing': False,
+}
+
+
+def _step_prompts(prompts, batch_num):
+    # Prompts are keyed by batch (frame) number, and each entry is either a list of prompts or a dict
+    # of step number to a list of prompts. Return the latter form for the given batch.
+    if not prompts:
+        return {}
+    keys = sorted(int(k) for k in prompts.keys())
+    key = max([k for k in keys if k <= batch_num], default=keys[0])
+    entry = prompts.get(str(key), prompts.get(key))
+    if type(entry) is list:
+        return {0: entry}
+    return {int(k): v for k, v in entry.items()}
+
+
+def _prompts_at(step_prompts, step):
+    if not step_prompts:
+        return []
+    keys = sorted(step_prompts.keys())
+    key = max([k for k in keys if k <= step], default=keys[0])
+    return step_prompts[key].copy()
+
+
+def resolve_settings(settings):
+    """
+    Fill in defaults and work out the automatic values for a settings dict, the same way prd.py does
+    for a settings file. Returns a namespace with the schedules parsed into Schedule objects.
+    """
+    resolved = dict(RENDER_DEFAULTS)
+    resolved.update(settings)
+    s = SimpleNamespace(**resolved)
+
+    s.clip_models = {
+        name: float(settings.get(name) or 0.0) for name in CLIP_NAME_MAP.keys() if settings.get(name)
+    }
+    if not s.clip_models:
+        raise ValueError('No CLIP models selected. Set at least one CLIP model (e.g. "ViTB32": 1.0).')
+    if not s.text_prompts and not s.image_prompts:
+        raise ValueError('No prompts provided. You must provide text_prompts and/or image_prompts.')
+
+    s.side_x = (int(s.width * s.width_height_scale) // 64) * 64
+    s.side_y = (int(s.height * s.width_height_scale) // 64) * 64
+
+    if s.set_seed == 'random_seed':
+        s.seed = random.randint(0, 2**32)
+    else:
+        s.seed = int(s.set_seed)
+
+    if s.skip_steps == 0 and (s.init_image is not None or s.perlin_init):
+        if 0 < s.skip_steps_ratio <= 1:
+            s.skip_steps = int(s.steps * s.skip_steps_ratio)
+        else:
+            s.skip_steps = int(s.steps * 0.33)
+
+    if s.eta == 'auto':
+        s.eta = auto_eta(s.steps)
+    if s.clamp_max == 'auto':
+        s.clamp_max = auto_clamp_max(s.steps, s.use_secondary_model)
+    if s.clip_guidance_scale == 'auto':
+        s.clip_guidance_scale = auto_clip_guidance_scale(s.side_x, s.side_y)
+
+    s.cutn_batches = Schedule.parse(s.cutn_batches, s.cutn_batches_final)
+    s.cut_overview = Schedule.parse(s.cut_overview)
+    s.cut_innercut = Schedule.parse(s.cut_innercut)
+    s.cut_ic_pow = Schedule.parse(s.cut_ic_pow, s.cut_ic_pow_final)
+    s.cut_icgray_p = Schedule.parse(s.cut_icgray_p)
+    s.clip_guidance_scale = Schedule.parse(s.clip_guidance_scale)
+    s.clamp_max = Schedule.parse(s.clamp_max)
+    if s.smooth_schedules:
+        s.cutn_batches = s.cutn_batches.smoothed()
+        s.cut_overview = s.cut_overview.smoothed()
+        s.cut_innercut = s.cut_innercut.smoothed()
+        s.cut_ic_pow = s.cut_ic_pow.smoothed()
+        s.clip_guidance_scale = s.clip_guidance_scale.smoothed()
+        s.clamp_max = s.clamp_max.smoothed()
+    s.sloss_scale = s.symm_loss_scale
+    return s
+
+
+class Renderer:
+    """
+    Renders images from settings with the models kept loaded between calls, so that one process can
+    work through many jobs without paying for a model reload each time.
+
+    The diffusion model, secondary model, LPIPS and CLIP models are loaded on first use and only
+    replaced when a later render asks for different ones. Changing the number of steps just rebuilds
+    the (cheap) diffusion schedule. CLIP models that a render doesn't use are unloaded unless
+    keep_clip_models is set. With a WeightCache, the diffusion and CLIP weights are mapped from it
+    when they've been cached before.
+
+    This covers still images: animation, gobig and sharpening stay in prd.py, and nothing is written
+    to disk apart from downloaded models and the weight cache.
+    """
+
+    def __init__(self, device, model_path='models', embedding_store=None, keep_clip_models=False,
+                 check_model_SHA=False, cpu_quantize=False, weight_cache=None):
+        self.device = torch.device(device)
+        self.model_path = model_path
+        self.embedding_store = embedding_store
+        self.keep_clip_models = keep_clip_models
+        self.check_model_SHA = check_model_SHA
+        self.cpu_quantize = cpu_quantize
+        self.weight_cache = weight_cache
+        self.fp16_mode = self.device.type == 'cuda'
+        self.diffusion_model = None
+        self.model_config = None
+        self.model = None
+        self.diffusion = None
+        self.steps = None
+        self.secondary_model = None
+        self.lpips_model = None
+        self.clip_managers = {}
+        self.last_settings = None
+
+    def _empty_cache(self):
+        gc.collect()
+        if self.device.type == 'cuda':
+            with torch.cuda.device(self.device):
+                torch.cuda.empty_cache()
+
+    def load(self, settings):
+        """
+        Make sure the models needed for the given (resolved) settings are loaded.
+        """
+        if self.diffusion_model is None or self.diffusion_model.name != settings.diffusion_model:
+            self.model = None
+            self.diffusion = None
+            self._empty_cache()
+            diffusion_model = read_diffusion_model(settings.diffusion_model, self.fp16_mode)
+            download_models(diffusion_model, self.model_path, self.check_model_SHA)
+            self.model_config = create_model_config(diffusion_model, 1000)
+            set_model_steps(self.model_config, settings.steps)
+            self.model, self.diffusion = load_diffusion_model(
+                self.model_config, f'{self.model_path}/{diffusion_model.path}', self.device, self.weight_cache
+            )
+            self.diffusion_model = diffusion_model
+            self.steps = settings.steps
+        elif self.steps != settings.steps:
+            set_model_steps(self.model_config, settings.steps)
+            self.diffusion = create_diffusion(self.model_config)
+            self.steps = settings.steps
+
+        if settings.use_secondary_model and self.secondary_model is None:
+            self.secondary_model = load_secondary_model(f'{self.model_path}/{SECONDARY_MODEL_FILE}', self.device)
+
+        if self.lpips_model is None:
+            import lpips
+            with track_model_vram(self.device, "LPIPS model"):
+                self.lpips_model = lpips.LPIPS(net='vgg', verbose=False).to(self.device)
+
+        if not self.keep_clip_models:
+            for name in [name for name in self.clip_managers if name not in settings.clip_models]:
+                del self.clip_managers[name]
+            self._empty_cache()
+        for name, multiplier in settings.clip_models.items():
+            if name not in self.clip_managers:
+                clip_manager = ClipManager(
+                    name=name,
+                    cut_count_multiplier=multiplier,
+                    device=self.device,
+                    use_cut_heatmap=True,
+                    pad_inner_cuts=True,
+                    embedding_store=self.embedding_store,
+                    quantize=self.cpu_quantize,
+                    weight_cache=self.weight_cache
+                )
+                clip_manager.load()
+                self.clip_managers[name] = clip_manager
+            self.clip_managers[name].cut_count_multiplier = multiplier
+
+    def render(self, settings):
+        """
+        Render settings['n_batches'] images and return them as a list of PIL images. settings is a dict
+        using the same keys as a settings file.
+        """
+        settings = resolve_settings(settings)
+        self.load(settings)
+        self.last_settings = settings
+        logger.info(f'Rendering {settings.n_batches} image(s) with seed {settings.seed}')
+        return [self._render_image(settings, batch_num) for batch_num in range(settings.n_batches)]
+
+    def _set_prompts(self, settings, clip_managers, step, text_prompts, image_prompts, image_prompt_store):
+        sample_prompt = _prompts_at(text_prompts, step)
+        sample_image_prompt = _prompts_at(image_prompts, step)
+        for clip_manager in clip_managers:
+            clip_manager.prompt_embeds = None
+            clip_manager.prompt_weights = None
+            if sample_prompt:
+                clip_manager.prompt_embeds, clip_manager.prompt_weights = clip_manager.embed_text_prompts(
+                    prompts=sample_prompt,
+                    step=step,
+                    fuzzy_prompt=settings.fuzzy_prompt,
+                    fuzzy_prompt_rand_mag=settings.rand_mag
+                )
+            if sample_image_prompt:
+                img_prompt_embeds, img_prompt_weights = clip_manager.embed_image_prompts(
+                    prompts=sample_image_prompt,
+                    step=step,
+                    cutn=16,
+                    cut_model=MakeCutoutsDango,
+                    side_x=settings.side_x,
+                    side_y=settings.side_y,
+                    fuzzy_prompt=settings.fuzzy_prompt,
+                    fuzzy_prompt_rand_mag=settings.rand_mag,
+                    cutout_skip_augs=settings.skip_augs,
+                    image_store=image_prompt_store,
+                    refresh_steps=settings.image_prompt_refresh_steps
+                )
+                if clip_manager.prompt_embeds is not None:
+                    clip_manager.prompt_embeds = torch.cat([img_prompt_embeds, clip_manager.prompt_embeds])
+                    clip_manager.prompt_weights = torch.cat([img_prompt_weights, clip_manager.prompt_weights])
+                else:
+                    clip_manager.prompt_embeds = img_prompt_embeds
+                    clip_manager.prompt_weights = img_prompt_weights
+            if clip_manager.prompt_embeds is None:
+                raise RuntimeError(f'No prompts for step {step}.')
+            if clip_manager.prompt_weights.sum().abs() < 1e-3:
+                raise RuntimeError('The weights must not sum to 0.')
+            clip_manager.prompt_weights /= clip_manager.prompt_weights.sum().abs()
+
+    def _brightness_contrast_fix(self, settings, image, s):
+        # Returns a corrected image when the automatic brightness/contrast fix kicks in, otherwise None
+        if not ((s % settings.adjustment_interval == 0) and (s < (settings.steps * .3)) and settings.fix_brightness_contrast):
+            return None
+        stat = ImageStat.Stat(image)
+        brightness = sum(stat.mean) / len(stat.mean)
+        contrast = sum(stat.stddev) / len(stat.stddev)
+        if settings.high_brightness_adjust and s > settings.high_brightness_start and brightness > settings.high_brightness_threshold:
+            logger.info(f"High brightness corrected at step {s}")
+            return ImageEnhance.Brightness(image).enhance(settings.high_brightness_adjust_amount)
+        if settings.low_brightness_adjust and s > settings.low_brightness_start and brightness < settings.low_brightness_threshold:
+            logger.info(f"Low brightness corrected at step {s}")
+            return ImageEnhance.Brightness(image).enhance(settings.low_brightness_adjust_amount)
+        if settings.high_contrast_adjust and s > settings.high_contrast_start and contrast > settings.high_contrast_threshold:
+            logger.info(f"High contrast corrected at step {s}")
+            return ImageEnhance.Contrast(image).enhance(settings.high_contrast_adjust_amount)
+        if settings.low_contrast_adjust and s > settings.low_contrast_start and contrast < settings.low_contrast_threshold:
+            logger.info(f"Low contrast corrected at step {s}")
+            return ImageEnhance.Contrast(image).enhance(settings.low_contrast_adjust_amount)
+        return None
+
+    def _render_image(self, settings, batch_num):
+        device = self.device
+        diffusion = self.diffusion
+        steps = settings.steps
+        skip_steps = settings.skip_steps
+        side_x, side_y = settings.side_x, settings.side_y
+        clip_managers = [self.clip_managers[name] for name in settings.clip_models]
+        # The CLIP models stay loaded between renders, but their cut heatmaps belong to one image
+        for clip_manager in clip_managers:
+            clip_manager.cut_heatmap = None
+
+        np.random.seed(settings.seed + batch_num)
+        random.seed(settings.seed + batch_num)
+        torch.manual_seed(settings.seed + batch_num)
+
+        text_prompts = _step_prompts(settings.text_prompts, batch_num)
+        image_prompts = _step_prompts(settings.image_prompts, batch_num)
+        image_prompt_store = ImagePromptStore(device, side_x, side_y)
+        self._set_prompts(settings, clip_managers, skip_steps, text_prompts, image_prompts, image_prompt_store)
+
+        init = None
+        init_img = None
+        if settings.init_image is not None:
+            init_img = Image.open(fetch(settings.init_image)).convert('RGB')
+            init_img = init_img.resize((side_x, side_y), get_resampling_mode())
+            init = TF.to_tensor(init_img).to(device).unsqueeze(0).mul(2).sub(1)
+        elif settings.perlin_init:
+            init = gen_perlin(settings.perlin_mode, side_x, side_y, device)
+
+        rmask = None
+        rmask_img = None
+        if settings.render_mask is not None:
+            rmask_img = Image.open(fetch(settings.render_mask)).convert('L')
+            rmask_img = rmask_img.resize((side_x, side_y), get_resampling_mode())
+            rmask = TF.to_tensor(rmask_img).to(device).unsqueeze(0)
+
+        guidance = Guidance(
+            diffusion,
+            self.model,
+            clip_managers,
+            settings,
+            MakeCutoutsDango,
+            self.lpips_model,
+            secondary_model=self.secondary_model if settings.use_secondary_model else None,
+            init=init,
+            rmask=rmask
+        )
+
+        if settings.sampling_mode == 'ddim':
+            sample_fn = diffusion.ddim_sample_loop_progressive
+            sample_kwargs = {'eta': settings.eta}
+        else:
+            sample_fn = diffusion.plms_sample_loop_progressive
+            sample_kwargs = {'order': 2}
+
+        self._empty_cache()
+        cur_t = diffusion.num_timesteps - skip_steps - 1
+        run_step = skip_steps
+        image = None
+        guidance.run_step = run_step
+        try:
+            while cur_t >= settings.stop_early:
+                guidance.init = init
+                samples = mixed_precision_iter(sample_fn(
+                    self.model,
+                    (1, 3, side_y, side_x),
+                    clip_denoised=settings.clip_denoised,
+                    model_kwargs={},
+                    cond_fn=guidance.cond_fn,
+                    progress=False,
+                    skip_timesteps=steps - cur_t - 1,
+                    init_image=init,
+                    randomize_class=settings.randomize_class,
+                    **sample_kwargs
+                ), device, settings.mixed_precision)
+                guidance.cur_t = cur_t
+                for sample in samples:
+                    run_step += 1
+                    cur_t -= 1
+                    if cur_t < settings.stop_early:
+                        cur_t = -1
+                    guidance.cur_t = cur_t
+                    guidance.run_step = run_step
+
+                    image = TF.to_pil_image(sample['pred_xstart'][0].add(1).div(2).clamp(0, 1))
+                    if cur_t == -1:
+                        break
+                    self._set_prompts(settings, clip_managers, steps - cur_t - 1, text_prompts, image_prompts, image_prompt_store)
+                    corrected = self._brightness_contrast_fix(settings, image, steps - cur_t)
+                    if corrected is not None:
+                        init = TF.to_tensor(corrected).to(device).unsqueeze(0).mul(2).sub(1)
+                        break
+        finally:
+            guidance.close()
+
+        if rmask_img is not None and init_img is not None:
+            image = image.convert('RGBA')
+            image.putalpha(rmask_img)
+            image = Image.alpha_composite(init_img.convert('RGBA'), image)
+        return image
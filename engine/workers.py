@@ -0,0 +1,140 @@
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import time
+import traceback
+
+logger = logging.getLogger(__name__)
+
+
+def parse_workers(workers, cpu_threads=None):
+    """
+    Turn a worker list like "0,1" or "cpu,cpu" into one spec per worker. Numbers are CUDA device
+    ids; "cpu" workers split the available cores between them unless cpu_threads is given.
+    """
+    names = [name.strip() for name in str(workers).split(',') if name.strip()]
+    cpu_count = sum(1 for name in names if name == 'cpu')
+    if cpu_threads is None and cpu_count:
+        cpu_threads = max(1, (os.cpu_count() or 1) // cpu_count)
+    specs = []
+    for name in names:
+        if name == 'cpu':
+            specs.append({'device': 'cpu', 'threads': cpu_threads})
+        else:
+            specs.append({'device': f'cuda:{int(name)}', 'threads': None})
+    return specs
+
+
+def prd_device_args(spec):
+    """
+    The prd.py arguments that run a render on spec's device. CPU workers always pass a thread
+    count, as prd.py reads a bare -c (or -c 0) as not asking for the CPU.
+    """
+    if spec['device'] == 'cpu':
+        return f"-c {spec['threads'] or os.cpu_count() or 1}"
+    return f"--cuda {spec['device'].split(':')[1]}"
+
+
+def model_set_key(setting):
+    # Points that share a model set can be rendered back to back without loading anything
+    from model_managers.clip_manager import CLIP_NAME_MAP
+    clip_models = tuple(name for name in CLIP_NAME_MAP.keys() if setting.get(name))
+    return (str(setting.get('diffusion_model')), bool(setting.get('use_secondary_model')), clip_models)
+
+
+def render_point(renderer, index, setting, output, run_id):
+    """
+    Render one point and save its images and settings. Returns the manifest entry for it.
+    """
+    start = time.perf_counter()
+    batch_name = setting.get('batch_name', 'Default')
+    batch_folder = f'{output}/{batch_name}'
+    os.makedirs(batch_folder, exist_ok=True)
+    prefix = f'{batch_folder}/{batch_name}(explorer-{run_id})_{index:04}'
+    entry = {'index': index, 'device': str(renderer.device), 'settings': setting}
+    try:
+        images = renderer.render(setting)
+    except Exception as e:
+        logger.error(f'Point {index} failed: {e}')
+        entry.update({'status': 'failed', 'error': traceback.format_exc()})
+        return entry
+    files = []
+    for j, image in enumerate(images):
+        image.save(f'{prefix}_{j}.png')
+        files.append(f'{prefix}_{j}.png')
+    with open(f'{prefix}_settings.json', 'w', encoding='utf-8') as f:
+        json.dump(dict(setting, set_seed=renderer.last_settings.seed), f, ensure_ascii=False, indent=4)
+    entry.update({
+        'status': 'done',
+        'seed': renderer.last_settings.seed,
+        'images': files,
+        'seconds': round(time.perf_counter() - start, 2),
+    })
+    return entry
+
+
+def _make_renderer(spec):
+    import torch
+    from engine.renderer import Renderer
+
+    if spec['threads']:
+        torch.set_num_threads(spec['threads'])
+    return Renderer(spec['device'])
+
+
+def render_worker(spec, task_queue, result_queue, output, run_id):
+    """
+    Worker process body: keeps one Renderer for its device and renders points from task_queue until
+    it gets None.
+    """
+    renderer = _make_renderer(spec)
+    while True:
+        task = task_queue.get()
+        if task is None:
+            break
+        index, setting = task
+        result_queue.put(render_point(renderer, index, setting, output, run_id))
+
+
+def run_points(settings, specs, output, run_id):
+    """
+    Render every settings dict, spread over one worker per spec, and return the manifest entries in
+    point order. Points are queued grouped by model set so each worker only swaps models when the
+    set changes. A single worker renders in this process.
+    """
+    order = sorted(range(len(settings)), key=lambda i: model_set_key(settings[i]))
+    if len(specs) == 1:
+        renderer = _make_renderer(specs[0])
+        manifest = [render_point(renderer, i, settings[i], output, run_id) for i in order]
+        return sorted(manifest, key=lambda entry: entry['index'])
+
+    # CUDA can't be used from forked processes
+    ctx = multiprocessing.get_context('spawn')
+    task_queue = ctx.Queue()
+    result_queue = ctx.Queue()
+    for i in order:
+        task_queue.put((i, settings[i]))
+    for _ in specs:
+        task_queue.put(None)
+    workers = [
+        ctx.Process(target=render_worker, args=(spec, task_queue, result_queue, output, run_id))
+        for spec in specs
+    ]
+    for worker in workers:
+        worker.start()
+    manifest = []
+    while len(manifest) < len(settings):
+        if not any(worker.is_alive() for worker in workers) and result_queue.empty():
+            logger.error('All workers stopped before finishing the queue.')
+            break
+        try:
+            manifest.append(result_queue.get(timeout=1))
+        except queue.Empty:
+            continue
+        entry = manifest[-1]
+        print(f"Point {entry['index']} {entry['status']} on {entry['device']} ({len(manifest)} of {len(settings)})")
+    for worker in workers:
+        worker.join()
+    return sorted(manifest, key=lambda entry: entry['index'])
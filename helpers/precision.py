@@ -0,0 +1,44 @@
+from contextlib import nullcontext
+
+import torch
+
+
+def autocast_dtype(device):
+    # CPUs run reduced precision fastest (and safest) in bfloat16, GPUs in float16
+    return torch.float16 if torch.device(device).type == 'cuda' else torch.bfloat16
+
+
+def mixed_precision(device, enabled=True):
+    """
+    A context that runs the forwards inside it under autocast in autocast_dtype(device), or does
+    nothing if not enabled. Their backwards run in the same precision. Tensors made outside, like
+    x_in and its gradient, keep their own dtype. Autocast is per thread, so worker threads need to
+    enter it themselves.
+    """
+    if not enabled:
+        return nullcontext()
+    device = torch.device(device)
+    return torch.autocast(device.type, dtype=autocast_dtype(device))
+
+
+def full_precision(device):
+    """
+    A context that turns autocast back off inside mixed_precision, for work that has to stay in
+    float32 like making cuts. mixed_precision can be entered again inside it.
+    """
+    return torch.autocast(torch.device(device).type, enabled=False)
+
+
+def mixed_precision_iter(iterable, device, enabled=True):
+    """
+    Iterate under mixed_precision, but only while the next item is made, so a sampling loop's
+    steps run in reduced precision and the code handling each sample doesn't.
+    """
+    iterator = iter(iterable)
+    while True:
+        with mixed_precision(device, enabled):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
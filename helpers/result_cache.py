@@ -0,0 +1,155 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+from helpers.vram_helpers import format_bytes
+
+logger = logging.getLogger(__name__)
+
+EVICTION_POLICIES = ('lru', 'fifo')
+
+# Settings that don't change the finished image, so they're left out of the fingerprint
+IGNORED_SETTINGS = ('batch_name', 'display_rate')
+
+
+def file_digest(path):
+    """
+    sha256 of a local file, or None if path isn't one (e.g. a URL).
+    """
+    if not path or not os.path.isfile(str(path)):
+        return None
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def prompt_file_digests(prompts):
+    """
+    Digests of any local image files named in a (possibly nested) image prompt setting. Prompts can
+    carry a weight after a colon, as in "image.png:2".
+    """
+    if isinstance(prompts, dict):
+        prompts = list(prompts.values())
+    digests = []
+    for prompt in prompts or []:
+        if isinstance(prompt, (dict, list)):
+            digests.extend(prompt_file_digests(prompt))
+        elif isinstance(prompt, str):
+            digest = file_digest(prompt) or file_digest(prompt.rsplit(':', 1)[0])
+            if digest:
+                digests.append(digest)
+    return digests
+
+
+class ResultCache:
+    """
+    Keeps copies of finished renders, indexed by a fingerprint of everything that determines the
+    output: the resolved settings, the checksums of the models used, the seed and the options the
+    run was done with (device, precision and so on). Only runs with a fixed seed are deterministic
+    enough to cache.
+
+    Images are copied into root/<fingerprint>/ and tracked in root/index.json. Once the cache grows
+    past max_bytes, entries are evicted until it fits again, either least recently used first
+    ('lru') or oldest first ('fifo').
+    """
+
+    def __init__(self, root, max_bytes=2 * 1024 ** 3, policy='lru'):
+        if policy not in EVICTION_POLICIES:
+            raise ValueError(f'Unknown eviction policy {policy}, use one of {EVICTION_POLICIES}')
+        self.root = root
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.index_path = os.path.join(root, 'index.json')
+        os.makedirs(self.root, exist_ok=True)
+        self.index = self._read_index()
+
+    @staticmethod
+    def fingerprint(settings, model_checksums, seed, run_options=None):
+        settings = {k: v for k, v in settings.items() if k not in IGNORED_SETTINGS}
+        content = json.dumps(
+            {'settings': settings, 'models': model_checksums, 'seed': seed, 'run': run_options},
+            sort_keys=True,
+            default=str
+        )
+        return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+    def _read_index(self):
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _write_index(self):
+        # Same write-then-rename as the embedding store, so a crash never leaves a broken index
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(self.index, f, indent=4)
+            os.replace(tmp_path, self.index_path)
+        except OSError as e:
+            logger.warning(f"Unable to write result cache index {self.index_path}: {e}")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    @property
+    def total_bytes(self):
+        return sum(entry['bytes'] for entry in self.index.values())
+
+    def get(self, key):
+        """
+        Return the cached image paths for key, or None on a miss.
+        """
+        entry = self.index.get(key)
+        if entry is None:
+            return None
+        files = [os.path.join(self.root, key, name) for name in entry['files']]
+        if not all(os.path.exists(f) for f in files):
+            logger.debug(f"Result cache entry {key} is missing files, dropping it")
+            self._remove(key)
+            self._write_index()
+            return None
+        entry['last_used'] = time.time()
+        self._write_index()
+        return files
+
+    def put(self, key, image_paths):
+        image_paths = [p for p in image_paths if os.path.exists(p)]
+        if not image_paths:
+            return
+        entry_dir = os.path.join(self.root, key)
+        os.makedirs(entry_dir, exist_ok=True)
+        files = []
+        size = 0
+        for i, path in enumerate(image_paths):
+            name = f'{i:04}{os.path.splitext(path)[1]}'
+            shutil.copyfile(path, os.path.join(entry_dir, name))
+            files.append(name)
+            size += os.path.getsize(path)
+        now = time.time()
+        self.index[key] = {'files': files, 'bytes': size, 'created': now, 'last_used': now}
+        if self.total_bytes > self.max_bytes:
+            self.evict()
+        self._write_index()
+
+    def _remove(self, key):
+        shutil.rmtree(os.path.join(self.root, key), ignore_errors=True)
+        self.index.pop(key, None)
+
+    def evict(self):
+        order = 'last_used' if self.policy == 'lru' else 'created'
+        total = self.total_bytes
+        evicted = 0
+        for key in sorted(self.index, key=lambda k: self.index[k][order]):
+            if total <= self.max_bytes:
+                break
+            total -= self.index[key]['bytes']
+            self._remove(key)
+            evicted += 1
+        logger.debug(f"Evicted {evicted} results, cache now holds {format_bytes(total)}")
@@ -0,0 +1,193 @@
+# Helpers for building and adjusting the 1000-entry schedules used for settings like
+# cut_overview, cut_innercut, clip_guidance_scale and clamp_max.
+
+import ast
+import re
+
+import numpy as np
+
+SCHEDULE_LENGTH = 1000
+
+# One "[value]*count" term of a schedule string like "[12]*400+[4]*600"
+_TERM = re.compile(r'^\[\s*([^\[\]]+?)\s*\]\s*\*\s*(\d+)$')
+
+
+def _parse_number(text):
+    value = ast.literal_eval(text)
+    if type(value) not in (int, float, bool):
+        raise ValueError(f'{text!r} is not a number')
+    return value
+
+
+class Schedule:
+    """
+    A per-step setting, stored as a NumPy array with one entry for each of the 1000 diffusion
+    timesteps. Index it the same way as the old lists, with schedule[1000 - t_int]; values come back
+    as plain Python ints or floats.
+
+    Schedules are built with Schedule.parse from a number, a string like "[12]*400+[4]*600", a dict
+    like {"start": 1, "end": 10} for a linear ramp, or a list of values.
+    """
+
+    def __init__(self, values, spec=None):
+        values = np.asarray(values)
+        if values.ndim != 1 or len(values) < SCHEDULE_LENGTH:
+            raise ValueError(f'A schedule needs {SCHEDULE_LENGTH} values, got {values.size}')
+        if values.dtype == bool:
+            values = values.astype(np.int64)
+        self.values = values[:SCHEDULE_LENGTH]
+        self.spec = spec
+
+    @classmethod
+    def constant(cls, value):
+        return cls(np.full(SCHEDULE_LENGTH, value), spec=f'[{value}]*{SCHEDULE_LENGTH}')
+
+    @classmethod
+    def interpolated(cls, start, end):
+        # The first step uses start, then values run linearly from start at step 1 to end at step 999
+        values = np.empty(SCHEDULE_LENGTH, dtype=np.float64)
+        values[0] = start
+        values[1:] = start + np.arange(SCHEDULE_LENGTH - 1) * ((end - start) / (SCHEDULE_LENGTH - 1))
+        if type(start) == int:
+            values = np.trunc(values).astype(np.int64)
+        return cls(values, spec={'start': start, 'end': end})
+
+    @classmethod
+    def piecewise(cls, segments):
+        """
+        Build a schedule from (value, count) pairs, e.g. [(12, 400), (4, 600)].
+        """
+        values = np.array([value for value, _ in segments])
+        counts = [count for _, count in segments]
+        return cls(np.repeat(values, counts), spec='+'.join(f'[{value}]*{count}' for value, count in segments))
+
+    @classmethod
+    def parse(cls, value, final=None):
+        if isinstance(value, Schedule):
+            return value
+        if isinstance(value, dict):
+            return cls.interpolated(value['start'], value['end'])
+        if isinstance(value, str):
+            segments = []
+            for term in value.split('+'):
+                match = _TERM.match(term.strip())
+                if match is None:
+                    raise ValueError(f'Unable to parse schedule {value!r}. Use the form "[12]*400+[4]*600".')
+                segments.append((_parse_number(match.group(1)), int(match.group(2))))
+            return cls.piecewise(segments)
+        if isinstance(value, (list, tuple, np.ndarray)):
+            return cls(value)
+        if final is not None:
+            return cls.interpolated(value, final)
+        return cls.constant(value)
+
+    def smoothed(self):
+        """
+        Return a copy with each change in value ramped linearly over 5% of the schedule (50 steps)
+        instead of jumping.
+        """
+        values = self.values.copy()
+        zone = int(len(values) * .05)
+        markers = np.flatnonzero(np.diff(self.values)) + 1
+        lastindex = 0
+        for index in markers:
+            if (index - lastindex) >= (zone / 2):  # only smooth if the indexes are far enough apart
+                start = max(int(index - (zone / 2)), 1)
+                end = min(int(index + (zone / 2)), len(values) - 1)
+                ramp = values[start] + (np.arange(start, end) - start) * ((values[end] - values[start]) / (end - start))
+                if values.dtype.kind == 'i':
+                    ramp = np.trunc(ramp)
+                values[start:end] = ramp
+            lastindex = index
+        return Schedule(values)
+
+    def max(self):
+        return self.values.max().item()
+
+    def to_json(self):
+        """
+        A compact form of the schedule that Schedule.parse can read back, for saving to settings files.
+        """
+        if self.spec is not None:
+            return self.spec
+        change = np.flatnonzero(np.diff(self.values)) + 1
+        starts = np.concatenate(([0], change))
+        counts = np.diff(np.concatenate((starts, [len(self.values)])))
+        return '+'.join(f'[{self.values[i].item()}]*{count}' for i, count in zip(starts, counts))
+
+    def __getitem__(self, index):
+        return self.values[index].item()
+
+    def __len__(self):
+        return len(self.values)
+
+    def __iter__(self):
+        return iter(self.values.tolist())
+
+    def __eq__(self, other):
+        if not isinstance(other, Schedule):
+            return NotImplemented
+        return np.array_equal(self.values, other.values)
+
+    def __str__(self):
+        spec = self.to_json()
+        if isinstance(spec, dict):
+            return f"{spec['start']} to {spec['end']}"
+        return spec
+
+    def __repr__(self):
+        return f'Schedule({self})'
+
+
+def auto_eta(steps):
+    # Automatic Eta based on steps
+    maxetasteps = 315
+    minetasteps = 50
+    maxeta = 1.0
+    mineta = 0.0
+    if steps > maxetasteps:
+        return maxeta
+    elif steps < minetasteps:
+        return mineta
+    stepsrange = (maxetasteps - minetasteps)
+    newrange = (maxeta - mineta)
+    eta = (((steps - minetasteps) * newrange) / stepsrange) + mineta
+    return round(eta, 2)
+
+
+def auto_clamp_max(steps, use_secondary_model=True):
+    # Automatic clamp_max based on steps
+    if steps <= 35:
+        clamp_max = 0.001
+    elif steps <= 75:
+        clamp_max = 0.0125
+    elif steps <= 150:
+        clamp_max = 0.02
+    elif steps <= 225:
+        clamp_max = 0.035
+    elif steps <= 300:
+        clamp_max = 0.05
+    elif steps <= 500:
+        clamp_max = 0.075
+    else:
+        clamp_max = 0.1
+    if use_secondary_model == False:
+        clamp_max = clamp_max * 2
+    return clamp_max
+
+
+def auto_clip_guidance_scale(width, height):
+    # Automatic clip_guidance_scale based on overall resolution
+    res = width * height  # total pixels
+    maxcgsres = 2000000
+    mincgsres = 250000
+    maxcgs = 50000
+    mincgs = 2500
+    if res > maxcgsres:
+        return maxcgs
+    elif res < mincgsres:
+        return mincgs
+    resrange = (maxcgsres - mincgsres)
+    newrange = (maxcgs - mincgs)
+    clip_guidance_scale = (((res - mincgsres) * newrange) / resrange) + mincgs
+    return round(clip_guidance_scale)
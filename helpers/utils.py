@@ -13,3 +13,15 @@ def fetch(url_or_path):
         fd.seek(0)
         return fd
     return open(url_or_path, 'rb')
+
+
+def get_resampling_mode():
+    try:
+        from PIL import __version__, Image
+        major_ver = int(__version__.split('.')[0])
+        if major_ver >= 9:
+            return Image.Resampling.LANCZOS
+        else:
+            return Image.LANCZOS
+    except Exception as ex:
+        return 1  # 'Lanczos' irrespective of version.
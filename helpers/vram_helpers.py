@@ -3,7 +3,7 @@ from dataclasses import dataclass
 from contextlib import contextmanager
 from typing import Union, List, Tuple
 
-import torch
+from helpers.schedules import Schedule
 
 logger = logging.getLogger(__name__)
 
@@ -17,10 +17,14 @@ LOADED_MODEL_TOTAL_SIZE = 0
 
 LPIPS_LOAD_SIZE = 59259904
 
+# torch is only imported by the functions that measure memory, so the estimates can be made without it
+# (prd.py --estimate)
+
 
 @contextmanager
 def track_model_vram(device, message=''):
     global LOADED_MODEL_TOTAL_SIZE
+    import torch
     initial_memory = torch.cuda.memory_allocated(device)
     try:
         yield
@@ -57,6 +61,7 @@ def track_max_vram_allocated(device, message=''):
     variable.
     """
     global CUDA_MAX_ALLOCATED
+    import torch
     CUDA_MAX_ALLOCATED = max((CUDA_MAX_ALLOCATED, torch.cuda.max_memory_allocated(device)))
     torch.cuda.reset_peak_memory_stats(device)
     initial_memory = torch.cuda.memory_allocated(device)
@@ -73,11 +78,13 @@ def track_max_vram_allocated(device, message=''):
 
 
 def log_vram(device, message=''):
+    import torch
     current_vram = torch.cuda.memory_allocated(device)
     logger.debug(f"{message}: current {format_bytes(current_vram)}")
 
 
 def log_max_allocated(device):
+    import torch
     max_vram = max((CUDA_MAX_ALLOCATED, torch.cuda.max_memory_allocated(device)))
     logger.debug(f"Global max: {format_bytes(max_vram)}")
 
@@ -122,9 +129,49 @@ class ClipModelProfile:
     name: str
     load_size: int = 0
     cut_coef: Tuple[Union[float, int], ...] = (0,)
+    # The share of the per cut memory left with the image encoder's blocks checkpointed
+    checkpointed_cut_fraction: float = 1.0
+
+    def estimate_peak(self, cuts, checkpointing=False):
+        scale = self.checkpointed_cut_fraction if checkpointing else 1.0
+        return int(self.cut_coef[0] + sum(coef * scale * cuts ** i for i, coef in enumerate(self.cut_coef) if i))
+
+def max_cuts_within(profile, budget, limit, checkpointing=False):
+    """
+    The most cuts, from 1 up to limit, that profile estimates fit in budget bytes. None if the
+    profile has no per cut data to go on.
+    """
+    if not any(coef > 0 for coef in profile.cut_coef[1:]):
+        return None
+    low, high = 1, limit
+    while low < high:
+        middle = (low + high + 1) // 2
+        if profile.estimate_peak(middle, checkpointing) <= budget:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+
+def available_memory(device):
+    """
+    Bytes that can still be allocated on device: free CUDA memory plus what PyTorch has cached but
+    isn't using, or the available RAM on CPU. None if it can't be told.
+    """
+    import torch
+    device = torch.device(device)
+    if device.type == 'cuda':
+        free, _ = torch.cuda.mem_get_info(device)
+        return free + torch.cuda.memory_reserved(device) - torch.cuda.memory_allocated(device)
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
 
-    def estimate_peak(self, cuts):
-        return int(sum(coef * cuts ** i for i, coef in enumerate(self.cut_coef)))
 
 @dataclass
 class DiffusionModelProfile:
@@ -179,58 +226,72 @@ unknown_clip_profile = ClipModelProfile(
     cut_coef=(1,)
 )
 
+# checkpointed_cut_fraction is an estimate, not profiled on the real models. With checkpointing each
+# block keeps its input instead of its activations, and one block at a time has its activations
+# back during the backward, so the fraction is about 1 / ratio + 1 / blocks. The ratio of a block's
+# activations to its input was measured with saved tensor hooks on blocks shaped like CLIP's, on
+# CPU: about 4 for a ResNet bottleneck and 18 to 30 for a ViT block.
 RN101 = ClipModelProfile(
     name='RN101',
     load_size=294541824,
-    cut_coef=(94069930, 86131029)
+    cut_coef=(94069930, 86131029),
+    checkpointed_cut_fraction=0.28
 )
 
 RN50 = ClipModelProfile(
     name='RN50',
     load_size=256350208,
-    cut_coef=(72989184, 65367040)
+    cut_coef=(72989184, 65367040),
+    checkpointed_cut_fraction=0.31
 )
 
 RN50x16 = ClipModelProfile(
     name='RN50x16',
     load_size=679183360,
-    cut_coef=(463826432, 449804288)
+    cut_coef=(463826432, 449804288),
+    checkpointed_cut_fraction=0.28
 )
 
 RN50x4 = ClipModelProfile(
     name='RN50x4',
     load_size=425698304,
-    cut_coef=(166758058, 164629845)
+    cut_coef=(166758058, 164629845),
+    checkpointed_cut_fraction=0.29
 )
 
 RN50x64 = ClipModelProfile(
     name='RN50x64',
     load_size=1369234944,
-    cut_coef=(984844117, 1037487787)
+    cut_coef=(984844117, 1037487787),
+    checkpointed_cut_fraction=0.27
 )
 
 ViTB16 = ClipModelProfile(
     name='ViTB16',
     load_size=357165568,
-    cut_coef=(102521685, 92044458)
+    cut_coef=(102521685, 92044458),
+    checkpointed_cut_fraction=0.14
 )
 
 ViTB32 = ClipModelProfile(
     name='ViTB32',
     load_size=361563648,
-    cut_coef=(35860309, 31099562)
+    cut_coef=(35860309, 31099562),
+    checkpointed_cut_fraction=0.12
 )
 
 ViTL14 = ClipModelProfile(
     name='ViTL14',
     load_size=942509568,
-    cut_coef=(0, 0)
+    cut_coef=(0, 0),
+    checkpointed_cut_fraction=0.1
 )
 
 ViTL14_336 = ClipModelProfile(
     name='ViTL14_336',
     load_size=944606720,
-    cut_coef=(0, 0)
+    cut_coef=(0, 0),
+    checkpointed_cut_fraction=0.1
 )
 
 CLIP_PROFILES = {
@@ -253,7 +314,7 @@ def estimate_vram_requirements(
         clip_model_names,
         diffusion_model_name,
         use_secondary,
-        device
+        clip_checkpointing=False
 ):
     """
     Estimate peak VRAM requirement, which is calculated as follows:
@@ -266,8 +327,11 @@ def estimate_vram_requirements(
       * size of diffusion model initialization as a function of pixel count
       * size of prompt text embeddings (currently on the order of a few MiB and not included in estimates)
     Plus the maximum of the following:
-      * maximum of CLIP model step allocations, which are a function of cuts
+      * maximum of CLIP model step allocations, which are a function of cuts, and much smaller with
+        clip_checkpointing
       * diffusion model loss step as a function of pixel count
+
+    Returns the estimated peak in bytes.
     """
     if use_secondary:
         diffusion_model_name += '_with_secondary'
@@ -278,7 +342,7 @@ def estimate_vram_requirements(
         )
         diffusion_profile = unknown_diffusion_profile
 
-    max_cuts = max(sum(x) for x in zip(eval(cut_innercut), eval(cut_overview)))
+    max_cuts = (Schedule.parse(cut_innercut).values + Schedule.parse(cut_overview).values).max().item()
 
     static_sizes = {}
     for model_name in clip_model_names:
@@ -305,13 +369,15 @@ def estimate_vram_requirements(
     logger.debug('')
 
     dynamic_sizes = {
-        model_name: CLIP_PROFILES.get(model_name, unknown_clip_profile).estimate_peak(max_cuts)
+        model_name: CLIP_PROFILES.get(model_name, unknown_clip_profile).estimate_peak(max_cuts, clip_checkpointing)
         for model_name in clip_model_names
     }
     estimated_loss_vram = DIFFUSION_PROFILES.get(diffusion_model_name, unknown_diffusion_profile).estimate_loss_bytes(side_x * side_y)
     dynamic_sizes[diffusion_model_name + ' loss calculations'] = estimated_loss_vram
 
     logger.debug("\tDYNAMIC ALLOCATION ESTIMATES (Released after use during each step)")
+    if clip_checkpointing:
+        logger.debug("\t(CLIP blocks checkpointed, which costs roughly a third more CLIP time per step)")
     for k, v in dynamic_sizes.items():
         logger.debug(
             f"\t{format_bytes(v)}\t{k}"
@@ -323,3 +389,4 @@ def estimate_vram_requirements(
     logger.debug('')
     logger.debug("\tESTIMATED PEAK ALLOCATION (static total + dynamic max):")
     logger.debug(f"\t{format_bytes(static_sum + dynamic_max)}")
+    return static_sum + dynamic_max
@@ -0,0 +1,51 @@
+import torch
+from torch import nn
+from torch.utils.checkpoint import checkpoint
+
+# The containers CLIP image encoders keep their repeated blocks in: transformer.resblocks in the
+# ViTs, layer1 to layer4 in the ResNets, under the same names in OpenAI CLIP and OpenCLIP
+BLOCK_CONTAINER_NAMES = ('resblocks', 'layer1', 'layer2', 'layer3', 'layer4')
+
+
+class CheckpointedBlock(nn.Module):
+    """
+    Wraps one block of an encoder so that, while enabled, its forward keeps only its input for the
+    backward and runs again to get the rest. Only applies when a gradient is being taken through
+    the block, so text encoding and no_grad prompt embedding run as before.
+    """
+
+    def __init__(self, block):
+        super().__init__()
+        self.block = block
+        self.enabled = True
+
+    def forward(self, *args, **kwargs):
+        if self.enabled and torch.is_grad_enabled() and any(
+            isinstance(arg, torch.Tensor) and arg.requires_grad for arg in args
+        ):
+            # The non-reentrant version works with torch.autograd.grad, which guidance uses
+            return checkpoint(self.block, *args, use_reentrant=False, **kwargs)
+        return self.block(*args, **kwargs)
+
+
+def set_block_checkpointing(encoder, enabled):
+    """
+    Turn activation checkpointing of encoder's blocks on or off, wrapping them in CheckpointedBlock
+    in place the first time. Returns the number of blocks checkpointed.
+    """
+    count = 0
+    for name, container in list(encoder.named_modules()):
+        if name.split('.')[-1] not in BLOCK_CONTAINER_NAMES:
+            continue
+        if not isinstance(container, (nn.Sequential, nn.ModuleList)):
+            continue
+        for index, block in enumerate(container):
+            if isinstance(block, CheckpointedBlock):
+                block.enabled = enabled
+            elif enabled:
+                container[index] = block = CheckpointedBlock(block)
+            else:
+                continue
+            if enabled:
+                count += 1
+    return count
@@ -1,5 +1,9 @@
+import hashlib
+import io
 import logging
 import os
+import time
+from collections import OrderedDict
 
 import numexpr
 import torch
@@ -10,9 +14,11 @@ from torchvision import transforms
 from torchvision.transforms import functional as transforms_functional
 from torch.nn import functional as F
 
-from helpers.vram_helpers import track_model_vram
-from cut_modules.make_cutouts import CutHeatmap, save_cut_image, save_inner_cut_bounds_image
+from helpers.vram_helpers import CLIP_PROFILES, max_cuts_within, track_model_vram, unknown_clip_profile
+from cut_modules.make_cutouts import CutBuffer, CutContext, CutHeatmap, save_cut_image, save_inner_cut_bounds_image
 from helpers.utils import fetch
+from model_managers.checkpointing import set_block_checkpointing
+from model_managers.quantization import quantize_linear_layers
 
 logger = logging.getLogger(__name__)
 
@@ -43,8 +49,18 @@ CLIP_NAME_MAP = {
 
 # These must be norms collected from image rgb channel values?
 # What dataset?
-clip_img_normalize = transforms.Normalize(mean=[0.48145466, 0.4578275, 0.40821073],
-                                          std=[0.26862954, 0.26130258, 0.27577711])
+CLIP_IMG_MEAN = [0.48145466, 0.4578275, 0.40821073]
+CLIP_IMG_STD = [0.26862954, 0.26130258, 0.27577711]
+clip_img_normalize = transforms.Normalize(mean=CLIP_IMG_MEAN, std=CLIP_IMG_STD)
+
+
+def clip_img_normalize_(cutouts):
+    """
+    clip_img_normalize in place, as one multiply and add on the cuts without a copy.
+    """
+    std = torch.tensor(CLIP_IMG_STD, device=cutouts.device, dtype=cutouts.dtype).view(1, 3, 1, 1)
+    mean = torch.tensor(CLIP_IMG_MEAN, device=cutouts.device, dtype=cutouts.dtype).view(1, 3, 1, 1)
+    return cutouts.mul_(1 / std).add_(-mean / std)
 
 
 def spherical_dist_loss(x, y):
@@ -53,6 +69,59 @@ def spherical_dist_loss(x, y):
     return (x - y).norm(dim=-1).div(2).arcsin().pow(2).mul(2)
 
 
+class ImagePromptStore:
+    """
+    Per-run store for image prompts. Each image is fetched, decoded and resized once and kept on the
+    render device, and the cutout embeddings for it are kept per CLIP model so they don't have to be
+    re-encoded on every step. With refresh_steps set, embeddings are re-encoded with fresh cutouts
+    once they are that many steps old.
+    """
+
+    def __init__(self, device, side_x, side_y):
+        self.device = device
+        self.side_x = side_x
+        self.side_y = side_y
+        self.images = {}
+        self.digests = {}
+        self.embeds = {}
+
+    def get_image(self, path):
+        if path not in self.images:
+            with fetch(path) as f:
+                data = f.read()
+            self.digests[path] = hashlib.sha256(data).hexdigest()
+            img = Image.open(io.BytesIO(data)).convert('RGB')
+            img = transforms_functional.resize(
+                img,
+                min(self.side_x, self.side_y, *img.size),
+                transforms.InterpolationMode.LANCZOS
+            )
+            self.images[path] = transforms_functional.to_tensor(img).to(self.device).unsqueeze(0).mul(2).sub(1)
+        return self.images[path]
+
+    def get_digest(self, path):
+        """
+        Identify an image prompt by its decoded content and the size it is resized against.
+        """
+        self.get_image(path)
+        return f'{self.digests[path]}:{self.side_x}x{self.side_y}'
+
+    def has_embed(self, model_name, path, cutn):
+        return (model_name, path, cutn) in self.embeds
+
+    def get_embed(self, model_name, path, cutn, step, refresh_steps=0):
+        cached = self.embeds.get((model_name, path, cutn))
+        if cached is None:
+            return None
+        embed_step, embed = cached
+        if refresh_steps and abs(step - embed_step) >= refresh_steps:
+            return None
+        return embed
+
+    def put_embed(self, model_name, path, cutn, step, embed):
+        self.embeds[(model_name, path, cutn)] = (step, embed)
+
+
 class ClipManager:
 
     def __init__(
@@ -61,8 +130,13 @@ class ClipManager:
             cut_count_multiplier: int,
             device,
             use_cut_heatmap=False,
+            cut_heatmap_resolution=0.25,
             pad_inner_cuts=False,
-            cutout_debug_image_dir='cutout_debug_images'
+            cutout_debug_image_dir='cutout_debug_images',
+            text_embed_cache_size=64,
+            embedding_store=None,
+            quantize=False,
+            weight_cache=None
     ):
         self.name = name
         self.model = None
@@ -71,9 +145,24 @@ class ClipManager:
         self.prompt_embeds = None
         self.device = device
         self.cut_heatmap = None
+        # Cut batches are written into the same storage every step
+        self.cut_buffer = CutBuffer()
         self.use_cut_heatmap = use_cut_heatmap
+        # The heatmap is blurred every step, so it's kept smaller than the image it covers. It stays on
+        # CPU, where the cut planner's thread can use it without waiting on queued GPU work.
+        self.cut_heatmap_resolution = cut_heatmap_resolution
         self.pad_inner_cuts = pad_inner_cuts
         self.cutout_debug_image_dir=cutout_debug_image_dir
+        # Prompts rarely change between steps, so keep their encodings around rather than
+        # running the text transformer again on every call to embed_text_prompts.
+        self.text_embed_cache = OrderedDict()
+        self.text_embed_cache_size = text_embed_cache_size
+        self.embedding_store = embedding_store
+        self.checkpoint = None
+        # Run the linear layers in int8 when rendering on CPU
+        self.quantize = quantize
+        self.activation_checkpointing = False
+        self.weight_cache = weight_cache
 
     @staticmethod
     def parse_prompt(prompt, vars={}):
@@ -85,7 +174,61 @@ class ClipManager:
         vals = vals + ['', '1'][len(vals):]
         return vals[0], float(numexpr.evaluate(vals[1].strip(), local_dict=vars))
 
+    def checkpoint_id(self):
+        """
+        Identify the weights this model was loaded from, so stored embeddings are never reused
+        across checkpoints. OpenAI CLIP download URLs contain the checkpoint's SHA256.
+        """
+        if type(CLIP_NAME_MAP[self.name]) == str:
+            url = clip.clip._MODELS[CLIP_NAME_MAP[self.name]]
+            return url.split('/')[-2]
+        model_name, pretrained = CLIP_NAME_MAP[self.name]
+        try:
+            source = open_clip.pretrained.get_pretrained_url(model_name, pretrained)
+        except Exception:
+            source = f'{model_name}:{pretrained}'
+        return hashlib.sha256(str(source).encode('utf-8')).hexdigest()
+
     def load(self):
+        self.clear_text_embed_cache()
+        if self.embedding_store is not None:
+            self.checkpoint = self.checkpoint_id()
+        self.model = None
+        if self.weight_cache is not None:
+            source = self.checkpoint_id()
+            with track_model_vram(self.device, f"Mapping {self.name}"):
+                self.model = self.load_cached(source)
+        if self.model is None:
+            self.load_checkpoint()
+            if self.weight_cache is not None:
+                self.weight_cache.save(self.model, self.name, source, device=torch.device(self.device).type)
+
+        if self.quantize and torch.device(self.device).type == 'cpu':
+            self.quantize_model()
+            # int8 embeddings are close to the float ones but not the same, so store them apart
+            if self.checkpoint is not None:
+                self.checkpoint += ':int8'
+
+    def load_cached(self, source):
+        """
+        Build the model from the weight cache, with its weights mapped rather than loaded. None if
+        it isn't cached.
+        """
+        device_type = torch.device(self.device).type
+        state_dict = self.weight_cache.state_dict(self.name, source, device=device_type)
+        if state_dict is None:
+            return None
+        print(f'--{self.name} (cached)')
+        if type(CLIP_NAME_MAP[self.name]) == str:
+            # build_model works out the architecture from the names and shapes of the weights
+            model = clip.model.build_model(dict(state_dict))
+        else:
+            model = open_clip.create_model(CLIP_NAME_MAP[self.name][0])
+        if not self.weight_cache.load(model, self.name, source, state_dict=state_dict, device=device_type):
+            return None
+        return model.eval().to(self.device)
+
+    def load_checkpoint(self):
         if type(CLIP_NAME_MAP[self.name]) == str: #OpenAI CLIP model
             with track_model_vram(self.device, f"Loading {self.name}"):
                 print(f'--{self.name}')
@@ -103,6 +246,62 @@ class ClipManager:
                     pretrained=CLIP_NAME_MAP[self.name][1]
                 ).eval().requires_grad_(False).to(self.device)
 
+    def _encode_probe(self, probe):
+        start = time.perf_counter()
+        with torch.no_grad():
+            embeds = self.model.encode_image(probe).float()
+        return embeds, time.perf_counter() - start
+
+    def quantize_model(self):
+        """
+        Swap the model's linear layers for int8 ones, and log how far that moves its image
+        embeddings and how much time and memory it saves, measured on a fixed batch of noise.
+        """
+        size = self.input_resolution
+        probe = torch.rand(4, 3, size, size, generator=torch.Generator().manual_seed(0))
+        probe = clip_img_normalize(probe).to(self.device)
+        expected, float_time = self._encode_probe(probe)
+        freed = quantize_linear_layers(self.model)
+        embeds, int8_time = self._encode_probe(probe)
+        similarity = F.cosine_similarity(embeds, expected, dim=-1).min().item()
+        logger.info(
+            f'Quantized {self.name} to int8: embedding cosine similarity {similarity:.4f}, '
+            f'encode {float_time * 1000:.0f}ms -> {int8_time * 1000:.0f}ms, {freed / 2 ** 20:.0f}MiB freed'
+        )
+
+    def set_activation_checkpointing(self, enabled):
+        """
+        Checkpoint the image encoder's blocks when guidance backpropagates through it, trading a
+        second forward of each block for keeping only the activations between blocks.
+        """
+        blocks = set_block_checkpointing(self.model.visual, enabled)
+        self.activation_checkpointing = enabled
+        if enabled:
+            logger.debug(f'Checkpointing {blocks} image encoder blocks of {self.name}')
+
+    def encode_text_prompt(self, prompt):
+        """
+        Return the CLIP text embedding for a prompt, using the LRU cache when possible.
+        """
+        if prompt in self.text_embed_cache:
+            self.text_embed_cache.move_to_end(prompt)
+            return self.text_embed_cache[prompt]
+        encoded_text = None
+        if self.embedding_store is not None:
+            encoded_text = self.embedding_store.get(self.name, self.checkpoint, 'text', prompt, self.device)
+        if encoded_text is None:
+            with torch.no_grad():
+                encoded_text = self.model.encode_text(clip.tokenize(prompt).to(self.device)).float()
+            if self.embedding_store is not None:
+                self.embedding_store.put(self.name, self.checkpoint, 'text', prompt, encoded_text)
+        self.text_embed_cache[prompt] = encoded_text
+        while len(self.text_embed_cache) > self.text_embed_cache_size:
+            self.text_embed_cache.popitem(last=False)
+        return encoded_text
+
+    def clear_text_embed_cache(self):
+        self.text_embed_cache.clear()
+
     def embed_text_prompts(
         self,
         prompts,
@@ -114,7 +313,7 @@ class ClipManager:
         prompt_weights = []
         for prompt in prompts:
             txt, weight = self.parse_prompt(prompt, {'s': step})
-            encoded_text = self.model.encode_text(clip.tokenize(prompt).to(self.device)).float()
+            encoded_text = self.encode_text_prompt(prompt)
             if fuzzy_prompt:
                 for i in range(25):
                     prompt_embeds.append(
@@ -144,26 +343,38 @@ class ClipManager:
             fuzzy_prompt=False,
             fuzzy_prompt_rand_mag=0.05,
             cutout_skip_augs=False,
-            cutout_debug=False
+            cutout_debug=False,
+            image_store=None,
+            refresh_steps=0
     ):
-        cutouts = cut_model(
-            self.model.visual.input_resolution,
-            cutn,
-        )
+        if image_store is None:
+            image_store = ImagePromptStore(self.device, side_x, side_y)
+        cutouts = None
         prompt_embeds = []
         prompt_weights = []
         for prompt in prompts:
             path, weight = self.parse_prompt(prompt, {'s': step})
-            img = Image.open(fetch(path)).convert('RGB')
-            img = transforms_functional.resize(
-                img,
-                min(side_x, side_y, *img.size),
-                transforms.InterpolationMode.LANCZOS
-            )
-            batch, _ = cutouts(
-                transforms_functional.to_tensor(img).to(self.device).unsqueeze(0).mul(2).sub(1)
-            )
-            embed = self.model.encode_image(clip_img_normalize(batch)).float()
+            embed = image_store.get_embed(self.name, path, cutn, step, refresh_steps)
+            # Only the first encoding of an image in a run comes from the on-disk store,
+            # refreshes always draw new cutouts.
+            use_embedding_store = self.embedding_store is not None and not image_store.has_embed(self.name, path, cutn)
+            if embed is None and use_embedding_store:
+                content = f'{image_store.get_digest(path)}:{cutn}'
+                embed = self.embedding_store.get(self.name, self.checkpoint, 'image', content, self.device)
+                if embed is not None:
+                    image_store.put_embed(self.name, path, cutn, step, embed)
+            if embed is None:
+                if cutouts is None:
+                    cutouts = cut_model(
+                        self.model.visual.input_resolution,
+                        cutn,
+                    )
+                batch, _ = cutouts(image_store.get_image(path))
+                with torch.no_grad():
+                    embed = self.model.encode_image(clip_img_normalize(batch)).float()
+                image_store.put_embed(self.name, path, cutn, step, embed)
+                if use_embedding_store:
+                    self.embedding_store.put(self.name, self.checkpoint, 'image', content, embed)
             if fuzzy_prompt:
                 for i in range(25):
                     prompt_embeds.append(
@@ -193,55 +404,163 @@ class ClipManager:
         for i, cutout in enumerate(cutouts):
             save_cut_image(cutout, os.path.join(self.cutout_debug_image_dir, f"cutout_{self.name}_{i}.jpg"))
 
-    def get_cut_batch_losses(
-        self,
-        x_in,
-        n,
-        cut_overview,
-        cut_innercut,
-        innercut_power,
-        innercut_gray_prob,
-        t_int,
-        cut_fn,
-        cutout_debug=False,
-    ):
+    @property
+    def input_resolution(self):
         try:
-            input_resolution = self.model.visual.input_resolution
+            return self.model.visual.input_resolution
         except:  # Except what?
-            input_resolution = 224
+            return 224
 
+    def cut_counts(self, cut_overview, cut_innercut, t_int):
         # Apply model weight to # of overview and innercuts to do
         o_cuts = int(cut_overview[1000 - t_int] * self.cut_count_multiplier)
         i_cuts = int(cut_innercut[1000 - t_int] * self.cut_count_multiplier)
         if o_cuts == 0 and i_cuts == 0:
             i_cuts = 2  # we have to do something otherwise we crash
-        logger.debug(f'Doing {o_cuts} overview cuts and {i_cuts} inner for {self.name}')
+        return o_cuts, i_cuts
+
+    def max_cut_counts(self, cut_overview, cut_innercut):
+        # At least the most overview and inner cuts cut_counts gives anywhere in the schedule
+        o_cuts = int(cut_overview.values.max() * self.cut_count_multiplier)
+        i_cuts = int(cut_innercut.values.max() * self.cut_count_multiplier)
+        return o_cuts, max(i_cuts, 2)
+
+    def cut_chunk_size(self, budget, n, limit):
+        """
+        The most cuts of an n image batch, up to limit, to encode and backpropagate at once within
+        budget bytes, going by this model's memory profile. None without a budget or a profile.
+        """
+        if budget is None:
+            return None
+        cuts = max_cuts_within(
+            CLIP_PROFILES.get(self.name, unknown_clip_profile), budget, limit * n, self.activation_checkpointing
+        )
+        return None if cuts is None else max(cuts // n, 1)
 
+    def _ensure_heatmap(self, cut_input):
         if not self.cut_heatmap and self.use_cut_heatmap:
-            self.cut_heatmap = CutHeatmap(side_x=x_in.shape[-1], side_y=x_in.shape[-2])
+            self.cut_heatmap = CutHeatmap(
+                side_x=cut_input.shape[-1],
+                side_y=cut_input.shape[-2],
+                resolution=self.cut_heatmap_resolution
+            )
+        return self.cut_heatmap
 
-        # Then do the cuts
-        cuts = cut_fn(
-            input_resolution,
+    def _cut_config(self, o_cuts, i_cuts, innercut_power, innercut_gray_prob, t_int):
+        return dict(
             Overview=o_cuts,
             InnerCrop=i_cuts,
             IC_Size_Pow=innercut_power[1000 - t_int],
             IC_Grey_P=innercut_gray_prob[1000 - t_int]
         )
 
-        cut_input = x_in.add(1).div(2)
-        cutouts, innercut_bound_list = cuts(cut_input, heatmap=self.cut_heatmap, pad_inner=self.pad_inner_cuts)
+    def plan_cuts(
+        self,
+        planner,
+        context,
+        o_cuts,
+        i_cuts,
+        innercut_power,
+        innercut_gray_prob,
+        t_int,
+        cut_fn,
+    ):
+        """
+        Queue the plan for one make_cuts batch on planner, a CutPlanner. Returns a Future of the plan,
+        to pass to make_cuts.
+        """
+        cut_input = context.input
+        return planner.submit(
+            context.cut_module(cut_fn, self.input_resolution),
+            cut_input.shape[-1],
+            cut_input.shape[-2],
+            cut_input.shape[0],
+            heatmap=self._ensure_heatmap(cut_input),
+            pad_inner=self.pad_inner_cuts,
+            config=self._cut_config(o_cuts, i_cuts, innercut_power, innercut_gray_prob, t_int)
+        )
+
+    def make_cuts(
+        self,
+        context,
+        o_cuts,
+        i_cuts,
+        innercut_power,
+        innercut_gray_prob,
+        t_int,
+        cut_fn,
+        cutout_debug=False,
+        plan=None,
+        out=None,
+    ):
+        """
+        Take a batch of o_cuts overview and i_cuts inner cuts from the image in context, a CutContext.
+        plan is a Future from plan_cuts for the same counts; without one the cuts are planned here.
+        The cuts are written into out, or else this manager's cut_buffer, and come back CLIP
+        normalized, so they're only good until the next batch.
+        """
+        logger.debug(f'Doing {o_cuts} overview cuts and {i_cuts} inner for {self.name}')
+        cut_input = context.input
+        if plan is None:
+            cuts = context.cut_module(
+                cut_fn,
+                self.input_resolution,
+                **self._cut_config(o_cuts, i_cuts, innercut_power, innercut_gray_prob, t_int)
+            )
+        else:
+            cuts = context.cut_module(cut_fn, self.input_resolution)
+            plan = plan.result()
+        cutouts, innercut_bound_list = cuts(
+            cut_input,
+            heatmap=self._ensure_heatmap(cut_input),
+            pad_inner=self.pad_inner_cuts,
+            overview=context.overview(self.input_resolution) if o_cuts else None,
+            plan=plan,
+            pyramid=context.pyramid(),
+            out=out if out is not None else self.cut_buffer.take(
+                (o_cuts + i_cuts) * cut_input.shape[0], self.input_resolution, cut_input.device, cut_input.dtype
+            )
+        )
         if cutout_debug:
             self.save_debug_images(cut_input, innercut_bound_list, cutouts)
-        if self.use_cut_heatmap:
+        clip_img_normalize_(cutouts)
+        # A planned batch had its heatmap decayed by the planner
+        if self.use_cut_heatmap and plan is None:
             self.cut_heatmap.decay()
-        clip_in = clip_img_normalize(
-            cutouts
-        )
-        image_embeds = self.model.encode_image(clip_in).float()
+        return cutouts
+
+    def cut_loss_sums(self, cutouts, n):
+        """
+        The prompt weighted loss of each of the n images, summed over the cuts in cutouts, which come
+        from make_cuts and so are already normalized. Any whole number of cuts can be scored at once.
+        """
+        image_embeds = self.model.encode_image(cutouts).float()
         dists = spherical_dist_loss(
             image_embeds.unsqueeze(1),
             self.prompt_embeds.unsqueeze(0))
-        dists = dists.view([o_cuts + i_cuts, n, -1])
-        losses = dists.mul(self.prompt_weights).sum(2).mean(0)
-        return losses
+        dists = dists.view([-1, n, dists.shape[-1]])
+        return dists.mul(self.prompt_weights).sum(2).sum(0)
+
+    def cut_losses(self, cutouts, n, o_cuts, i_cuts):
+        return self.cut_loss_sums(cutouts, n) / (o_cuts + i_cuts)
+
+    def get_cut_batch_losses(
+        self,
+        x_in,
+        n,
+        cut_overview,
+        cut_innercut,
+        innercut_power,
+        innercut_gray_prob,
+        t_int,
+        cut_fn,
+        cutout_debug=False,
+        context=None,
+    ):
+        if context is None:
+            context = CutContext(x_in)
+        o_cuts, i_cuts = self.cut_counts(cut_overview, cut_innercut, t_int)
+        cutouts = self.make_cuts(
+            context, o_cuts, i_cuts, innercut_power, innercut_gray_prob, t_int, cut_fn, cutout_debug
+        )
+        return self.cut_losses(cutouts, n, o_cuts, i_cuts)
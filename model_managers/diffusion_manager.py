@@ -0,0 +1,229 @@
+import hashlib
+import logging
+import os
+import urllib.request
+from dataclasses import dataclass
+
+import json5 as json
+
+logger = logging.getLogger(__name__)
+
+# torch and guided_diffusion are imported by the functions that build models, so reading a model's
+# details stays cheap (prd.py --estimate)
+
+SECONDARY_MODEL_FILE = 'secondary_model_imagenet_2.pth'
+SECONDARY_MODEL_SHA = '983e3de6f95c88c81b2ca7ebb2c217933be1973b1ff058776b970f901584613a'
+SECONDARY_MODEL_LINK = 'https://the-eye.eu/public/AI/models/v-diffusion/secondary_model_imagenet_2.pth'
+SECONDARY_MODEL_LINK_FB = 'https://www.dropbox.com/s/luv4fezod3r8d2n/secondary_model_imagenet_2.pth'
+
+
+@dataclass
+class Diff_Model:
+    def __init__(self):
+        pass
+    name: str
+    SHA: str
+    plink: str
+    path: str
+    attention_resolutions: str
+    class_cond: bool
+    rescale_timesteps: bool
+    image_size: int
+    learn_sigma: bool
+    noise_schedule: str
+    num_channels: int
+    num_res_blocks: int
+    resblock_updown: bool
+    use_scale_shift_norm: bool
+    timestep_respacing: str
+    use_fp16: bool
+    num_head_channels: int = -1
+    num_heads: int = 1
+    slink: str = "none"
+
+
+def read_diffusion_model(name, fp16_mode, timestep_respacing='50', models_file='diffusion_models.json'):
+    """
+    Look up a diffusion model's details in diffusion_models.json.
+    """
+    with open(models_file, 'r', encoding="utf-8") as json_file:
+        diffusion_models_file = json.load(json_file)
+    if name not in diffusion_models_file:
+        raise KeyError(f'{name} is not listed in {models_file}')
+    details = diffusion_models_file[name]
+    diffusion_model = Diff_Model()
+    diffusion_model.name = name
+    diffusion_model.SHA = details['SHA']
+    diffusion_model.plink = details['primary_link']
+    if details.get('secondary_link') is not None:
+        diffusion_model.slink = details['secondary_link']
+    diffusion_model.path = details['file_name']
+    diffusion_model.attention_resolutions = details['attention_resolutions']
+    diffusion_model.class_cond = details['class_cond']
+    diffusion_model.rescale_timesteps = details['rescale_timesteps']
+    diffusion_model.image_size = details['image_size']
+    diffusion_model.learn_sigma = details['learn_sigma']
+    diffusion_model.noise_schedule = details['noise_schedule']
+    diffusion_model.num_channels = details['num_channels']
+    if details.get('num_head_channels') is not None:
+        diffusion_model.num_head_channels = details['num_head_channels']
+    diffusion_model.num_heads = details['num_heads']
+    diffusion_model.num_res_blocks = details['num_res_blocks']
+    diffusion_model.resblock_updown = details['resblock_updown']
+    diffusion_model.use_scale_shift_norm = details['use_scale_shift_norm']
+    # Can't use fp16 when in CPU mode
+    diffusion_model.use_fp16 = bool(fp16_mode and details.get('use_fp16'))
+    if details.get('timestep_respacing') is not None:
+        diffusion_model.timestep_respacing = details['timestep_respacing']
+    else:
+        diffusion_model.timestep_respacing = timestep_respacing
+    return diffusion_model
+
+
+def _file_matches_sha(file_name, sha):
+    with open(file_name, "rb") as f:
+        bytes = f.read()
+        hash = hashlib.sha256(bytes).hexdigest()
+    return hash == sha
+
+
+def download_models(diffusion_model, model_path, check_model_SHA=False):
+    """
+    Make sure the diffusion model and the secondary model are present in model_path, downloading
+    them if needed. Raises a RuntimeError if either can't be downloaded.
+    """
+    model_downloaded = False
+    model_secondary_downloaded = False
+    model_file = f'{model_path}/{diffusion_model.path}'
+    model_secondary_path = f'{model_path}/{SECONDARY_MODEL_FILE}'
+
+    if os.path.exists(model_file):
+        model_downloaded = True
+        if check_model_SHA:
+            print(f'Checking SHA for {diffusion_model.name}')
+            if not _file_matches_sha(model_file, diffusion_model.SHA):
+                print('SHA does not match. Redownloading...')
+                model_downloaded = False
+
+    if model_downloaded == False:
+        print(f'{diffusion_model.name} Model downloading. This may take a while...')
+        urllib.request.urlretrieve(diffusion_model.plink, model_file)
+        if os.path.exists(model_file):
+            model_downloaded = True
+        else:
+            print('First URL failed, using backup if available')
+            if diffusion_model.slink != "none":
+                urllib.request.urlretrieve(diffusion_model.slink, model_file)
+            if os.path.exists(model_file):
+                model_downloaded = True
+
+    if model_downloaded == False:
+        raise RuntimeError(
+            'Unable to download the diffusion model.\n'
+            'Please check your diffusion_models.json file for proper formatting,\n'
+            'Or check the Prog Rock Diffusion github for updated links.'
+        )
+
+    if os.path.exists(model_secondary_path):
+        model_secondary_downloaded = True
+        if check_model_SHA:
+            print(f'Checking SHA for Secondary Model')
+            if not _file_matches_sha(model_secondary_path, SECONDARY_MODEL_SHA):
+                print('SHA does not match. Redownloading...')
+                model_secondary_downloaded = False
+
+    if model_secondary_downloaded == False:
+        print(f'Secondary Model downloading. This may take a while...')
+        urllib.request.urlretrieve(SECONDARY_MODEL_LINK, model_secondary_path)
+        if os.path.exists(model_secondary_path):
+            model_secondary_downloaded = True
+        else:
+            print('First URL failed, using backup if available')
+            urllib.request.urlretrieve(SECONDARY_MODEL_LINK_FB, model_secondary_path)
+            if os.path.exists(model_secondary_path):
+                model_secondary_downloaded = True
+
+    if model_secondary_downloaded == False:
+        raise RuntimeError(
+            'Unable to download the secondary diffusion model.\n'
+            'Please check the Prog Rock Diffusion github for a possible updated version with new links.'
+        )
+
+
+def create_model_config(diffusion_model, diffusion_steps, use_checkpoint=True):
+    from guided_diffusion.script_util import model_and_diffusion_defaults
+    model_config = model_and_diffusion_defaults()
+    model_config.update({
+        'attention_resolutions': diffusion_model.attention_resolutions,
+        'class_cond': diffusion_model.class_cond,
+        'diffusion_steps': diffusion_steps,
+        'rescale_timesteps': diffusion_model.rescale_timesteps,
+        'timestep_respacing': diffusion_model.timestep_respacing,
+        'image_size': diffusion_model.image_size,
+        'learn_sigma': diffusion_model.learn_sigma,
+        'noise_schedule': diffusion_model.noise_schedule,
+        'num_channels': diffusion_model.num_channels,
+        'num_head_channels': diffusion_model.num_head_channels,
+        'num_heads': diffusion_model.num_heads,
+        'num_res_blocks': diffusion_model.num_res_blocks,
+        'resblock_updown': diffusion_model.resblock_updown,
+        'use_checkpoint': use_checkpoint,
+        'use_fp16': diffusion_model.use_fp16,
+        'use_scale_shift_norm': diffusion_model.use_scale_shift_norm,
+    })
+    return model_config
+
+
+def set_model_steps(model_config, steps):
+    """
+    Point the model config at a DDIM schedule with the given number of steps.
+    """
+    model_config.update({
+        'timestep_respacing': f'ddim{steps}',
+        'diffusion_steps': (1000 // steps) * steps if steps < 1000 else steps,
+    })
+    return model_config
+
+
+def load_diffusion_model(model_config, model_file, device, weight_cache=None):
+    """
+    Build the diffusion model for model_config with the weights in model_file, ready to sample
+    with on device. With a WeightCache, the converted weights are mapped from it when they've
+    been cached before, and cached otherwise.
+    """
+    import torch
+    from guided_diffusion.script_util import create_model_and_diffusion
+    model, diffusion = create_model_and_diffusion(**model_config)
+    cache_name = os.path.splitext(os.path.basename(model_file))[0]
+    if weight_cache is not None and weight_cache.load(model, cache_name, model_file, use_fp16=model_config['use_fp16']):
+        model.eval()
+    else:
+        model.load_state_dict(torch.load(model_file, map_location='cpu'))
+        model.requires_grad_(False).eval()
+        for name, param in model.named_parameters():
+            if 'qkv' in name or 'norm' in name or 'proj' in name:
+                param.requires_grad_()
+        if model_config['use_fp16']:
+            model.convert_to_fp16()
+        if weight_cache is not None:
+            weight_cache.save(model, cache_name, model_file, use_fp16=model_config['use_fp16'])
+    model.to(device)
+    return model, diffusion
+
+
+def create_diffusion(model_config):
+    """
+    Build just the sampling schedule for a model config. This is cheap, so a resident model can be
+    reused with a different number of steps by swapping in a new diffusion.
+    """
+    from guided_diffusion.script_util import create_gaussian_diffusion
+    return create_gaussian_diffusion(
+        steps=model_config['diffusion_steps'],
+        learn_sigma=model_config['learn_sigma'],
+        noise_schedule=model_config['noise_schedule'],
+        use_kl=model_config['use_kl'],
+        predict_xstart=model_config['predict_xstart'],
+        rescale_timesteps=model_config['rescale_timesteps'],
+        rescale_learned_sigmas=model_config['rescale_learned_sigmas'],
+        timestep_respacing=model_config['timestep_respacing'],
+    )
@@ -0,0 +1,101 @@
+import hashlib
+import logging
+import os
+import tempfile
+
+import numpy as np
+import torch
+
+from helpers.vram_helpers import format_bytes
+
+logger = logging.getLogger(__name__)
+
+
+class EmbeddingStore:
+    """
+    Content-addressed on-disk store for CLIP embeddings, shared between runs.
+
+    Each embedding is saved as its own .npy file, named by a hash of the model name, the checkpoint
+    it was produced with and the prompt text (or image digest), and sharded into subdirectories by
+    the first two characters of that hash. Files are memory-mapped on read and handed back without a
+    copy, so only moving an embedding to another device reads it into memory. The modification time
+    of a file is bumped on every read, and once the store grows past max_bytes the least recently
+    used files are deleted until it is back under the low water mark.
+    """
+
+    def __init__(self, root, max_bytes=1024 ** 3, low_water_ratio=0.9):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.low_water_ratio = low_water_ratio
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(self.root, exist_ok=True)
+        self.total_bytes = sum(size for _, size, _ in self._scan())
+        logger.debug(f"Embedding store at {self.root} holds {format_bytes(self.total_bytes)}")
+
+    @staticmethod
+    def make_key(model_name, checkpoint, kind, content):
+        key = '\0'.join((str(model_name), str(checkpoint), str(kind), str(content)))
+        return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.root, key[:2], f'{key}.npy')
+
+    def _scan(self):
+        for shard in os.scandir(self.root):
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                if entry.name.endswith('.npy'):
+                    stat = entry.stat()
+                    yield entry.path, stat.st_size, stat.st_mtime
+
+    def get(self, model_name, checkpoint, kind, content, device='cpu'):
+        path = self._path(self.make_key(model_name, checkpoint, kind, content))
+        try:
+            # Copy on write, so the tensor is writable without ever writing through to the file
+            embed = np.load(path, mmap_mode='c')
+            # Bump the mtime so eviction sees this entry as recently used
+            os.utime(path)
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return torch.from_numpy(embed).to(device)
+
+    def put(self, model_name, checkpoint, kind, content, embed):
+        path = self._path(self.make_key(model_name, checkpoint, kind, content))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write to a temporary file and rename it into place, so that other processes sharing
+        # the store never see a partially written file.
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, embed.detach().float().cpu().numpy())
+            # An entry being replaced no longer counts towards the size
+            replaced_bytes = os.path.getsize(path) if os.path.exists(path) else 0
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f"Unable to write embedding to {path}: {e}")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+        self.total_bytes += os.path.getsize(path) - replaced_bytes
+        if self.total_bytes > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        entries = sorted(self._scan(), key=lambda entry: entry[2])
+        self.total_bytes = sum(size for _, size, _ in entries)
+        target = self.max_bytes * self.low_water_ratio
+        evicted = 0
+        for path, size, _ in entries:
+            if self.total_bytes <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self.total_bytes -= size
+            evicted += 1
+        logger.debug(f"Evicted {evicted} embeddings, store now holds {format_bytes(self.total_bytes)}")
@@ -0,0 +1,70 @@
+import torch
+from torch import nn
+
+
+class _DynamicInt8LinearFunction(torch.autograd.Function):
+
+    @staticmethod
+    def forward(ctx, input, layer):
+        ctx.layer = layer
+        return torch.ops.quantized.linear_dynamic(input, layer.packed, layer.reduce_range)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        # Straight through: the input gradient is the float layer's, from the dequantized weight
+        return grad_output.matmul(ctx.layer.qweight.dequantize()), None
+
+
+class DynamicInt8Linear(nn.Module):
+    """
+    Stands in for a frozen nn.Linear with its weight stored as per-channel int8. The forward runs
+    on the quantized CPU kernels, quantizing each input on the fly, and the backward passes the
+    gradient through to the input in float32 so guidance still works. Weights have no gradient.
+    """
+
+    def __init__(self, linear, reduce_range=True):
+        super().__init__()
+        self.in_features = linear.in_features
+        self.out_features = linear.out_features
+        self.reduce_range = reduce_range
+        weight = linear.weight.detach().float()
+        scales = weight.abs().amax(dim=1).clamp(min=1e-8) / 127
+        zero_points = torch.zeros(self.out_features, dtype=torch.long)
+        self.qweight = torch.quantize_per_channel(weight, scales, zero_points, 0, torch.qint8)
+        bias = None if linear.bias is None else linear.bias.detach().float()
+        self.packed = torch.ops.quantized.linear_prepack(self.qweight, bias)
+
+    def forward(self, input):
+        return _DynamicInt8LinearFunction.apply(input.float(), self)
+
+    def weight_bytes(self):
+        return self.qweight.numel() + self.qweight.q_per_channel_scales().numel() * 8
+
+    def extra_repr(self):
+        return f'in_features={self.in_features}, out_features={self.out_features}, dtype=qint8'
+
+
+# Modules that pass their linear layers' weights to F.multi_head_attention_forward rather than
+# calling them, like the attention pooling at the end of the CLIP ResNets, by class name so the CLIP
+# packages don't have to be imported
+WEIGHT_READING_MODULES = ('AttentionPool2d',)
+
+
+def quantize_linear_layers(model):
+    """
+    Replace the nn.Linear layers of a frozen CPU model with DynamicInt8Linear, in place. Layers whose
+    weights are read directly are left alone: the output projections nn.MultiheadAttention keeps as
+    subclasses, and the projections of WEIGHT_READING_MODULES. Returns the number of float weight
+    bytes freed.
+    """
+    freed = 0
+    for parent in list(model.modules()):
+        if type(parent).__name__ in WEIGHT_READING_MODULES:
+            continue
+        for name, child in list(parent.named_children()):
+            if type(child) is not nn.Linear:
+                continue
+            quantized = DynamicInt8Linear(child)
+            freed += child.weight.numel() * child.weight.element_size() - quantized.weight_bytes()
+            setattr(parent, name, quantized)
+    return freed
@@ -0,0 +1,135 @@
+import hashlib
+import json
+import logging
+import os
+import tempfile
+
+import numpy as np
+import torch
+
+from helpers.vram_helpers import format_bytes
+
+logger = logging.getLogger(__name__)
+
+# Bump when the layout of the files changes, so older caches are ignored rather than misread
+WEIGHT_CACHE_VERSION = 1
+# Tensors start on this boundary in the data file, so every view of the map is aligned
+ALIGNMENT = 64
+
+
+class WeightCache:
+    """
+    On-disk cache of models' weights as they are after loading: converted to the dtype they run in
+    and with the requires_grad pattern they are used with. Each model is a raw data file holding its
+    parameters and buffers back to back, and a JSON index of where each one is. Loading maps the
+    data file into memory and points the parameters at it, so nothing is deserialized or copied
+    until the model moves to a GPU, and pages are only read from disk as they are used.
+
+    Entries are keyed by the model name, its source (a checkpoint file, whose size and modification
+    time are included, or an identifier like a checkpoint hash) and any options that change the
+    converted weights, such as the device type they were converted for.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(self.root, exist_ok=True)
+
+    @staticmethod
+    def make_key(name, source, **options):
+        source = str(source)
+        if os.path.isfile(source):
+            stat = os.stat(source)
+            source = f'{os.path.abspath(source)}:{stat.st_size}:{stat.st_mtime_ns}'
+        key = json.dumps([WEIGHT_CACHE_VERSION, name, source, options], sort_keys=True)
+        return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+    def _paths(self, name, key):
+        base = os.path.join(self.root, f'{name}-{key[:16]}')
+        return f'{base}.json', f'{base}.bin'
+
+    def state_dict(self, name, source, **options):
+        """
+        The cached tensors for a model, mapped from disk, with requires_grad set as they were saved.
+        None if the model isn't cached.
+        """
+        index_path, data_path = self._paths(name, self.make_key(name, source, **options))
+        try:
+            with open(index_path, 'r', encoding='utf-8') as f:
+                index = json.load(f)
+            # Copy on write, so the file is shared between processes but never written through
+            data = np.memmap(data_path, dtype=np.uint8, mode='c')
+        except (OSError, ValueError):
+            return None
+        tensors = {}
+        for tensor_name, entry in index.items():
+            array = data[entry['offset']:entry['offset'] + entry['bytes']].view(entry['dtype'])
+            tensor = torch.from_numpy(array.reshape(entry['shape']))
+            tensors[tensor_name] = tensor.requires_grad_(entry['requires_grad'])
+        return tensors
+
+    def load(self, module, name, source, state_dict=None, **options):
+        """
+        Point module's parameters and buffers at its cached, mapped weights. Pass state_dict if it
+        was already fetched with state_dict(). Returns False, leaving module as it was, if there is
+        no cache entry or it doesn't fit module.
+        """
+        if state_dict is None:
+            state_dict = self.state_dict(name, source, **options)
+        if state_dict is None:
+            return False
+        parameters = dict(module.named_parameters())
+        buffers = dict(module.named_buffers())
+        if set(state_dict) != set(parameters) | set(buffers):
+            logger.warning(f'Cached weights for {name} do not match the model, ignoring them')
+            return False
+        for tensor_name, tensor in state_dict.items():
+            if tensor_name in parameters:
+                parameters[tensor_name].data = tensor
+                parameters[tensor_name].requires_grad_(tensor.requires_grad)
+            else:
+                owner_name, _, buffer_name = tensor_name.rpartition('.')
+                owner = module.get_submodule(owner_name) if owner_name else module
+                owner._buffers[buffer_name] = tensor.detach()
+        logger.debug(f'Mapped cached weights for {name}')
+        return True
+
+    def save(self, module, name, source, **options):
+        """
+        Cache module's parameters and buffers as they are now. Failing to write only logs a warning.
+        """
+        index_path, data_path = self._paths(name, self.make_key(name, source, **options))
+        tensors = list(module.named_parameters()) + list(module.named_buffers())
+        index = {}
+        # Write to temporary files and rename them into place, data first, so that other processes
+        # never see an index without its data or a partially written file
+        fd, tmp_data_path = tempfile.mkstemp(dir=self.root, suffix='.tmp')
+        tmp_index_path = None
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                offset = 0
+                for tensor_name, tensor in tensors:
+                    array = tensor.detach().cpu().contiguous().numpy()
+                    f.write(b'\0' * (-offset % ALIGNMENT))
+                    offset += -offset % ALIGNMENT
+                    f.write(array.tobytes())
+                    index[tensor_name] = {
+                        'dtype': str(array.dtype),
+                        'shape': list(array.shape),
+                        'offset': offset,
+                        'bytes': array.nbytes,
+                        'requires_grad': tensor.requires_grad,
+                    }
+                    offset += array.nbytes
+            fd, tmp_index_path = tempfile.mkstemp(dir=self.root, suffix='.tmp')
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(index, f)
+            os.replace(tmp_data_path, data_path)
+            os.replace(tmp_index_path, index_path)
+        except (OSError, TypeError) as e:
+            # TypeError is numpy not having the dtype, like bfloat16
+            logger.warning(f'Unable to cache weights for {name}: {e}')
+            for path in (tmp_data_path, tmp_index_path):
+                if path is not None and os.path.exists(path):
+                    os.remove(path)
+            return
+        logger.debug(f'Cached weights for {name} in {data_path}: {format_bytes(offset)}')
@@ -53,6 +53,9 @@ Comic faces model by alex_spirin
 
 import sys
 import os
+import time
+
+startup_time = time.perf_counter()
 
 root_path = os.getcwd() # noqa: E402
 sys.path.append(f'{root_path}/ResizeRight')  # noqa: E402
@@ -60,36 +63,32 @@ sys.path.append(f'{root_path}/CLIP')  # noqa: E402
 sys.path.append(f'{root_path}/guided-diffusion')  # noqa: E402
 sys.path.append(f'{root_path}/open_clip/src')  # noqa: E402
 
-from cut_modules.make_cutouts import MakeCutoutsDango, MakeCutouts
-from helpers.utils import fetch
+# Only light imports up here. Torch, CLIP and the diffusion code take several seconds to import,
+# so they are imported further down once the command line and settings have been parsed.
+# That way --help, --estimate and a broken settings file all return quickly.
+from helpers.utils import fetch, get_resampling_mode
+from helpers.schedules import (
+    auto_clamp_max,
+    auto_clip_guidance_scale,
+    auto_eta,
+    Schedule,
+)
 from os.path import exists
 import urllib.request
 import hashlib
 import random
 import numpy as np
 from datetime import datetime
-from guided_diffusion.script_util import create_model_and_diffusion, model_and_diffusion_defaults
-from resize_right import resize
-import clip
-from tqdm import tqdm
-import torchvision.transforms.functional as TF
-from torch.nn import functional as F
-from torch import nn
-import torch
 from typing import Text, List, Union
 from types import SimpleNamespace
 import json5 as json
 from glob import glob
 from PIL.PngImagePlugin import PngInfo
 from PIL import Image, ImageOps, ImageStat, ImageEnhance
-import lpips
-import timm
 import math
 import io
 import gc
 import re
-import pandas as pd
-import cv2
 from functools import partial
 from dataclasses import dataclass
 import subprocess
@@ -98,12 +97,6 @@ from pickle import FALSE
 import shutil
 import logging
 import argparse
-from helpers.vram_helpers import (
-    track_model_vram,
-    estimate_vram_requirements,
-    log_max_allocated,
-)
-from model_managers.clip_manager import ClipManager, CLIP_NAME_MAP
 
 from attr import has
 
@@ -118,12 +111,8 @@ def createPath(filepath):
 
 
 initDirPath = f'{root_path}/init_images'
-createPath(initDirPath)
 outDirPath = f'{root_path}/images_out'
-createPath(outDirPath)
-
 model_path = f'{root_path}/models'
-createPath(model_path)
 
 model_256_downloaded = False
 model_512_downloaded = False
@@ -244,6 +233,13 @@ symm_loss_scale = 2400
 symm_switch = 45
 use_jpg = False
 render_mask = None
+image_prompt_refresh_steps = 0
+share_cut_batches = False
+cut_pyramid = True
+cut_memory_budget = 'auto'
+guidance_workers = 1
+mixed_precision = False
+clip_checkpointing = False
 
 # Command Line parse
 
@@ -301,6 +297,18 @@ def parse_args():
     Alternative scaling method is to use ESRGAN (note: RealESRGAN must be installed and in your path):
      {python_example} prd.py --esrgan
     More information on instlaling it is here: https://github.com/xinntao/Real-ESRGAN
+
+    To check your settings and see how much VRAM they need, without rendering anything:
+     {python_example} prd.py -s "some_directory/mysettings.json" --estimate
+
+    To reuse CLIP prompt embeddings across runs (stored in models/embeddings, limited to 2GB here):
+     {python_example} prd.py --embedding_store --embedding_store_mb 2048
+
+    To load models faster on later runs, from converted copies kept in models/weight_cache:
+     {python_example} prd.py --weight_cache
+
+    To skip rendering when the same settings and seed have been rendered before (needs a fixed set_seed):
+     {python_example} prd.py -s "some_directory/mysettings.json" --result_cache
     '''
 
     my_parser = argparse.ArgumentParser(
@@ -362,6 +370,13 @@ def parse_args():
         help='Force use of CPU instead of GPU, and how many threads to run'
     )
 
+    my_parser.add_argument(
+        '--cpu_quantize',
+        action='store_true',
+        required=False,
+        help='When rendering on CPU, run the CLIP models with int8 weights. Faster and smaller, with slightly different guidance.'
+    )
+
     my_parser.add_argument(
         '-g',
         '--geninit',
@@ -468,6 +483,58 @@ def parse_args():
         help="Output cut debug images."
     )
 
+    my_parser.add_argument(
+        '--estimate',
+        action='store_true',
+        required=False,
+        help='Check the settings and print the estimated VRAM requirement, then exit without loading any models.'
+    )
+
+    my_parser.add_argument(
+        '--embedding_store',
+        action='store_true',
+        required=False,
+        help='Keep CLIP prompt embeddings in models/embeddings and reuse them across runs.'
+    )
+
+    my_parser.add_argument(
+        '--embedding_store_mb',
+        type=int,
+        required=False,
+        default=1024,
+        help='Maximum size of the embedding store in MB. Least recently used embeddings are removed past this. (default: 1024)'
+    )
+
+    my_parser.add_argument(
+        '--weight_cache',
+        action='store_true',
+        required=False,
+        help='Keep converted copies of the diffusion and CLIP weights in models/weight_cache and map them in on later runs, for faster loading with less memory.'
+    )
+
+    my_parser.add_argument(
+        '--result_cache',
+        action='store_true',
+        required=False,
+        help='Keep finished images in result_cache, and reuse them instead of rendering when the settings and seed match a previous run.'
+    )
+
+    my_parser.add_argument(
+        '--result_cache_mb',
+        type=int,
+        required=False,
+        default=2048,
+        help='Maximum size of the result cache in MB. (default: 2048)'
+    )
+
+    my_parser.add_argument(
+        '--result_cache_policy',
+        choices=['lru', 'fifo'],
+        required=False,
+        default='lru',
+        help='Which results to remove when the cache is full: least recently used (lru) or oldest (fifo). (default: lru)'
+    )
+
     return my_parser.parse_args()
 
 
@@ -507,7 +574,7 @@ def clampval(var_name, minval, val, maxval):
     # Auto is handled later, so we just return it back as is
     elif val == "auto":
         return val
-    elif type(val) == str:
+    elif isinstance(val, (str, dict, list)):
         return val
     elif val < minval and not cl_args.skip_checks:
         print(f'Warning: {var_name} is below {minval} - if you get bad results, consider adjusting.')
@@ -807,6 +874,20 @@ for setting_arg in cl_args.settings:
                 use_jpg = (settings_file['use_jpg'])
             if is_json_key_present(settings_file, 'render_mask'):
                 render_mask = (settings_file['render_mask'])
+            if is_json_key_present(settings_file, 'image_prompt_refresh_steps'):
+                image_prompt_refresh_steps = int(settings_file['image_prompt_refresh_steps'])
+            if is_json_key_present(settings_file, 'share_cut_batches'):
+                share_cut_batches = (settings_file['share_cut_batches'])
+            if is_json_key_present(settings_file, 'cut_pyramid'):
+                cut_pyramid = (settings_file['cut_pyramid'])
+            if is_json_key_present(settings_file, 'cut_memory_budget'):
+                cut_memory_budget = (settings_file['cut_memory_budget'])
+            if is_json_key_present(settings_file, 'guidance_workers'):
+                guidance_workers = int(settings_file['guidance_workers'])
+            if is_json_key_present(settings_file, 'mixed_precision'):
+                mixed_precision = (settings_file['mixed_precision'])
+            if is_json_key_present(settings_file, 'clip_checkpointing'):
+                clip_checkpointing = (settings_file['clip_checkpointing'])
 
     except Exception as e:
         print('Failed to open or parse ' + setting_arg + ' - Check formatting.')
@@ -903,97 +984,31 @@ else:
     useinit = False
 
 
-def val_interpolate(x1, y1, x2, y2, x):
-    # Linear interpolation. Return y between y1 and y2 for the same position x is bettewen x1 and x2
-    d = [[x1, y1], [x2, y2]]
-    output = d[0][1] + (x - d[0][0]) * ((d[1][1] - d[0][1])/(d[1][0] - d[0][0]))
-    if type(y1) == int:
-        output = int(output)  # return the proper type
-    return(output)
-
-
-def num_to_schedule(input, final=-9999):
-    # take a single number and turn it into a string-style schedule, with support for interpolated
-    if final != -9999:
-        output = (f"[{input}]*1+")
-        for i in range(1, 1000):
-            percent_done = i / 1000
-            val = val_interpolate(1, input, 1000, final, i)
-            output = output + (f"[{val}]*1+")
-        output = output[:-1]  # remove the final plus character
-    else:
-        output = (f'[{input}]*1000')
-    return(output)
-
-
 # Automatic Eta based on steps
 if eta == 'auto':
-    maxetasteps = 315
-    minetasteps = 50
-    maxeta = 1.0
-    mineta = 0.0
-    if steps > maxetasteps:
-        eta = maxeta
-    elif steps < minetasteps:
-        eta = mineta
-    else:
-        stepsrange = (maxetasteps - minetasteps)
-        newrange = (maxeta - mineta)
-        eta = (((steps - minetasteps) * newrange) / stepsrange) + mineta
-        eta = round(eta, 2)
-        print(f'Eta set automatically to: {eta}')
+    eta = auto_eta(steps)
+    print(f'Eta set automatically to: {eta}')
 
 # Automatic clamp_max based on steps
 if clamp_max == 'auto':
-    if steps <= 35:
-        clamp_max = 0.001
-    elif steps <= 75:
-        clamp_max = 0.0125
-    elif steps <= 150:
-        clamp_max = 0.02
-    elif steps <= 225:
-        clamp_max = 0.035
-    elif steps <= 300:
-        clamp_max = 0.05
-    elif steps <= 500:
-        clamp_max = 0.075
-    else:
-        clamp_max = 0.1
-    if use_secondary_model == False:
-        clamp_max = clamp_max * 2
-    clamp_max = num_to_schedule(clamp_max)
+    clamp_max = Schedule.constant(auto_clamp_max(steps, use_secondary_model))
     print(f'Clamp_max automatically set to {clamp_max}')
 elif type(clamp_max) != str:
-    clamp_max = num_to_schedule(clamp_max)
+    clamp_max = Schedule.parse(clamp_max)
     print(f'Converted clamp_max to schedule, new value is: {clamp_max}')
+else:
+    clamp_max = Schedule.parse(clamp_max)
 
 # Automatic clip_guidance_scale based on overall resolution
 if clip_guidance_scale == 'auto':
-    res = width_height[0] * width_height[1]  # total pixels
-    maxcgsres = 2000000
-    mincgsres = 250000
-    maxcgs = 50000
-    mincgs = 2500
-    if res > maxcgsres:
-        clip_guidance_scale = maxcgs
-    elif res < mincgsres:
-        clip_guidance_scale = mincgs
-    else:
-        resrange = (maxcgsres - mincgsres)
-        newrange = (maxcgs - mincgs)
-        clip_guidance_scale = (((res - mincgsres) * newrange) / resrange) + mincgs
-        clip_guidance_scale = round(clip_guidance_scale)
-    clip_guidance_scale = num_to_schedule(clip_guidance_scale)
+    clip_guidance_scale = Schedule.constant(auto_clip_guidance_scale(width_height[0], width_height[1]))
     print(f'clip_guidance_scale set automatically to: {clip_guidance_scale}')
 
 og_cutn_batches = cutn_batches
 if type(cutn_batches) != str:
-    if cutn_batches_final != None:
-        cutn_batches = num_to_schedule(cutn_batches, cutn_batches_final)
-    else:
-        cutn_batches = num_to_schedule(cutn_batches)
     print(f'Converted cutn_batches to schedule.')
-    logger.debug(f'cutn_batches schedule is: {cutn_batches}')
+cutn_batches = Schedule.parse(cutn_batches, cutn_batches_final)
+logger.debug(f'cutn_batches schedule is: {cutn_batches}')
 
 if cl_args.prompt:
     text_prompts["0"] = cl_args.prompt
@@ -1073,18 +1088,6 @@ def random_file(directory):
     return(file)
 
 
-def get_resampling_mode():
-    try:
-        from PIL import __version__, Image
-        major_ver = int(__version__.split('.')[0])
-        if major_ver >= 9:
-            return Image.Resampling.LANCZOS
-        else:
-            return Image.LANCZOS
-    except Exception as ex:
-        return 1  # 'Lanczos' irrespective of version.
-
-
 # Check for init randomizer in settings, and configure a random init if found
 init_image_OriginalPath = init_image
 if init_image != None:
@@ -1104,6 +1107,99 @@ if init_image != None:
             temp.save('temp_init.png')
             init_image = 'temp_init.png'
 
+if diffusion_model == 'random':
+    the_models = [
+        '256x256_diffusion_uncond',
+        '512x512_diffusion_uncond_finetune_008100',
+        '256x256_openai_comics_faces_by_alex_spirin',
+        'pixel_art_diffusion_hard_256',
+        'pixel_art_diffusion_soft_256',
+        'portrait_generator_v001',
+        'pixelartdiffusion4k',
+        'watercolordiffusion',
+        'watercolordiffusion_2',
+        'PulpSciFiDiffusion'
+    ]
+    diffusion_model = random.choice(the_models)
+    print(f'Random model selected is {diffusion_model}')
+
+# Map model parameter names to the load names
+model_load_name_map = {
+    'ViTB32': 'ViT-B/32',
+    'ViTB16': 'ViT-B/16',
+    'ViTL14': 'ViT-L/14',
+    'ViTL14_336': 'ViT-L/14@336px',
+    'RN50': 'RN50',
+    'RN50x4': 'RN50x4',
+    'RN50x16': 'RN50x16',
+    'RN50x64': 'RN50x64',
+    'RN101': 'RN101',
+    'ViTB32_laion2b_e16': 'ViTB32_laion2b_e16',
+    'ViTB32_laion400m_e31': 'ViTB32_laion400m_e31',
+    'ViTB32_laion400m_32': 'ViTB32_laion400m_32',
+    'ViTB32quickgelu_laion400m_e31': 'ViTB32quickgelu_laion400m_e31',
+    'ViTB32quickgelu_laion400m_e32': 'ViTB32quickgelu_laion400m_e32',
+    'ViTB16_laion400m_e31': 'ViTB16_laion400m_e31',
+    'ViTB16_laion400m_e32': 'ViTB16_laion400m_e32',
+    'RN50_yffcc15m': 'RN50_yffcc15m',
+    'RN50_cc12m': 'RN50_cc12m',
+    'RN50_quickgelu_yfcc15m': 'RN50_quickgelu_yfcc15m',
+    'RN50_quickgelu_cc12m': 'RN50_quickgelu_cc12m',
+    'RN101_yfcc15m': 'RN101_yfcc15m',
+    'RN101_quickgelu_yfcc15m': 'RN101_quickgelu_yfcc15m'
+}
+
+
+clip_modelname = [model_name for model_name in model_load_name_map.keys() if eval(model_name) > 0.0]
+clip_model_weights = [eval(model_name) for model_name in model_load_name_map.keys() if eval(model_name) > 0.0]
+
+# Get corrected sizes
+side_x = (width_height[0] // 64) * 64
+side_y = (width_height[1] // 64) * 64
+if side_x != width_height[0] or side_y != width_height[1]:
+    print(f'Changing output size to {side_x}x{side_y}. Dimensions must by multiples of 64.')
+
+# The estimate only needs the settings, so --estimate is answered before the heavy imports
+from helpers.vram_helpers import estimate_vram_requirements, format_bytes  # noqa: E402
+estimated_vram = estimate_vram_requirements(
+    side_x=side_x,
+    side_y=side_y,
+    cut_innercut=cut_innercut,
+    cut_overview=cut_overview,
+    clip_model_names=clip_modelname,
+    diffusion_model_name=diffusion_model,
+    use_secondary=use_secondary_model,
+    clip_checkpointing=clip_checkpointing
+)
+if cl_args.estimate:
+    from model_managers.diffusion_manager import read_diffusion_model
+    try:
+        read_diffusion_model(diffusion_model, False)
+    except Exception as e:
+        print('Unable to read diffusion_models.json - check formatting')
+        print(e)
+        quit()
+    print(f'Settings OK. Estimated peak VRAM use is {format_bytes(estimated_vram, include_byte_int=False)}.')
+    sys.exit(0)
+
+# Settings are parsed, so now it's worth paying for the heavy imports
+logger.debug(f'Startup: settings parsed after {time.perf_counter() - startup_time:.2f}s')
+import torch  # noqa: E402
+import torchvision.transforms.functional as TF  # noqa: E402
+from tqdm import tqdm  # noqa: E402
+from helpers.perlin import gen_perlin  # noqa: E402
+from model_managers.diffusion_manager import (  # noqa: E402
+    SECONDARY_MODEL_FILE,
+    SECONDARY_MODEL_SHA,
+    create_model_config,
+    download_models,
+    load_diffusion_model,
+    read_diffusion_model,
+    set_model_steps,
+)
+from model_managers.secondary_model import load_secondary_model  # noqa: E402
+from helpers.vram_helpers import track_model_vram, log_max_allocated  # noqa: E402
+
 # Decide if we're using CPU or GPU, with appropriate settings depending...
 if cl_args.cpu or not torch.cuda.is_available():
     DEVICE = torch.device('cpu')
@@ -1138,144 +1234,20 @@ def ease(num, t):
     return start + pow(t, power) * (end - start)
 
 
-def interp(t):
-    return 3 * t**2 - 2 * t**3
-
-
-def smooth_jazz(schedule):
-    # Take a list of numbers (i.e. an already-evaluated schedule),
-    # find the places where the number changes from one to the next, and smooth those transitions
-    newschedule = schedule
-    zone = int(len(schedule) * .05)  # We want to smooth a transition for 50 steps in a 1000 step scenario
-    markers = []
-    last_num = schedule[0]
-    # build a list of indicies of where the number changes
-    for i in range(1, len(schedule)):
-        current_num = schedule[i]
-        if current_num != last_num:
-            markers.append(i)
-        last_num = current_num
-    # now smooth out the surrounding numbers for any markers we have
-    lastindex = 0
-    if len(markers) > 0:
-        for index in markers:
-            if (index - lastindex) >= (zone / 2):  # only smooth if the indexes are far enough apart
-                start = int(index - (zone / 2))
-                if start < 1:
-                    start = 1  # make sure we stay within the range of the array
-                end = int(index + (zone / 2))
-                if end > len(schedule):
-                    end = len(schedule)  # make sure we stay within the range of the array
-                i = start
-                while i < end:
-                    newschedule[i] = val_interpolate(start, schedule[start], end, schedule[end], i)
-                    i += 1
-            lastindex = index
-    return(newschedule)
-
-
-def perlin(width, height, scale=10, device=None):
-    gx, gy = torch.randn(2, width + 1, height + 1, 1, 1, device=device)
-    xs = torch.linspace(0, 1, scale + 1)[:-1, None].to(device)
-    ys = torch.linspace(0, 1, scale + 1)[None, :-1].to(device)
-    wx = 1 - interp(xs)
-    wy = 1 - interp(ys)
-    dots = 0
-    dots += wx * wy * (gx[:-1, :-1] * xs + gy[:-1, :-1] * ys)
-    dots += (1 - wx) * wy * (-gx[1:, :-1] * (1 - xs) + gy[1:, :-1] * ys)
-    dots += wx * (1 - wy) * (gx[:-1, 1:] * xs - gy[:-1, 1:] * (1 - ys))
-    dots += (1 - wx) * (1 - wy) * (-gx[1:, 1:] * (1 - xs) - gy[1:, 1:] * (1 - ys))
-    return dots.permute(0, 2, 1, 3).contiguous().view(width * scale, height * scale)
-
-
-def perlin_ms(octaves, width, height, grayscale, device=device):
-    out_array = [0.5] if grayscale else [0.5, 0.5, 0.5]
-    # out_array = [0.0] if grayscale else [0.0, 0.0, 0.0]
-    for i in range(1 if grayscale else 3):
-        scale = 2**len(octaves)
-        oct_width = width
-        oct_height = height
-        for oct in octaves:
-            p = perlin(oct_width, oct_height, scale, device)
-            out_array[i] += p * oct
-            scale //= 2
-            oct_width *= 2
-            oct_height *= 2
-    return torch.cat(out_array)
-
-
-def create_perlin_noise(octaves=[1, 1, 1, 1], width=2, height=2, grayscale=True):
-    out = perlin_ms(octaves, width, height, grayscale)
-    if grayscale:
-        out = TF.resize(size=(side_y, side_x), img=out.unsqueeze(0))
-        out = TF.to_pil_image(out.clamp(0, 1)).convert('RGB')
-    else:
-        out = out.reshape(-1, 3, out.shape[0] // 3, out.shape[1])
-        out = TF.resize(size=(side_y, side_x), img=out)
-        out = TF.to_pil_image(out.clamp(0, 1).squeeze())
-
-    out = ImageOps.autocontrast(out)
-    return out
-
-
-def gen_perlin():
-    if perlin_mode == 'color':
-        init = create_perlin_noise([1.5**-i * 0.5 for i in range(12)], 1, 1, False)
-        init2 = create_perlin_noise([1.5**-i * 0.5 for i in range(8)], 4, 4, False)
-    elif perlin_mode == 'gray':
-        init = create_perlin_noise([1.5**-i * 0.5 for i in range(12)], 1, 1, True)
-        init2 = create_perlin_noise([1.5**-i * 0.5 for i in range(8)], 4, 4, True)
-    else:
-        init = create_perlin_noise([1.5**-i * 0.5 for i in range(12)], 1, 1, False)
-        init2 = create_perlin_noise([1.5**-i * 0.5 for i in range(8)], 4, 4, True)
-    init = TF.to_tensor(init).add(TF.to_tensor(init2)).div(2).to(device).unsqueeze(0).mul(2).sub(1)
-    del init2
-    return init.expand(batch_size, -1, -1, -1)
-
-
 def read_image_workaround(path):
     """OpenCV reads images as BGR, Pillow saves them as RGB. Work around
     this incompatibility to avoid colour inversions."""
+    import cv2
     im_tmp = cv2.imread(path)
     return cv2.cvtColor(im_tmp, cv2.COLOR_BGR2RGB)
 
 
-def spherical_dist_loss(x, y):
-    x = F.normalize(x, dim=-1)
-    y = F.normalize(y, dim=-1)
-    return (x - y).norm(dim=-1).div(2).arcsin().pow(2).mul(2)
-
-
-def tv_loss(input):
-    """L2 total variation loss, as in Mahendran et al."""
-    input = F.pad(input, (0, 1, 0, 1), 'replicate')
-    x_diff = input[..., :-1, 1:] - input[..., :-1, :-1]
-    y_diff = input[..., 1:, :-1] - input[..., :-1, :-1]
-    return (x_diff**2 + y_diff**2).mean([1, 2, 3])
-
-
-def range_loss(input):
-    return (input - input.clamp(-1, 1)).pow(2).mean([1, 2, 3])
-
-
-def symm_loss_v(im, lpm):
-    h = int(im.shape[3]/2)
-    h1, h2 = im[:, :, :, :h], im[:, :, :, h:]
-    h2 = TF.hflip(h2)
-    return lpm(h1, h2)
-
-
-def symm_loss_h(im, lpm):
-    w = int(im.shape[2]/2)
-    w1, w2 = im[:, :, :w, :], im[:, :, w:, :]
-    w2 = TF.vflip(w2)
-    return lpm(w1, w2)
-
-
 stop_on_next_loop = False  # Make sure GPU memory doesn't get corrupted from cancelling the run mid-way through, allow a full frame to complete
 scoreprompt = True
 actual_total_steps = steps
 actual_run_steps = 0
+first_step_logged = False
+final_outputs = []  # finished images, for the result cache
 
 
 def do_run(batch_num, slice_num=-1):
@@ -1302,6 +1274,7 @@ def do_run(batch_num, slice_num=-1):
                 print(f'angle: {angle}', f'zoom: {zoom}', f'translation_x: {translation_x}', f'translation_y: {translation_y}')
 
             if frame_num > 0:
+                import cv2
                 seed = seed + 1
                 if resume_run and frame_num == start_frame:
                     img_0 = cv2.imread(batchFolder + f"/{batch_name}({batchNum})_{start_frame-1:04}.png")
@@ -1350,8 +1323,6 @@ def do_run(batch_num, slice_num=-1):
         else:
             frame_prompt = []
 
-        # TODO: Image prompts are being fetched on every cut for every model, which is quite slow.
-        # We should get the image once and keep it in ram, reference it that way.
         if args.image_prompts_series is not None and frame_num >= len(
                 args.image_prompts_series):
             image_prompt = args.image_prompts_series[-1]
@@ -1368,6 +1339,8 @@ def do_run(batch_num, slice_num=-1):
 
         prev_sample_prompt = []
         prev_sample_image_prompt = []
+        # Image prompts are decoded once per run and their embeddings reused between steps
+        image_prompt_store = ImagePromptStore(device, side_x, side_y)
 
         def do_weights(s, clip_managers):
             nonlocal prev_sample_prompt
@@ -1419,7 +1392,9 @@ def do_run(batch_num, slice_num=-1):
                         side_y=side_y,
                         fuzzy_prompt=args.fuzzy_prompt,
                         fuzzy_prompt_rand_mag=args.rand_mag,
-                        cutout_skip_augs=args.skip_augs
+                        cutout_skip_augs=args.skip_augs,
+                        image_store=image_prompt_store,
+                        refresh_steps=args.image_prompt_refresh_steps
                     )
                     if clip_manager.prompt_embeds is not None:
                         clip_manager.prompt_embeds = torch.cat([img_prompt_embeds, clip_manager.prompt_embeds])
@@ -1464,83 +1439,27 @@ def do_run(batch_num, slice_num=-1):
             rmask = TF.to_tensor(rmask_img).to(device).unsqueeze(0)
 
         if (args.perlin_init == True) and (init_image == None):
-            init = gen_perlin()
+            init = gen_perlin(perlin_mode, side_x, side_y, device, batch_size)
 
         cur_t = None
+        guidance = Guidance(
+            diffusion,
+            model,
+            clip_managers,
+            args,
+            MakeCutoutsDango,
+            lpips_model,
+            secondary_model=secondary_model if use_secondary_model else None,
+            rmask=rmask,
+            cut_debug=cl_args.cut_debug
+        )
+        guidance.loss_values = loss_values
 
         def cond_fn(x, t, y=None):
-            with torch.enable_grad():
-                x_is_NaN = False
-                x = x.detach().requires_grad_()
-                n = x.shape[0]
-                if use_secondary_model is True:
-                    alpha = torch.tensor(diffusion.sqrt_alphas_cumprod[cur_t], device=device, dtype=torch.float32)
-                    sigma = torch.tensor(diffusion.sqrt_one_minus_alphas_cumprod[cur_t], device=device, dtype=torch.float32)
-                    cosine_t = alpha_sigma_to_t(alpha, sigma)
-                    out = secondary_model(x, cosine_t[None].repeat([n])).pred
-                    fac = diffusion.sqrt_one_minus_alphas_cumprod[cur_t]
-                    x_in = out * fac + x * (1 - fac)
-                    x_in_grad = torch.zeros_like(x_in)
-                else:
-                    my_t = torch.ones([n], device=device, dtype=torch.long) * cur_t
-                    out = diffusion.p_mean_variance(model,  x, my_t, clip_denoised=False, model_kwargs={'y': y})
-                    fac = diffusion.sqrt_one_minus_alphas_cumprod[cur_t]
-                    x_in = out['pred_xstart'] * fac + x * (1 - fac)
-                    x_in_grad = torch.zeros_like(x_in)
-
-                for clip_manager in clip_managers:
-                    t_int = int(t.item()) + 1
-                    for _ in range(args.cutn_batches[1000 - t_int]):
-                        clip_losses = clip_manager.get_cut_batch_losses(
-                            x_in,
-                            n,
-                            args.cut_overview,
-                            args.cut_innercut,
-                            args.cut_ic_pow,
-                            args.cut_icgray_p,
-                            t_int,
-                            MakeCutoutsDango,
-                            cl_args.cut_debug
-                        )
-                        loss_values.append(clip_losses.sum().item())  # log loss, probably shouldn't do per cutn_batch
-                        #factor in render_mask
-                        prompt_grad = torch.autograd.grad(clip_losses.sum() * args.clip_guidance_scale[1000 - t_int], x_in)[0] / args.cutn_batches[1000 - t_int]
-                        if rmask != None:
-                            x_in_grad += rmask.mul(prompt_grad)
-                        else:
-                            x_in_grad += prompt_grad
-
-                tv_losses = tv_loss(x_in)
-                if use_secondary_model is True:
-                    range_losses = range_loss(out)
-                else:
-                    range_losses = range_loss(out['pred_xstart'])
-                sat_losses = torch.abs(x_in - x_in.clamp(min=-1, max=1)).mean()
-                logger.debug(f"tv_loss: {tv_losses.sum()}")
-                logger.debug(f"range_loss: {range_losses.sum()}")
-                logger.debug(f"sat_loss: {sat_losses.sum()}")
-                loss = tv_losses.sum() * tv_scale + range_losses.sum() * range_scale + sat_losses.sum() * sat_scale
-                if init is not None and args.init_scale:
-                    init_losses = lpips_model(x_in, init)
-                    loss = loss + init_losses.sum() * args.init_scale
-                if args.symmetry_loss_v and actual_run_steps <= args.symm_switch:
-                    sloss = symm_loss_v(x_in, lpips_model)
-                    loss = loss + sloss.sum() * args.sloss_scale
-                if args.symmetry_loss_h and actual_run_steps <= args.symm_switch:
-                    sloss = symm_loss_h(x_in, lpips_model)
-                    loss = loss + sloss.sum() * args.sloss_scale
-                x_in_grad += torch.autograd.grad(loss, x_in)[0]
-                if torch.isnan(x_in_grad).any() == False:
-                    grad = -torch.autograd.grad(x_in, x, x_in_grad)[0]
-                else:
-                    # print("NaN'd")
-                    x_is_NaN = True
-                    grad = torch.zeros_like(x)
-            if args.clamp_grad and x_is_NaN == False:
-                magnitude = grad.square().mean().sqrt()
-
-                return grad * magnitude.clamp(max=args.clamp_max[1000 - t_int]) / magnitude
-            return grad
+            guidance.cur_t = cur_t
+            guidance.run_step = actual_run_steps
+            guidance.init = init
+            return guidance.cond_fn(x, t, y)
 
         if args.sampling_mode == 'ddim':
             sample_fn = diffusion.ddim_sample_loop_progressive
@@ -1557,12 +1476,13 @@ def do_run(batch_num, slice_num=-1):
         cur_t = diffusion.num_timesteps - skip_steps - 1
         global actual_total_steps
         global actual_run_steps
+        global first_step_logged
         actual_run_steps = skip_steps
         total_steps = cur_t
         logger.debug(f'cur_t at start of image is {cur_t} and diffusion.num_timesteps is {diffusion.num_timesteps}')
 
         if (args.perlin_init == True) and (init_image == None):
-            init = gen_perlin()
+            init = gen_perlin(perlin_mode, side_x, side_y, device, batch_size)
         else:
             init = starting_init  # make sure we return to a baseline for each image in a batch
 
@@ -1603,9 +1523,12 @@ def do_run(batch_num, slice_num=-1):
         else:
             progressBar.set_description(f'Image {batch_num + 1} of {n_batches}: ')
         while cur_t >= stop_early:
-            samples = do_sample_fn(init, steps - cur_t - 1)
+            samples = mixed_precision_iter(do_sample_fn(init, steps - cur_t - 1), device, args.mixed_precision)
             for j, sample in enumerate(samples):
                 actual_run_steps += 1
+                if not first_step_logged:
+                    logger.debug(f'Startup: first step finished after {time.perf_counter() - startup_time:.2f}s')
+                    first_step_logged = True
                 progressBar.n = actual_run_steps
                 progressBar.refresh()
                 cur_t -= 1
@@ -1776,11 +1699,12 @@ def do_run(batch_num, slice_num=-1):
 
                 if (cur_t == -1):
                     break
-        progressBar.close()            
+        progressBar.close()
+        guidance.close()
 
 
-def save_settings():
-    setting_list = {
+def get_settings():
+    return {
         'batch_name': batch_name,
         'text_prompts': text_prompts,
         'n_batches': n_batches,
@@ -1791,7 +1715,7 @@ def save_settings():
         'height': int(width_height[1] / width_height_scale),
         'set_seed': seed,
         'image_prompts': image_prompts,
-        'clip_guidance_scale': clip_guidance_scale,
+        'clip_guidance_scale': clip_guidance_scale.to_json(),
         'tv_scale': tv_scale,
         'range_scale': range_scale,
         'sat_scale': sat_scale,
@@ -1814,7 +1738,7 @@ def save_settings():
         'randomize_class': randomize_class,
         'clip_denoised': clip_denoised,
         'clamp_grad': clamp_grad,
-        'clamp_max': clamp_max,
+        'clamp_max': clamp_max.to_json(),
         'fuzzy_prompt': fuzzy_prompt,
         'rand_mag': rand_mag,
         'eta': eta,
@@ -1844,11 +1768,11 @@ def save_settings():
         'RN50_quickgelu_cc12m': RN50_quickgelu_cc12m,
         'RN101_yfcc15m': RN101_yfcc15m,
         'RN101_quickgelu_yfcc15m': RN101_quickgelu_yfcc15m,
-        'cut_overview': str(cut_overview),
-        'cut_innercut': str(cut_innercut),
+        'cut_overview': Schedule.parse(cut_overview).to_json(),
+        'cut_innercut': Schedule.parse(cut_innercut).to_json(),
         'cut_ic_pow': og_cut_ic_pow,
         'cut_ic_pow_final': cut_ic_pow_final,
-        'cut_icgray_p': str(cut_icgray_p),
+        'cut_icgray_p': Schedule.parse(cut_icgray_p).to_json(),
         'smooth_schedules': smooth_schedules,
         'animation_mode': animation_mode,
         'key_frames': key_frames,
@@ -1884,178 +1808,46 @@ def save_settings():
         'symmetry_loss_h': symmetry_loss_h,
         'sloss_scale': symm_loss_scale,
         'symm_switch': symm_switch,
+        'image_prompt_refresh_steps': image_prompt_refresh_steps,
+        'share_cut_batches': share_cut_batches,
+        'cut_pyramid': cut_pyramid,
+        'cut_memory_budget': cut_memory_budget,
+        'guidance_workers': guidance_workers,
+        'mixed_precision': mixed_precision,
+        'clip_checkpointing': clip_checkpointing,
     }
-    with open(f"{batchFolder}/{batch_name}_{batchNum}_settings.json",  "w+", encoding="utf-8") as f:  # save settings
-        json.dump(setting_list, f, ensure_ascii=False, indent=4)
-
-
-# @title 2.3 Define the secondary diffusion model
-
 
-def append_dims(x, n):
-    return x[(Ellipsis, *(None, ) * (n - x.ndim))]
 
+def next_batch_num(batchFolder, batch_name):
+    # take the highest numbered settings file + 1
+    filenums = []
+    for file in os.listdir(batchFolder):
+        if batch_name in file and ".json" in file:
+            start = file.index('_')
+            end = file.index('_', start+1)
+            filenum = int(file[(start + 1):end])
+            filenums.append(filenum)
+    if not filenums:
+        return 0
+    return max(filenums) + 1
 
-def expand_to_planes(x, shape):
-    return append_dims(x, len(shape)).repeat([1, 1, *shape[2:]])
-
-
-def alpha_sigma_to_t(alpha, sigma):
-    return torch.atan2(sigma, alpha) * 2 / math.pi
-
-
-def t_to_alpha_sigma(t):
-    return torch.cos(t * math.pi / 2), torch.sin(t * math.pi / 2)
-
-
-@dataclass
-class DiffusionOutput:
-    v: torch.Tensor
-    pred: torch.Tensor
-    eps: torch.Tensor
-
-
-class ConvBlock(nn.Sequential):
-    def __init__(self, c_in, c_out):
-        super().__init__(nn.Conv2d(c_in, c_out, 3, padding=1),  nn.ReLU(inplace=True))
-
-
-class SkipBlock(nn.Module):
-    def __init__(self, main, skip=None):
-        super().__init__()
-        self.main = nn.Sequential(*main)
-        self.skip = skip if skip else nn.Identity()
-
-    def forward(self, input):
-        return torch.cat([self.main(input), self.skip(input)], dim=1)
-
-
-class FourierFeatures(nn.Module):
-    def __init__(self, in_features, out_features, std=1.):
-        super().__init__()
-        assert out_features % 2 == 0
-        self.weight = nn.Parameter(torch.randn([out_features // 2, in_features]) * std)
-
-    def forward(self, input):
-        f = 2 * math.pi * input @ self.weight.T
-        return torch.cat([f.cos(), f.sin()], dim=-1)
-
-
-class SecondaryDiffusionImageNet(nn.Module):
-    def __init__(self):
-        super().__init__()
-        c = 64  # The base channel count
-
-        self.timestep_embed = FourierFeatures(1, 16)
 
-        self.net = nn.Sequential(
-            ConvBlock(3 + 16, c),
-            ConvBlock(c, c),
-            SkipBlock([
-                nn.AvgPool2d(2),
-                ConvBlock(c, c * 2),
-                ConvBlock(c * 2, c * 2),
-                SkipBlock([
-                    nn.AvgPool2d(2),
-                    ConvBlock(c * 2, c * 4),
-                    ConvBlock(c * 4, c * 4),
-                    SkipBlock([
-                        nn.AvgPool2d(2),
-                        ConvBlock(c * 4, c * 8),
-                        ConvBlock(c * 8, c * 4),
-                        nn.Upsample(scale_factor=2,
-                                    mode='bilinear',
-                                    align_corners=False),
-                    ]),
-                    ConvBlock(c * 8, c * 4),
-                    ConvBlock(c * 4, c * 2),
-                    nn.Upsample(scale_factor=2,
-                                mode='bilinear',
-                                align_corners=False),
-                ]),
-                ConvBlock(c * 4, c * 2),
-                ConvBlock(c * 2, c),
-                nn.Upsample(scale_factor=2,
-                            mode='bilinear',
-                            align_corners=False),
-            ]),
-            ConvBlock(c * 2, c),
-            nn.Conv2d(c, 3, 3, padding=1),
-        )
+def final_output_names(batch_image, batch_num):
+    # The finished image(s) of one batch item, named as do_run and gobig save them, leaving out gobig's slices and
+    # the image it started from
+    if letsgobig:
+        gpu = f'{cl_args.cuda}_' if cl_args.cuda != '0' else ''
+        return [f'{batch_name}_go_big_{gpu}{batch_num}_{batch_image}.png']
+    filename = f'{batch_name}_{batch_num}_{batch_image}.{"jpg" if use_jpg else "png"}'
+    if cl_args.esrgan:
+        return [filename, f'ESRGAN-{filename}']
+    return [filename]
 
-    def forward(self, input, t):
-        timestep_embed = expand_to_planes(self.timestep_embed(t[:, None]), input.shape)
-        v = self.net(torch.cat([input, timestep_embed], dim=1))
-        alphas, sigmas = map(partial(append_dims, n=v.ndim), t_to_alpha_sigma(t))
-        pred = input * alphas - v * sigmas
-        eps = input * sigmas + v * alphas
-        return DiffusionOutput(v, pred, eps)
-
-
-class SecondaryDiffusionImageNet2(nn.Module):
-    def __init__(self):
-        super().__init__()
-        c = 64  # The base channel count
-        cs = [c, c * 2, c * 2, c * 4, c * 4, c * 8]
-
-        self.timestep_embed = FourierFeatures(1, 16)
-        self.down = nn.AvgPool2d(2)
-        self.up = nn.Upsample(scale_factor=2, mode='bilinear', align_corners=False)
-
-        self.net = nn.Sequential(
-            ConvBlock(3 + 16, cs[0]),
-            ConvBlock(cs[0], cs[0]),
-            SkipBlock([
-                self.down,
-                ConvBlock(cs[0], cs[1]),
-                ConvBlock(cs[1], cs[1]),
-                SkipBlock([
-                    self.down,
-                    ConvBlock(cs[1], cs[2]),
-                    ConvBlock(cs[2], cs[2]),
-                    SkipBlock([
-                        self.down,
-                        ConvBlock(cs[2], cs[3]),
-                        ConvBlock(cs[3], cs[3]),
-                        SkipBlock([
-                            self.down,
-                            ConvBlock(cs[3], cs[4]),
-                            ConvBlock(cs[4], cs[4]),
-                            SkipBlock([
-                                self.down,
-                                ConvBlock(cs[4], cs[5]),
-                                ConvBlock(cs[5], cs[5]),
-                                ConvBlock(cs[5], cs[5]),
-                                ConvBlock(cs[5], cs[4]),
-                                self.up,
-                            ]),
-                            ConvBlock(cs[4] * 2, cs[4]),
-                            ConvBlock(cs[4], cs[3]),
-                            self.up,
-                        ]),
-                        ConvBlock(cs[3] * 2, cs[3]),
-                        ConvBlock(cs[3], cs[2]),
-                        self.up,
-                    ]),
-                    ConvBlock(cs[2] * 2, cs[2]),
-                    ConvBlock(cs[2], cs[1]),
-                    self.up,
-                ]),
-                ConvBlock(cs[1] * 2, cs[1]),
-                ConvBlock(cs[1], cs[0]),
-                self.up,
-            ]),
-            ConvBlock(cs[0] * 2, cs[0]),
-            nn.Conv2d(cs[0], 3, 3, padding=1),
-        )
 
-    def forward(self, input, t):
-        timestep_embed = expand_to_planes(self.timestep_embed(t[:, None]), input.shape)
-        v = self.net(torch.cat([input, timestep_embed], dim=1))
-        alphas, sigmas = map(partial(append_dims, n=v.ndim),  t_to_alpha_sigma(t))
-        pred = input * alphas - v * sigmas
-        eps = input * sigmas + v * alphas
-        return DiffusionOutput(v, pred, eps)
+def save_settings():
+    setting_list = get_settings()
+    with open(f"{batchFolder}/{batch_name}_{batchNum}_settings.json",  "w+", encoding="utf-8") as f:  # save settings
+        json.dump(setting_list, f, ensure_ascii=False, indent=4)
 
 
 timestep_respacing = '50'  # param ['25','50','100','150','250','500','1000','ddim25','ddim50', 'ddim75', 'ddim100','ddim150','ddim250','ddim500','ddim1000']
@@ -2065,219 +1857,115 @@ other_sampling_mode = 'bicubic'
 check_model_SHA = False  # @param{type:"boolean"}
 
 # TODO: Chance this to use any available model in the JSON file
-if diffusion_model == 'random':
-    the_models = [
-        '256x256_diffusion_uncond',
-        '512x512_diffusion_uncond_finetune_008100',
-        '256x256_openai_comics_faces_by_alex_spirin',
-        'pixel_art_diffusion_hard_256',
-        'pixel_art_diffusion_soft_256',
-        'portrait_generator_v001',
-        'pixelartdiffusion4k',
-        'watercolordiffusion',
-        'watercolordiffusion_2',
-        'PulpSciFiDiffusion'
-    ]
-    diffusion_model = random.choice(the_models)
-    print(f'Random model selected is {diffusion_model}')
-
-
-@dataclass
-class Diff_Model:
-    def __init__(self):
-        pass
-    name: str
-    SHA: str
-    plink: str
-    path: str
-    attention_resolutions: str
-    class_cond: bool
-    rescale_timesteps: bool
-    image_size: int
-    learn_sigma: bool
-    noise_schedule: str
-    num_channels: int
-    num_res_blocks: int
-    resblock_updown: bool
-    use_scale_shift_norm: bool
-    timestep_respacing: str
-    use_fp16: bool
-    num_head_channels: int = -1
-    num_heads: int = 1
-    slink: str = "none"
-
 
 try:
-    with open('diffusion_models.json', 'r', encoding="utf-8") as json_file:
-        print(f'Loading diffusion model details from diffusion_models.json')
-        user_supplied_name = diffusion_model
-        print(f'Using Diffusion Model: {user_supplied_name}')
-        diffusion_models_file = json.load(json_file)
-        if user_supplied_name in diffusion_models_file:
-            diffusion_model = Diff_Model()
-            diffusion_model.name = user_supplied_name
-            diffusion_model.SHA = diffusion_models_file[user_supplied_name]['SHA']
-            diffusion_model.plink = diffusion_models_file[user_supplied_name]['primary_link']
-            if is_json_key_present(settings_file, user_supplied_name, 'secondary_link'):
-                diffusion_model.slink = diffusion_models_file[user_supplied_name]['secondary_link']
-            diffusion_model.path = diffusion_models_file[user_supplied_name]['file_name']
-            diffusion_model.attention_resolutions = diffusion_models_file[user_supplied_name]['attention_resolutions']
-            diffusion_model.class_cond = diffusion_models_file[user_supplied_name]['class_cond']
-            diffusion_model.rescale_timesteps = diffusion_models_file[user_supplied_name]['rescale_timesteps']
-            diffusion_model.image_size = diffusion_models_file[user_supplied_name]['image_size']
-            diffusion_model.learn_sigma = diffusion_models_file[user_supplied_name]['learn_sigma']
-            diffusion_model.noise_schedule = diffusion_models_file[user_supplied_name]['noise_schedule']
-            diffusion_model.num_channels = diffusion_models_file[user_supplied_name]['num_channels']
-            if is_json_key_present(diffusion_models_file, user_supplied_name, 'num_head_channels'):
-                diffusion_model.num_head_channels = diffusion_models_file[user_supplied_name]['num_head_channels']
-            diffusion_model.num_heads = diffusion_models_file[user_supplied_name]['num_heads']
-            diffusion_model.num_res_blocks = diffusion_models_file[user_supplied_name]['num_res_blocks']
-            diffusion_model.resblock_updown = diffusion_models_file[user_supplied_name]['resblock_updown']
-            diffusion_model.use_scale_shift_norm = diffusion_models_file[user_supplied_name]['use_scale_shift_norm']
-            if is_json_key_present(diffusion_models_file, user_supplied_name, 'use_fp16'):
-                if fp16_mode == True:
-                    diffusion_model.use_fp16 = diffusion_models_file[user_supplied_name]['use_fp16']
-                else:
-                    diffusion_model.use_fp16 = False # Can't use fp16 when in CPU mode
-            if is_json_key_present(diffusion_models_file, user_supplied_name, 'timestep_respacing'):
-                diffusion_model.timestep_respacing = diffusion_models_file[user_supplied_name]['timestep_respacing']
-            else:
-                diffusion_model.timestep_respacing = timestep_respacing
+    print(f'Loading diffusion model details from diffusion_models.json')
+    print(f'Using Diffusion Model: {diffusion_model}')
+    diffusion_model = read_diffusion_model(diffusion_model, fp16_mode, timestep_respacing)
 except Exception as e:
     print('Unable to read diffusion_models.json - check formatting')
     print(e)
     quit()
 
+model_config = create_model_config(diffusion_model, diffusion_steps, use_checkpoint)
 
-def download_models(diffusion_model, use_secondary_model):
-    model_downloaded = False
-    model_secondary_downloaded = False
-    model_file = f'{model_path}/{diffusion_model.path}'
-    model_secondary_SHA = '983e3de6f95c88c81b2ca7ebb2c217933be1973b1ff058776b970f901584613a'
-    model_secondary_link = 'https://the-eye.eu/public/AI/models/v-diffusion/secondary_model_imagenet_2.pth'
-    model_secondary_link_fb = 'https://www.dropbox.com/s/luv4fezod3r8d2n/secondary_model_imagenet_2.pth'
-    model_secondary_path = f'{model_path}/secondary_model_imagenet_2.pth'
-
-    if os.path.exists(model_file):
-        model_downloaded = True
-        if check_model_SHA:
-            print(f'Checking SHA for {diffusion_model.name}')
-            with open(model_file, "rb") as f:
-                bytes = f.read()
-                hash = hashlib.sha256(bytes).hexdigest()
-            if hash != diffusion_model.SHA:
-                print('SHA does not match. Redownloading...')
-                model_downloaded = False
-
-    if model_downloaded == False:
-        print(f'{diffusion_model.name} Model downloading. This may take a while...')
-        urllib.request.urlretrieve(diffusion_model.plink, model_file)
-        if os.path.exists(model_file):
-            model_downloaded = True
-        else:
-            print('First URL failed, using backup if available')
-            if diffusion_model.slink != "none":
-                urllib.request.urlretrieve(diffusion_model.slink, model_file)
-            if os.path.exists(model_file):
-                model_downloaded = True
-
-    if model_downloaded == False:
-        print('Unable to download the diffusion model.')
-        print('Please check your diffusion_models.json file for proper formatting,')
-        print('Or check the Prog Rock Diffusion github for updated links.')
-        quit()
+model_default = model_config['image_size']
 
-    if os.path.exists(model_secondary_path):
-        model_secondary_downloaded = True
-        if check_model_SHA:
-            print(f'Checking SHA for Secondary Model')
-            with open(model_secondary_path, "rb") as f:
-                bytes = f.read()
-                hash = hashlib.sha256(bytes).hexdigest()
-            if hash != model_secondary_SHA:
-                print('SHA does not match. Redownloading...')
-                model_secondary_downloaded = False
-
-    if model_secondary_downloaded == False:
-        print(f'Secondary Model downloading. This may take a while...')
-        urllib.request.urlretrieve(model_secondary_link, model_secondary_path)
-        if os.path.exists(model_secondary_path):
-            model_secondary_downloaded = True
-        else:
-            print('First URL failed, using backup if available')
-            urllib.request.urlretrieve(model_secondary_link_fb, model_secondary_path)
-            if os.path.exists(model_secondary_path):
-                model_secondary_downloaded = True
-
-    if model_secondary_downloaded == False:
-        print('Unable to download the secondary diffusion model.')
-        print('Please check the Prog Rock Diffusion github for a possible updated version with new links.')
-        quit()
+def load_lpips_model(net: str = 'vgg'):
+    import lpips
+    with track_model_vram(device, "LPIPS model"):
+        lpips_model = lpips.LPIPS(net=net, verbose=False).to(device)
+    return lpips_model
 
 
-download_models(diffusion_model, use_secondary_model)
+createPath(initDirPath)
+createPath(outDirPath)
+createPath(model_path)
 
-model_config = model_and_diffusion_defaults()
-model_config.update({
-    'attention_resolutions': diffusion_model.attention_resolutions,
-    'class_cond': diffusion_model.class_cond,
-    'diffusion_steps': diffusion_steps,
-    'rescale_timesteps': diffusion_model.rescale_timesteps,
-    'timestep_respacing': diffusion_model.timestep_respacing,
-    'image_size': diffusion_model.image_size,
-    'learn_sigma': diffusion_model.learn_sigma,
-    'noise_schedule': diffusion_model.noise_schedule,
-    'num_channels': diffusion_model.num_channels,
-    'num_head_channels': diffusion_model.num_head_channels,
-    'num_heads': diffusion_model.num_heads,
-    'num_res_blocks': diffusion_model.num_res_blocks,
-    'resblock_updown': diffusion_model.resblock_updown,
-    'use_checkpoint': use_checkpoint,
-    'use_fp16': diffusion_model.use_fp16,
-    'use_scale_shift_norm': diffusion_model.use_scale_shift_norm,
-})
+# Update Model Settings
+set_model_steps(model_config, steps)
+timestep_respacing = model_config['timestep_respacing']
+diffusion_steps = model_config['diffusion_steps']
 
-model_default = model_config['image_size']
+if set_seed == 'random_seed':
+    random.seed()
+    seed = random.randint(0, 2**32)
+    # print(f'Using seed: {seed}')
+else:
+    seed = int(set_seed)
 
-def load_secondary_model():
-    with track_model_vram(device, "secondary model"):
-        secondary_model = SecondaryDiffusionImageNet2()
-        secondary_model.load_state_dict(torch.load(f'{model_path}/secondary_model_imagenet_2.pth', map_location='cpu'))
-        secondary_model.eval().requires_grad_(False).to(device)
-    return secondary_model
+# convert old number-style settings to new scheduled settings
+og_cut_ic_pow = cut_ic_pow
+cut_ic_pow = Schedule.parse(cut_ic_pow, cut_ic_pow_final)
+clip_guidance_scale = Schedule.parse(clip_guidance_scale)
 
-def load_lpips_model(net: str = 'vgg'):
-    with track_model_vram(device, "LPIPS model"):
-        lpips_model = lpips.LPIPS(net=net, verbose=False).to(device)
-    return lpips_model
+print(f'Using seed {seed}')
 
+# With a fixed seed the render is deterministic, so a finished render of the same settings can be reused
+result_cache = None
+result_key = None
+if cl_args.result_cache and set_seed != 'random_seed' and animation_mode == "None":
+    from helpers.result_cache import ResultCache, file_digest, prompt_file_digests
+    result_cache = ResultCache(
+        f'{root_path}/result_cache',
+        max_bytes=cl_args.result_cache_mb * 1024 * 1024,
+        policy=cl_args.result_cache_policy
+    )
+    model_checksums = {
+        'diffusion_model': diffusion_model.SHA,
+        'secondary_model': SECONDARY_MODEL_SHA if use_secondary_model else None,
+        'init_image': file_digest(init_image),
+        'render_mask': file_digest(render_mask),
+        'image_prompts': prompt_file_digests(image_prompts),
+        'gobig': [letsgobig, cl_args.gobig_slices, file_digest(cl_args.gobiginit)],
+    }
+    # How the run is done changes the pixels too: a CPU int8 render isn't a full precision GPU one
+    run_options = {
+        'device': device.type,
+        'fp16': fp16_mode,
+        'cpu_quantize': cl_args.cpu_quantize,
+        'mixed_precision': mixed_precision,
+        'esrgan': cl_args.esrgan,
+    }
+    result_key = ResultCache.fingerprint(get_settings(), model_checksums, seed, run_options)
+    cached_images = result_cache.get(result_key)
+    if cached_images:
+        batchFolder = f'{outDirPath}/{batch_name}'
+        createPath(batchFolder)
+        batch_name = batch_name.replace('_', '-')
+        batchNum = next_batch_num(batchFolder, batch_name)
+        # Written under the names a fresh run would give them
+        output_names = [name for batch_image in range(n_batches) for name in final_output_names(batch_image, batchNum)]
+        if len(output_names) == len(cached_images):
+            for cached_image, name in zip(cached_images, output_names):
+                shutil.copyfile(cached_image, f'{batchFolder}/{name}')
+            save_settings()
+            print(f'These settings were rendered before, so the result was taken from the cache: {", ".join(output_names)} in {batchFolder}')
+            sys.exit(0)
 
-# Map model parameter names to the load names
-model_load_name_map = {
-    'ViTB32': 'ViT-B/32',
-    'ViTB16': 'ViT-B/16',
-    'ViTL14': 'ViT-L/14',
-    'ViTL14_336': 'ViT-L/14@336px',
-    'RN50': 'RN50',
-    'RN50x4': 'RN50x4',
-    'RN50x16': 'RN50x16',
-    'RN50x64': 'RN50x64',
-    'RN101': 'RN101',
-    'ViTB32_laion2b_e16': 'ViTB32_laion2b_e16',
-    'ViTB32_laion400m_e31': 'ViTB32_laion400m_e31',
-    'ViTB32_laion400m_32': 'ViTB32_laion400m_32',
-    'ViTB32quickgelu_laion400m_e31': 'ViTB32quickgelu_laion400m_e31',
-    'ViTB32quickgelu_laion400m_e32': 'ViTB32quickgelu_laion400m_e32',
-    'ViTB16_laion400m_e31': 'ViTB16_laion400m_e31',
-    'ViTB16_laion400m_e32': 'ViTB16_laion400m_e32',
-    'RN50_yffcc15m': 'RN50_yffcc15m',
-    'RN50_cc12m': 'RN50_cc12m',
-    'RN50_quickgelu_yfcc15m': 'RN50_quickgelu_yfcc15m',
-    'RN50_quickgelu_cc12m': 'RN50_quickgelu_cc12m',
-    'RN101_yfcc15m': 'RN101_yfcc15m',
-    'RN101_quickgelu_yfcc15m': 'RN101_quickgelu_yfcc15m'
-}
+try:
+    download_models(diffusion_model, model_path, check_model_SHA)
+except RuntimeError as e:
+    print(e)
+    quit()
+
+from cut_modules.make_cutouts import MakeCutoutsDango  # noqa: E402
+from model_managers.clip_manager import ClipManager, ImagePromptStore, CLIP_NAME_MAP  # noqa: E402
+from model_managers.embedding_store import EmbeddingStore  # noqa: E402
+from model_managers.weight_cache import WeightCache  # noqa: E402
+from engine.guidance import Guidance  # noqa: E402
+from helpers.precision import mixed_precision_iter  # noqa: E402
+
+embedding_store = None
+if cl_args.embedding_store:
+    embedding_store = EmbeddingStore(
+        f'{model_path}/embeddings',
+        max_bytes=cl_args.embedding_store_mb * 1024 * 1024
+    )
 
+weight_cache = None
+if cl_args.weight_cache:
+    weight_cache = WeightCache(f'{model_path}/weight_cache')
 
 clip_managers = [
     ClipManager(
@@ -2285,47 +1973,24 @@ clip_managers = [
         cut_count_multiplier=eval(model_name),
         device=device,
         use_cut_heatmap=True,
-        pad_inner_cuts=True
+        pad_inner_cuts=True,
+        embedding_store=embedding_store,
+        quantize=cl_args.cpu_quantize,
+        weight_cache=weight_cache
     )
     for model_name in CLIP_NAME_MAP.keys() if eval(model_name)
 ]
 
-clip_modelname = [model_name for model_name in model_load_name_map.keys() if eval(model_name) > 0.0]
-clip_model_weights = [eval(model_name) for model_name in model_load_name_map.keys() if eval(model_name) > 0.0]
-
-# Get corrected sizes
-side_x = (width_height[0] // 64) * 64
-side_y = (width_height[1] // 64) * 64
-if side_x != width_height[0] or side_y != width_height[1]:
-    print(f'Changing output size to {side_x}x{side_y}. Dimensions must by multiples of 64.')
-
-estimate_vram_requirements(
-    side_x=side_x,
-    side_y=side_y,
-    cut_innercut=cut_innercut,
-    cut_overview=cut_overview,
-    clip_model_names=clip_modelname,
-    diffusion_model_name=diffusion_model.name,
-    use_secondary=use_secondary_model,
-    device=device
-)
 lpips_model = load_lpips_model()
+secondary_model = None
 if use_secondary_model:
-    secondary_model = load_secondary_model()
+    secondary_model = load_secondary_model(f'{model_path}/{SECONDARY_MODEL_FILE}', device)
 
 print('\nLoading CLIP Models:\n')
 # Load the CLIP models
 for clip_manager in clip_managers:
     clip_manager.load()
 
-# Update Model Settings
-timestep_respacing = f'ddim{steps}'
-diffusion_steps = (1000 // steps) * steps if steps < 1000 else steps
-model_config.update({
-    'timestep_respacing': timestep_respacing,
-    'diffusion_steps': diffusion_steps,
-})
-
 # Make folder for batch
 batchFolder = f'{outDirPath}/{batch_name}'
 createPath(batchFolder)
@@ -2451,6 +2116,7 @@ def get_inbetweens(key_frames, integer=False):
     4    6
     dtype: int64
     """
+    import pandas as pd
     key_frame_series = pd.Series([np.nan for a in range(max_frames)])
 
     for i, value in key_frames.items():
@@ -2650,41 +2316,10 @@ else:
     start_frame = 0
     #batchNum = len(glob(batchFolder + "/*.json"))
     # changing old naming method -- intstead of counting files, take the highest numbered file + 1
-    files = os.listdir(batchFolder)
-    count = 0
-    filenums = []
-    for file in files:
-        if batch_name in file and ".json" in file:
-            start = file.index('_')
-            end = file.index('_', start+1)
-            filenum = int(file[(start + 1):end])
-            filenums.append(filenum)
-    if not filenums:
-        batchNum = 0
-    else:
-        batchNum = max(filenums) + 1
+    batchNum = next_batch_num(batchFolder, batch_name)
 
 print(f'\nStarting Run: {batch_name}({batchNum}) at frame {start_frame}')
 
-if set_seed == 'random_seed':
-    random.seed()
-    seed = random.randint(0, 2**32)
-    # print(f'Using seed: {seed}')
-else:
-    seed = int(set_seed)
-
-# convert old number-style settings to new scheduled settings
-og_cut_ic_pow = cut_ic_pow
-if type(cut_ic_pow) != str:
-    if type(cut_ic_pow_final) != type(None):
-        cut_ic_pow = num_to_schedule(cut_ic_pow, cut_ic_pow_final)
-    else:
-        cut_ic_pow = num_to_schedule(cut_ic_pow)
-
-if type(clip_guidance_scale) != str:
-    clip_guidance_scale = num_to_schedule(clip_guidance_scale)
-
-print(f'Using seed {seed}')
 
 
 # Leave this section alone, it takes all our settings and puts them in one variable dictionary
@@ -2701,11 +2336,11 @@ args = {
     'steps': steps,
     'sampling_mode': sampling_mode,
     'width_height': width_height,
-    'clip_guidance_scale': eval(clip_guidance_scale),
+    'clip_guidance_scale': clip_guidance_scale,
     'tv_scale': tv_scale,
     'range_scale': range_scale,
     'sat_scale': sat_scale,
-    'cutn_batches': eval(cutn_batches),
+    'cutn_batches': cutn_batches,
     'init_image': init_image,
     'init_scale': init_scale,
     'skip_steps': skip_steps,
@@ -2736,11 +2371,11 @@ args = {
     'calc_frames_skip_steps': calc_frames_skip_steps,
     'text_prompts': text_prompts,
     'image_prompts': image_prompts,
-    'cut_overview': eval(cut_overview),
-    'cut_innercut': eval(cut_innercut),
-    'cut_ic_pow': eval(cut_ic_pow),
+    'cut_overview': Schedule.parse(cut_overview),
+    'cut_innercut': Schedule.parse(cut_innercut),
+    'cut_ic_pow': cut_ic_pow,
     'cut_ic_pow_final': cut_ic_pow_final,
-    'cut_icgray_p': eval(cut_icgray_p),
+    'cut_icgray_p': Schedule.parse(cut_icgray_p),
     'intermediate_saves': intermediate_saves,
     'intermediates_in_subfolder': intermediates_in_subfolder,
     'steps_per_checkpoint': steps_per_checkpoint,
@@ -2749,7 +2384,7 @@ args = {
     'set_seed': set_seed,
     'eta': eta,
     'clamp_grad': clamp_grad,
-    'clamp_max': eval(clamp_max),
+    'clamp_max': clamp_max,
     'skip_augs': skip_augs,
     'randomize_class': randomize_class,
     'clip_denoised': clip_denoised,
@@ -2761,30 +2396,31 @@ args = {
     'sloss_scale': symm_loss_scale,
     'symm_switch': symm_switch,
     'smooth_schedules': smooth_schedules,
-    'render_mask': render_mask
+    'render_mask': render_mask,
+    'image_prompt_refresh_steps': image_prompt_refresh_steps,
+    'share_cut_batches': share_cut_batches,
+    'cut_pyramid': cut_pyramid,
+    'cut_memory_budget': cut_memory_budget,
+    'guidance_workers': guidance_workers,
+    'mixed_precision': mixed_precision,
+    'clip_checkpointing': clip_checkpointing
 }
 
 args = SimpleNamespace(**args)
 
 # Smooth out them tasty schedules if the user wills it so...
 if smooth_schedules == True:
-    args.cutn_batches = smooth_jazz(args.cutn_batches)
-    args.cut_overview = smooth_jazz(args.cut_overview)
-    args.cut_innercut = smooth_jazz(args.cut_innercut)
-    args.cut_ic_pow = smooth_jazz(args.cut_ic_pow)
-    args.clip_guidance_scale = smooth_jazz(args.clip_guidance_scale)
-    args.clamp_max = smooth_jazz(args.clamp_max)
+    args.cutn_batches = args.cutn_batches.smoothed()
+    args.cut_overview = args.cut_overview.smoothed()
+    args.cut_innercut = args.cut_innercut.smoothed()
+    args.cut_ic_pow = args.cut_ic_pow.smoothed()
+    args.clip_guidance_scale = args.clip_guidance_scale.smoothed()
+    args.clamp_max = args.clamp_max.smoothed()
 
 if cl_args.gobiginit == None:
-    model, diffusion = create_model_and_diffusion(**model_config)
-    model.load_state_dict(torch.load(f'{model_path}/{diffusion_model.path}', map_location='cpu'))
-    model.requires_grad_(False).eval()
-    for name, param in model.named_parameters():
-        if 'qkv' in name or 'norm' in name or 'proj' in name:
-            param.requires_grad_()
-    if model_config['use_fp16']:
-        model.convert_to_fp16()
-    model.to(device)
+    model, diffusion = load_diffusion_model(
+        model_config, f'{model_path}/{diffusion_model.path}', device, weight_cache
+    )
     gc.collect()
     if "cuda" in str(device):
         with torch.cuda.device(device):
@@ -2872,6 +2508,7 @@ try:
                 progress_image = (f'progress{cl_args.cuda}.png')
             else:
                 progress_image = 'progress.png'
+            final_output_image = f'{batchFolder}/{final_output_names(batch_image, batchNum)[0]}'
             # grab the init image and make it our progress image
             if cl_args.gobiginit is not None:
                 shutil.copy(init_image, progress_image)                
@@ -2879,12 +2516,10 @@ try:
             if cl_args.cuda != '0':  # handle if a different GPU is in use
                 slice_image = (f'slice{cl_args.cuda}.png')
                 slice_rmask = (f'slice_rmask{cl_args.cuda}.png')
-                final_output_image = (f'{batchFolder}/{batch_name}_go_big_{cl_args.cuda}_{batchNum}_{batch_image}.png')
             else:
 
                 slice_image = 'slice.png'
                 slice_rmask = 'slice_rmask.png'
-                final_output_image = (f'{batchFolder}/{batch_name}_go_big_{batchNum}_{batch_image}.png')
 
             # To keep things simple (hah), we'll create a fully white render_mask to use in the case that there's no provided render_mask
             # that way there's going to be a render_mask no matter what, and we don't have to keep checking for it
@@ -2914,14 +2549,9 @@ try:
                 seed = seed + 1
                 args.seed = seed
                 # Reset underlying systems for another run
-                model, diffusion = create_model_and_diffusion(**model_config)
-                model.load_state_dict(torch.load(f'{model_path}/{diffusion_model.path}', map_location='cpu'))
-                model.requires_grad_(False).eval().to(device)
-                for name, param in model.named_parameters():
-                    if 'qkv' in name or 'norm' in name or 'proj' in name:
-                        param.requires_grad_()
-                if model_config['use_fp16']:
-                    model.convert_to_fp16()
+                model, diffusion = load_diffusion_model(
+                    model_config, f'{model_path}/{diffusion_model.path}', device, weight_cache
+                )
                 gc.collect()
                 if "cuda" in str(device):
                     with torch.cuda.device(device):
@@ -2973,10 +2603,14 @@ try:
             print(f'\n\nGO BIG is complete!\n\n ***** NOTE *****\nYour output is saved as {final_output_image}!')
             # set everything back for the next image in the batch
             args = temp_args            
+        final_outputs.extend(f'{batchFolder}/{name}' for name in final_output_names(batch_image, batchNum))
         gc.collect()
         if "cuda" in str(device):
             with torch.cuda.device(device):
                 torch.cuda.empty_cache()
+    # Only a complete set of outputs is worth reusing, e.g. not one where ESRGAN failed
+    if result_cache is not None and all(os.path.exists(path) for path in final_outputs):
+        result_cache.put(result_key, final_outputs)
 
 except KeyboardInterrupt:
     pass
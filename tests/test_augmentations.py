@@ -0,0 +1,66 @@
+import torch
+import torchvision.transforms as T
+import pytest
+
+from cut_modules.augmentations import BatchAugment
+
+
+def noise(x):
+    return x + torch.randn_like(x) * 0.01
+
+
+# The per cut recipes BatchAugment replaces
+TORCHVISION_RECIPES = {
+    'None': T.Compose([
+        T.RandomHorizontalFlip(p=0.5),
+        T.Lambda(noise),
+        T.RandomAffine(degrees=10, translate=(0.05, 0.05), interpolation=T.InterpolationMode.BILINEAR),
+        T.Lambda(noise),
+        T.RandomGrayscale(p=0.1),
+        T.Lambda(noise),
+        T.ColorJitter(brightness=0.1, contrast=0.1, saturation=0.1, hue=0.1),
+    ]),
+    'Video Input': T.Compose([
+        T.RandomHorizontalFlip(p=0.5),
+        T.Lambda(noise),
+        T.RandomAffine(degrees=15, translate=(0.1, 0.1)),
+        T.Lambda(noise),
+        T.RandomPerspective(distortion_scale=0.4, p=0.7),
+        T.Lambda(noise),
+        T.RandomGrayscale(p=0.15),
+        T.Lambda(noise),
+    ]),
+}
+
+
+@pytest.fixture
+def image():
+    torch.manual_seed(0)
+    ramp = torch.linspace(0, 0.5, 64).view(1, 1, 1, 64)
+    return torch.rand((1, 3, 64, 64)) * 0.5 + ramp
+
+
+class TestBatchAugment:
+
+    @pytest.mark.parametrize('animation_mode', ['None', 'Video Input'])
+    def test_matches_torchvision_recipe(self, image, animation_mode):
+        count = 500
+        expected = torch.cat([TORCHVISION_RECIPES[animation_mode](image) for _ in range(count)])
+        augmented = BatchAugment.for_animation_mode(animation_mode)(image.repeat(count, 1, 1, 1))
+        assert augmented.shape == expected.shape
+        assert abs(augmented.mean() - expected.mean()) < 0.01
+        assert abs(augmented.std() - expected.std()) < 0.01
+        # How much of the cut the warps push off the frame
+        assert abs((augmented < 0.1).float().mean() - (expected < 0.1).float().mean()) < 0.03
+        # How much the color changes from cut to cut
+        assert abs(augmented.mean((2, 3)).std(0).mean() - expected.mean((2, 3)).std(0).mean()) < 0.01
+
+    def test_samples_are_independent(self, image):
+        augmented = BatchAugment()(image.repeat(8, 1, 1, 1))
+        for i in range(1, 8):
+            assert not torch.allclose(augmented[0], augmented[i])
+
+    def test_gradient_reaches_input(self, image):
+        image = image.repeat(4, 1, 1, 1).requires_grad_()
+        BatchAugment.for_animation_mode('Video Input')(image).sum().backward()
+        assert image.grad.abs().sum() > 0
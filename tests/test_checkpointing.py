@@ -0,0 +1,123 @@
+import logging
+import time
+
+import torch
+from torch import nn
+from torch.nn import functional as F
+
+from model_managers.checkpointing import CheckpointedBlock, set_block_checkpointing
+
+logger = logging.getLogger(__name__)
+
+
+class Block(nn.Module):
+    def __init__(self, width):
+        super().__init__()
+        self.ln = nn.LayerNorm(width)
+        self.mlp = nn.Sequential(nn.Linear(width, width * 4), nn.GELU(), nn.Linear(width * 4, width))
+
+    def forward(self, x):
+        return x + self.mlp(self.ln(x))
+
+
+class Transformer(nn.Module):
+    def __init__(self, width, layers):
+        super().__init__()
+        self.resblocks = nn.Sequential(*[Block(width) for _ in range(layers)])
+
+    def forward(self, x):
+        return self.resblocks(x)
+
+
+class Visual(nn.Module):
+    # Laid out like a CLIP ViT image encoder
+    def __init__(self, width=64, layers=6):
+        super().__init__()
+        self.conv1 = nn.Conv2d(3, width, 8, stride=8)
+        self.transformer = Transformer(width, layers)
+        self.proj = nn.Linear(width, 32)
+
+    def forward(self, x):
+        x = self.conv1(x).flatten(2).transpose(1, 2)
+        return self.proj(self.transformer(x).mean(1))
+
+
+def make_visual():
+    torch.manual_seed(0)
+    return Visual().eval().requires_grad_(False)
+
+
+def input_grad(visual, x, target):
+    x = x.detach().requires_grad_()
+    embeds = F.normalize(visual(x), dim=-1)
+    return torch.autograd.grad((embeds - target).norm(dim=-1).pow(2).sum(), x)[0]
+
+
+def saved_bytes(visual, x):
+    # What autograd keeps for the backward outside the checkpointed blocks
+    saved = {}
+    params = {p.data_ptr() for p in visual.parameters()}
+
+    def pack(tensor):
+        if tensor.data_ptr() not in params:
+            saved[tensor.data_ptr()] = tensor.numel() * tensor.element_size()
+        return tensor
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        visual(x.detach().requires_grad_())
+    return sum(saved.values())
+
+
+class TestBlockCheckpointing:
+
+    def test_wraps_the_blocks(self):
+        visual = make_visual()
+        assert set_block_checkpointing(visual, True) == 6
+        assert all(isinstance(block, CheckpointedBlock) for block in visual.transformer.resblocks)
+        # Wrapping again only switches them
+        assert set_block_checkpointing(visual, True) == 6
+        assert not isinstance(visual.transformer.resblocks[0].block, CheckpointedBlock)
+        assert set_block_checkpointing(visual, False) == 0
+        assert not any(block.enabled for block in visual.transformer.resblocks)
+
+    def test_gradient_is_unchanged(self):
+        visual = make_visual()
+        x = torch.rand(4, 3, 64, 64)
+        target = F.normalize(torch.randn(4, 32), dim=-1)
+        expected = input_grad(visual, x, target)
+        set_block_checkpointing(visual, True)
+        assert torch.allclose(input_grad(visual, x, target), expected, atol=1e-6)
+        with torch.no_grad():
+            set_block_checkpointing(visual, False)
+            embeds = visual(x)
+            set_block_checkpointing(visual, True)
+            assert torch.equal(visual(x), embeds)
+
+    def test_keeps_less_for_the_backward(self):
+        visual = make_visual()
+        x = torch.rand(4, 3, 64, 64)
+        full = saved_bytes(visual, x)
+        set_block_checkpointing(visual, True)
+        assert saved_bytes(visual, x) < full / 3
+
+    def test_benchmark(self):
+        """
+        Not a pass/fail check: logs what checkpointing adds to a forward and backward on CPU. Run with
+        pytest -s --log-cli-level=INFO to see it.
+        """
+        visual = make_visual()
+        x = torch.rand(16, 3, 128, 128)
+        target = F.normalize(torch.randn(16, 32), dim=-1)
+
+        def seconds():
+            input_grad(visual, x, target)
+            start = time.perf_counter()
+            for _ in range(3):
+                input_grad(visual, x, target)
+            return (time.perf_counter() - start) / 3
+
+        plain = seconds()
+        set_block_checkpointing(visual, True)
+        checkpointed = seconds()
+        logger.info(f'Forward and backward {plain * 1000:.0f}ms, {checkpointed * 1000:.0f}ms checkpointed')
+        assert checkpointed > 0
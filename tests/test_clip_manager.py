@@ -0,0 +1,124 @@
+import importlib
+import sys
+import types
+
+import pytest
+import torch
+from torch import nn
+
+from model_managers.quantization import DynamicInt8Linear
+from test_quantization import AttentionPool2d
+
+
+class StubVisual(nn.Module):
+    # A CLIP ResNet image encoder in miniature: a stem, a linear layer, then attention pooling
+    def __init__(self):
+        super().__init__()
+        self.input_resolution = 32
+        self.conv1 = nn.Conv2d(3, 64, 8, stride=8)
+        self.mlp = nn.Linear(64, 64)
+        self.attnpool = AttentionPool2d(4, 64, 4, 32)
+
+    def forward(self, x):
+        x = self.conv1(x)
+        x = self.mlp(x.permute(0, 2, 3, 1)).permute(0, 3, 1, 2)
+        return self.attnpool(x)
+
+
+class StubClip(nn.Module):
+
+    def __init__(self):
+        super().__init__()
+        torch.manual_seed(0)
+        self.visual = StubVisual()
+        self.text_calls = 0
+
+    def encode_image(self, image):
+        return self.visual(image)
+
+    def encode_text(self, tokens):
+        self.text_calls += 1
+        return tokens.float().expand(-1, 32)
+
+
+@pytest.fixture
+def clip_manager(monkeypatch):
+    """
+    model_managers.clip_manager with clip.load and clip.tokenize handing back stubs. The CLIP
+    packages are stood in for by empty modules when they aren't installed.
+    """
+    for name in ('clip', 'open_clip'):
+        try:
+            importlib.import_module(name)
+        except ImportError:
+            monkeypatch.setitem(sys.modules, name, types.ModuleType(name))
+    module = importlib.import_module('model_managers.clip_manager')
+    monkeypatch.setattr(module.clip, 'load', lambda *args, **kwargs: (StubClip(), None), raising=False)
+    monkeypatch.setattr(module.clip, 'tokenize', lambda prompt: torch.tensor([[len(prompt)]]), raising=False)
+    yield module
+    # Don't leave a copy imported against the stand-ins for other tests
+    if not hasattr(module.open_clip, 'create_model'):
+        sys.modules.pop('model_managers.clip_manager', None)
+
+
+class TestQuantizedLoad:
+
+    def test_load_quantizes_on_cpu(self, clip_manager):
+        manager = clip_manager.ClipManager('RN50', 1, 'cpu', quantize=True)
+        manager.load()
+        visual = manager.model.visual
+        assert isinstance(visual.mlp, DynamicInt8Linear)
+        assert not any(isinstance(module, DynamicInt8Linear) for module in visual.attnpool.children())
+        image = torch.rand(2, 3, 32, 32, requires_grad=True)
+        embeds = manager.model.encode_image(image)
+        assert embeds.shape == (2, 32)
+        assert torch.autograd.grad(embeds.sum(), image)[0].abs().sum() > 0
+
+    def test_load_without_quantize(self, clip_manager):
+        manager = clip_manager.ClipManager('RN50', 1, 'cpu')
+        manager.load()
+        assert isinstance(manager.model.visual.mlp, nn.Linear)
+
+
+class TestCutHeatmap:
+
+    def test_heatmap_stays_on_cpu(self, clip_manager):
+        manager = clip_manager.ClipManager('ViTB32', 1, 'cpu', use_cut_heatmap=True)
+        # The planner thread samples it, so it's kept off the render device
+        heatmap = manager._ensure_heatmap(torch.empty(1, 3, 64, 128, device='meta'))
+        assert heatmap.device.type == 'cpu'
+        assert (heatmap.side_x, heatmap.side_y) == (128, 64)
+
+
+class TestTextEmbedCache:
+
+    def test_repeat_prompts_are_encoded_once(self, clip_manager):
+        manager = clip_manager.ClipManager('ViTB32', 1, 'cpu')
+        manager.load()
+        for step in range(3):
+            _, weights = manager.embed_text_prompts(['a castle:s+1', 'a moat:2'], step=step)
+        # Only the weights are worked out again each step
+        assert manager.model.text_calls == 2
+        assert weights.tolist() == [3, 2]
+
+    def test_least_recently_used_is_evicted(self, clip_manager):
+        manager = clip_manager.ClipManager('ViTB32', 1, 'cpu', text_embed_cache_size=2)
+        manager.load()
+        manager.encode_text_prompt('first')
+        manager.encode_text_prompt('second')
+        manager.encode_text_prompt('first')
+        manager.encode_text_prompt('third')
+        assert list(manager.text_embed_cache) == ['first', 'third']
+        manager.encode_text_prompt('first')
+        assert manager.model.text_calls == 3
+        manager.encode_text_prompt('second')
+        assert manager.model.text_calls == 4
+
+    def test_load_clears_the_cache(self, clip_manager):
+        manager = clip_manager.ClipManager('ViTB32', 1, 'cpu')
+        manager.load()
+        manager.encode_text_prompt('a castle')
+        manager.load()
+        assert not manager.text_embed_cache
+        manager.encode_text_prompt('a castle')
+        assert manager.model.text_calls == 1
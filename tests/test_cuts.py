@@ -1,19 +1,32 @@
 import logging
 import os
+import time
+from concurrent.futures import wait
 
 import torch
+from torch.nn import functional as F
 import pytest
+from torchvision.transforms.functional import rgb_to_grayscale
 
 import numpy as np
 from cut_modules import make_cutouts
 from cut_modules.make_cutouts import (
+    MakeCutouts,
     MakeCutoutsDango,
     CutHeatmap,
     save_inner_cut_bounds_image,
     save_cut_image,
     random_sample,
-    center_to_bounds
+    center_to_bounds,
+    extract_cuts,
+    build_pyramid,
+    extract_pyramid_cuts,
+    CutBuffer,
+    CutContext,
+    take_cuts,
+    resample
 )
+from cut_modules.cut_planner import CutPlanner
 
 numeric_log_level = numeric_level = getattr(logging, 'DEBUG', None)
 logging.basicConfig(level=numeric_level)
@@ -61,6 +74,40 @@ class TestHeatmapSampling:
         assert min(x_list) >= pad_size
         assert min(y_list) >= pad_size
 
+    def test_decay_matches_gaussian_filter(self):
+        from scipy.ndimage import gaussian_filter
+        heatmap = CutHeatmap(side_x=125, side_y=100)
+        values = np.random.rand(100, 125).astype(np.float32)
+        heatmap.heatmap = values
+        heatmap.decay()
+        expected = (gaussian_filter(values, sigma=7) + 0.3) / 1.3
+        assert np.allclose(heatmap.heatmap.numpy(), expected, atol=1e-5)
+
+    def test_reduced_resolution_sample(self):
+        image_x, image_y = 125, 100
+        heatmap = CutHeatmap(side_x=image_x, side_y=image_y, resolution=0.25)
+        assert heatmap.heatmap.shape == (25, 31)
+        heatmap.heatmap[:] = 0
+        heatmap.heatmap[5, 2] = 1.0
+        # Cell 2 covers x 9-12, but unpadded 20 pixel cuts can't be centered closer than 10 to the edge
+        x_list, y_list = heatmap.sample_centerpoints([2] * 200 + [20] * 200, padded=False)
+        assert set(y_list) == {20, 21, 22, 23}
+        assert set(x_list[:200]) == {9, 10, 11, 12}
+        assert set(x_list[200:]) == {10, 11, 12}
+
+    def test_fractional_cells_stay_in_range(self):
+        # Cells of 137/69 by 113/57 pixels, so the last cell overlapping the allowed range can start at its end
+        image_x, image_y = 137, 113
+        heatmap = CutHeatmap(side_x=image_x, side_y=image_y, resolution=0.5)
+        generator = torch.Generator().manual_seed(0)
+        for padded in (True, False):
+            sizes = list(range(2, 110, 3)) * 20
+            x_list, y_list = heatmap.sample_centerpoints(sizes, padded=padded, generator=generator)
+            for size, x, y in zip(sizes, x_list, y_list):
+                offset = 0 if padded else size // 2
+                assert offset <= x < image_x - offset
+                assert offset <= y < image_y - offset
+
 
 class TestRandomSampling:
     def test_random_sample_padded(self):
@@ -200,3 +247,264 @@ class TestCutouts:
         self.save_test_images("test_corner_unpadded_no_heatmap_cutout", image, bounds_list, cuts, None)
         assert bounds_list[0] == (104, 124, 0, 20)
         assert cuts[0].shape == (3, 20, 20)
+
+    @pytest.mark.parametrize('image_and_heatmap', [(125, 100)], indirect=True)
+    def test_padded_cuts_match_per_cut_padding(self, image_and_heatmap, monkeypatch):
+        centers = [(0, 0), (124, 99), (60, 3), (5, 95), (50, 50)]
+        samples = iter(centers)
+        monkeypatch.setattr(make_cutouts, "random_sample", lambda *args, **kwargs: next(samples))
+        image, _ = image_and_heatmap
+        image = image * torch.rand(image.shape)
+        cutout_module = MakeCutoutsDango(cut_size=20, Overview=0, InnerCrop=len(centers), IC_Grey_P=0)
+        cuts, bounds_list = cutout_module(image, pad_inner=True, fix_size=True, skip_augs=True)
+
+        # What the cuts used to be: pad a copy of the image for each cut and slice it
+        pad_size = 10
+        padded = torch.nn.functional.pad(image, (pad_size,) * 4)
+        for i, (center_x, center_y) in enumerate(centers):
+            left, right, top, bottom = center_to_bounds(
+                center_x + pad_size, center_y + pad_size, 20, 125 + 20, 100 + 20
+            )
+            assert bounds_list[i] == (left - pad_size, right - pad_size, top - pad_size, bottom - pad_size)
+            expected = padded[0, :, top:bottom, left:right]
+            if i == 0:
+                # IC_Grey_P=0 still greys the first cut
+                expected = rgb_to_grayscale(expected).expand_as(expected)
+            assert torch.allclose(cuts[i], expected, atol=1e-6)
+
+
+def reference_make_cutouts(input, cut_size, cutn, augs=None):
+    # MakeCutouts before it was batched
+    input = F.pad(input, [input.shape[2] // 4] * 4)
+    side_y, side_x = input.shape[2:4]
+    max_size = min(side_x, side_y)
+    cutouts = []
+    for ch in range(cutn):
+        if ch > cutn - cutn // 4:
+            cutout = input.clone()
+        else:
+            size = int(max_size * torch.zeros(1, ).normal_(mean=.8, std=.3).clip(float(cut_size / max_size), 1.))
+            offsetx = torch.randint(0, abs(side_x - size + 1), ())
+            offsety = torch.randint(0, abs(side_y - size + 1), ())
+            cutout = input[:, :, offsety:offsety + size, offsetx:offsetx + size]
+        if augs is not None:
+            cutout = augs(cutout)
+        cutouts.append(resample(cutout, (cut_size, cut_size)))
+    return torch.cat(cutouts, dim=0)
+
+
+class TestMakeCutouts:
+
+    @pytest.fixture
+    def image(self):
+        torch.manual_seed(0)
+        return F.interpolate(torch.rand(1, 3, 8, 8), (96, 128), mode='bicubic', align_corners=False).clamp(0, 1)
+
+    def test_matches_per_cut_loop(self, image):
+        cutn = 400
+        cutouts, bounds = MakeCutouts(32, cutn, skip_augs=True)(image)
+        expected = reference_make_cutouts(image, 32, cutn)
+        assert cutouts.shape == expected.shape
+        assert bounds == []
+        assert abs(cutouts.mean() - expected.mean()) < 0.01
+        assert abs(cutouts.std() - expected.std()) < 0.01
+        # The share of each cut the padding covers follows from the cut sizes and offsets
+        assert abs((cutouts < 0.05).float().mean() - (expected < 0.05).float().mean()) < 0.02
+        # The whole image views at the end are the same, up to lanczos ringing at the padding edge
+        assert (cutouts[-1] - expected[-1]).abs().mean() < 0.03
+
+    def test_benchmark(self, image):
+        """
+        Not a pass/fail check: logs the batched module against the per cut loop on CPU. Run with
+        pytest -s --log-cli-level=INFO to see it.
+        """
+        image = F.interpolate(image, (512, 512), mode='bilinear', align_corners=False)
+        cut_module = MakeCutouts(224, 16)
+        times = {}
+        for name, fn in (
+            ('per cut', lambda: reference_make_cutouts(image, 224, 16, cut_module.augs)),
+            ('batched', lambda: cut_module(image)),
+        ):
+            fn()
+            start = time.perf_counter()
+            for _ in range(3):
+                fn()
+            times[name] = (time.perf_counter() - start) / 3
+        logger.info(f"MakeCutouts 16 cuts of 512px on CPU: {times['per cut'] * 1000:.1f}ms per cut loop, {times['batched'] * 1000:.1f}ms batched")
+        assert times['batched'] > 0
+
+
+class TestExtractCuts:
+
+    def test_unscaled_cut_matches_slice(self):
+        image = torch.rand((1, 3, 100, 125))
+        cuts = extract_cuts(image, [(10, 30, 5, 25), (100, 120, 70, 90)], 20)
+        assert cuts.shape == (2, 3, 20, 20)
+        assert torch.allclose(cuts[0], image[0, :, 5:25, 10:30])
+        assert torch.allclose(cuts[1], image[0, :, 70:90, 100:120])
+
+    def test_cut_past_edge_reads_zeros(self):
+        image = torch.rand((1, 3, 100, 125))
+        cuts = extract_cuts(image, [(-10, 10, -10, 10)], 20)
+        assert torch.all(cuts[0, :, :10, :] == 0)
+        assert torch.all(cuts[0, :, :, :10] == 0)
+        assert torch.allclose(cuts[0, :, 10:, 10:], image[0, :, :10, :10])
+
+    def test_planned_sizes_follow_size_pow(self):
+        cutouts = MakeCutoutsDango(cut_size=20, Overview=0, InnerCrop=2000, IC_Size_Pow=2)
+        bounds_list, _ = cutouts.plan_inner_cuts(200, 200, pad_inner=True)
+        sizes = torch.tensor([float(right - left) for left, right, _, _ in bounds_list])
+        # size = u ** 2 * 180 + 20 for uniform u, so its mean is 180 / 3 + 20
+        assert 20 <= sizes.min() and sizes.max() <= 200
+        assert abs(sizes.mean().item() - 80) < 5
+
+
+class TestPyramidCuts:
+
+    @pytest.fixture
+    def image(self):
+        torch.manual_seed(0)
+        smooth = F.interpolate(torch.rand(1, 3, 32, 32), (512, 512), mode='bicubic', align_corners=False)
+        return smooth + torch.rand(1, 3, 512, 512) * 0.1
+
+    def test_levels_halve(self):
+        pyramid = build_pyramid(torch.rand(1, 3, 300, 500))
+        assert [level.shape[-2:] for level in pyramid] == [(300, 500), (150, 250), (75, 125)]
+
+    def test_small_boxes_match_extract_cuts(self, image):
+        boxes = [(10, 60, 20, 70), (100, 132, 0, 32)]
+        assert torch.allclose(extract_pyramid_cuts(build_pyramid(image), boxes, 32), extract_cuts(image, boxes, 32))
+
+    def test_cuts_and_gradients_match_full_resolution(self, image):
+        boxes = [(0, 512, 0, 512), (100, 164, 40, 104), (37, 437, 50, 450), (200, 400, 100, 300)]
+        weights = F.interpolate(torch.randn(len(boxes), 3, 4, 4), (64, 64), mode='bilinear', align_corners=False)
+        image = image.requires_grad_()
+        expected = extract_cuts(image, boxes, 64)
+        cuts = extract_pyramid_cuts(build_pyramid(image), boxes, 64)
+        assert (cuts - expected).abs().mean() < 0.01
+        expected_grad = torch.autograd.grad((expected * weights).sum(), image)[0]
+        grad = torch.autograd.grad((cuts * weights).sum(), image)[0]
+        assert F.cosine_similarity(grad.flatten(), expected_grad.flatten(), dim=0) > 0.99
+
+
+class TestCutBuffer:
+
+    def test_batches_reuse_storage(self):
+        cut_buffer = CutBuffer()
+        cut_buffer.reserve(16, 20, 'cpu')
+        x_in = torch.rand((1, 3, 100, 125)).requires_grad_()
+        cut_module = MakeCutoutsDango(20, Overview=6, InnerCrop=4)
+        pointers = set()
+        for _ in range(3):
+            cutouts, _ = cut_module(x_in, out=cut_buffer.take(10, 20, 'cpu'))
+            torch.autograd.grad(cutouts.sum(), x_in)
+            pointers.add(cutouts.data_ptr())
+        assert pointers == {cut_buffer.buffer.data_ptr()}
+        assert cut_buffer.buffer.grad_fn is None
+
+    def test_matches_concatenated_cuts(self):
+        x_in = torch.rand((2, 3, 100, 125)).requires_grad_()
+        cut_module = MakeCutoutsDango(20, Overview=2, InnerCrop=4)
+        plan = cut_module.plan(125, 100, 2, skip_augs=True)
+        expected, _ = cut_module(x_in, plan=plan)
+        cutouts, _ = cut_module(x_in, plan=plan, out=CutBuffer().take(12, 20, 'cpu'))
+        assert torch.equal(cutouts, expected)
+        weights = torch.randn_like(expected)
+        assert torch.allclose(
+            torch.autograd.grad((cutouts * weights).sum(), x_in)[0],
+            torch.autograd.grad((expected * weights).sum(), x_in)[0]
+        )
+
+
+class TestCutContext:
+
+    def test_modules_and_overviews_are_reused(self):
+        x_in = torch.rand((1, 3, 100, 125)) * 2 - 1
+        modules = {}
+        context = CutContext(x_in, modules)
+        first = context.cut_module(MakeCutoutsDango, 20, Overview=4, InnerCrop=2, IC_Size_Pow=0.5, IC_Grey_P=0.2)
+        second = context.cut_module(MakeCutoutsDango, 20, Overview=2, InnerCrop=6, IC_Size_Pow=1, IC_Grey_P=0.2)
+        assert first is second
+        assert (second.overview_cut_count, second.inner_cut_count) == (2, 6)
+        assert context.overview(20) is context.overview(20)
+        assert CutContext(x_in, modules).cut_module(MakeCutoutsDango, 20) is first
+
+    def test_batches_share_overview_gradient(self):
+        x_in = (torch.rand((1, 3, 100, 125)) * 2 - 1).requires_grad_()
+        context = CutContext(x_in)
+        cut_module = context.cut_module(MakeCutoutsDango, 20, Overview=2, InnerCrop=2)
+        grads = []
+        for _ in range(2):
+            cutouts, _ = cut_module(context.input, overview=context.overview(20), skip_augs=True)
+            grads.append(torch.autograd.grad(cutouts.sum(), x_in, retain_graph=True)[0])
+        # Without the shared overview each batch computes its own
+        separate = torch.autograd.grad(cut_module(x_in.add(1).div(2), skip_augs=True)[0].sum(), x_in)[0]
+        assert grads[0].abs().sum() > 0
+        assert torch.allclose(grads[0].sum(), separate.sum(), rtol=1e-3)
+
+    def test_take_cuts(self):
+        cutouts = torch.arange(7 * 2).view(14, 1, 1, 1)
+        # Batch of 3 overview and 4 inner cuts, two images each; take 1 overview and 2 inner
+        taken = take_cuts(cutouts, 2, 3, 1, 2)
+        assert taken.flatten().tolist() == [0, 1, 6, 7, 8, 9]
+
+
+class TestCutPlanner:
+
+    @staticmethod
+    def plan_twice(seed):
+        planner = CutPlanner(seed)
+        heatmap = CutHeatmap(side_x=125, side_y=100)
+        cut_module = MakeCutoutsDango(20, Overview=6, InnerCrop=4)
+        config = dict(Overview=6, InnerCrop=4, IC_Size_Pow=0.5, IC_Grey_P=0.2)
+        futures = [planner.submit(cut_module, 125, 100, 2, heatmap=heatmap, config=config) for _ in range(2)]
+        plans = [future.result() for future in futures]
+        planner.close()
+        return plans
+
+    def test_plans_are_reproducible(self):
+        first, second = self.plan_twice(3), self.plan_twice(3)
+        for a, b in zip(first, second):
+            assert a.boxes == b.boxes
+            assert a.bounds == b.bounds
+            for key in a.inner_augment:
+                assert torch.equal(a.inner_augment[key], b.inner_augment[key])
+            assert torch.equal(a.overview_augment['angle'], b.overview_augment['angle'])
+        # Each batch gets its own cuts
+        assert first[0].boxes != first[1].boxes
+        assert self.plan_twice(4)[0].boxes != first[0].boxes
+
+    def test_heatmap_is_held_while_planning(self):
+        heatmap = CutHeatmap(side_x=125, side_y=100)
+        cut_module = MakeCutoutsDango(20, Overview=0, InnerCrop=4)
+        with CutPlanner(0) as planner:
+            with heatmap.lock:
+                future = planner.submit(cut_module, 125, 100, 1, heatmap=heatmap)
+                done, _ = wait([future], timeout=0.2)
+                assert not done
+            assert future.result().boxes
+        # Reading the map for a debug image takes the same lock
+        assert heatmap.to_image().size == (125, 100)
+
+    def test_context_manager_shuts_down_the_thread(self):
+        cut_module = MakeCutoutsDango(20, Overview=6, InnerCrop=4)
+        with CutPlanner(0) as planner:
+            planner.submit(cut_module, 125, 100, 1).result()
+        with pytest.raises(RuntimeError):
+            planner.submit(cut_module, 125, 100, 1)
+
+    def test_plan_sizes_the_cut_batch(self):
+        x_in = torch.rand((2, 3, 100, 125))
+        cut_module = MakeCutoutsDango(20, Overview=6, InnerCrop=4)
+        plan = CutPlanner(0).submit(cut_module, 125, 100, 2).result()
+        assert len(plan.overview_augment['flip']) == 6 * 2
+        assert len(plan.inner_augment['flip']) == 4 * 2
+        cutouts, bounds = cut_module(x_in, plan=plan)
+        assert cutouts.shape == (10 * 2, 3, 20, 20)
+        assert bounds == plan.bounds
+
+    def test_overview_kinds_are_drawn_from_the_generator(self):
+        cut_module = MakeCutoutsDango(20, Overview=3, InnerCrop=0)
+        plans = [cut_module.plan(125, 100, generator=torch.Generator().manual_seed(5)) for _ in range(2)]
+        assert plans[0].overview_kinds == plans[1].overview_kinds
+        assert len(plans[0].overview_kinds) == 3
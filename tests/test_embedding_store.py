@@ -0,0 +1,60 @@
+import os
+import time
+
+import torch
+
+from model_managers.embedding_store import EmbeddingStore
+
+
+class TestEmbeddingStore:
+
+    def test_round_trip(self, tmp_path):
+        store = EmbeddingStore(str(tmp_path))
+        embed = torch.randn(1, 512)
+        store.put('ViTB32', 'abc', 'text', 'a castle', embed)
+        loaded = store.get('ViTB32', 'abc', 'text', 'a castle')
+        assert torch.equal(loaded, embed)
+        assert store.hits == 1
+
+    def test_writes_to_a_read_embedding_stay_in_memory(self, tmp_path):
+        store = EmbeddingStore(str(tmp_path))
+        embed = torch.randn(1, 512)
+        store.put('ViTB32', 'abc', 'text', 'a castle', embed)
+        store.get('ViTB32', 'abc', 'text', 'a castle').zero_()
+        assert torch.equal(store.get('ViTB32', 'abc', 'text', 'a castle'), embed)
+
+    def test_overwrite_keeps_size(self, tmp_path):
+        store = EmbeddingStore(str(tmp_path))
+        store.put('ViTB32', 'abc', 'text', 'a castle', torch.randn(1, 512))
+        entry_size = store.total_bytes
+        store.put('ViTB32', 'abc', 'text', 'a castle', torch.randn(1, 512))
+        assert store.total_bytes == entry_size
+
+    def test_key_includes_model_and_checkpoint(self, tmp_path):
+        store = EmbeddingStore(str(tmp_path))
+        store.put('ViTB32', 'abc', 'text', 'a castle', torch.randn(1, 512))
+        assert store.get('ViTB16', 'abc', 'text', 'a castle') is None
+        assert store.get('ViTB32', 'def', 'text', 'a castle') is None
+        assert store.get('ViTB32', 'abc', 'image', 'a castle') is None
+        assert store.misses == 3
+
+    def test_evicts_least_recently_used(self, tmp_path):
+        embed = torch.randn(1, 512)
+        store = EmbeddingStore(str(tmp_path))
+        store.put('ViTB32', 'abc', 'text', 'first', embed)
+        entry_size = store.total_bytes
+        # Room for two entries, and the low water mark still leaves room for two
+        store.max_bytes = int(entry_size * 2.5)
+        store.put('ViTB32', 'abc', 'text', 'second', embed)
+
+        # Make 'first' the oldest, then read it so that 'second' becomes least recently used
+        for i, prompt in enumerate(('first', 'second')):
+            path = store._path(store.make_key('ViTB32', 'abc', 'text', prompt))
+            os.utime(path, (time.time() - 100 + i, time.time() - 100 + i))
+        assert store.get('ViTB32', 'abc', 'text', 'first') is not None
+
+        store.put('ViTB32', 'abc', 'text', 'third', embed)
+        assert store.total_bytes <= store.max_bytes
+        assert store.get('ViTB32', 'abc', 'text', 'second') is None
+        assert store.get('ViTB32', 'abc', 'text', 'first') is not None
+        assert store.get('ViTB32', 'abc', 'text', 'third') is not None
@@ -0,0 +1,107 @@
+import pytest
+import torch
+
+from engine.guidance import plan_cut_passes
+from engine.guidance_pool import GuidancePool
+from helpers.vram_helpers import ClipModelProfile, max_cuts_within, unknown_clip_profile
+
+
+class TestPlanCutPasses:
+
+    def test_without_chunk_sizes_batches_are_kept(self):
+        assert plan_cut_passes(4, [16], [None]) == (1, [16])
+        # One model without a profile keeps the whole group's batches
+        assert plan_cut_passes(4, [16, 8], [64, None]) == (1, [16, 8])
+
+    def test_room_merges_batches(self):
+        assert plan_cut_passes(4, [16], [40]) == (2, [32])
+        assert plan_cut_passes(4, [16], [1000]) == (4, [64])
+        # The model with the least room decides how many batches a pass cuts
+        assert plan_cut_passes(4, [16, 8], [1000, 16]) == (2, [32, 16])
+
+    def test_no_room_splits_batches(self):
+        assert plan_cut_passes(4, [16], [5]) == (1, [5])
+
+    def test_gradient_and_loss_match_batches(self):
+        torch.manual_seed(0)
+        x = torch.rand(3, requires_grad=True)
+        cutn_batches, cuts, n = 3, 4, 2
+        batches = [torch.rand(cuts * n, 3) for _ in range(cutn_batches)]
+
+        def loss_sums(rows):
+            # Stands in for ClipManager.cut_loss_sums: each image's loss summed over the cuts
+            return (rows * x).sum(1).view(-1, n).sum(0)
+
+        expected = sum(
+            torch.autograd.grad((loss_sums(batch) / cuts).sum(), x)[0] / cutn_batches for batch in batches
+        )
+        # The step's logged loss, as the batches were once logged one by one
+        expected_loss = sum((loss_sums(batch) / cuts).sum().item() for batch in batches)
+        for chunk in (1, 3, 4, 9, 100):
+            merge, (model_chunk,) = plan_cut_passes(cutn_batches, [cuts], [chunk])
+            grad = torch.zeros_like(x)
+            loss = 0
+            for start in range(0, cutn_batches, merge):
+                cutouts = torch.cat(batches[start:start + merge])
+                for chunk_start in range(0, len(cutouts), model_chunk * n):
+                    rows = cutouts[chunk_start:chunk_start + model_chunk * n]
+                    chunk_losses = loss_sums(rows) / cuts
+                    grad += torch.autograd.grad(chunk_losses.sum() / cutn_batches, x)[0]
+                    loss += chunk_losses.sum().item()
+            assert torch.allclose(grad, expected)
+            assert loss == pytest.approx(expected_loss)
+
+
+class TestMaxCutsWithin:
+
+    def test_largest_fitting_count(self):
+        profile = ClipModelProfile(name='test', cut_coef=(100, 10))
+        assert max_cuts_within(profile, 1000, 1000) == 90
+        assert max_cuts_within(profile, 1000, 50) == 50
+        assert max_cuts_within(profile, 10, 1000) == 1
+
+    def test_checkpointing_fits_more_cuts(self):
+        profile = ClipModelProfile(name='test', cut_coef=(100, 10), checkpointed_cut_fraction=0.25)
+        assert profile.estimate_peak(10, checkpointing=True) == 125
+        assert max_cuts_within(profile, 1000, 1000, checkpointing=True) == 360
+
+    def test_profiles_without_cut_data(self):
+        assert max_cuts_within(unknown_clip_profile, 1000, 1000) is None
+        assert max_cuts_within(ClipModelProfile(name='test', cut_coef=(0, 0)), 1000, 1000) is None
+
+
+class TestGuidancePool:
+
+    def test_results_come_back_in_order(self):
+        with GuidancePool(3, 'cpu') as pool:
+            results = list(pool.map_ordered((pow, (i, 2)) for i in range(20)))
+        assert results == [i ** 2 for i in range(20)]
+        # Leaving the block shuts the workers down
+        with pytest.raises(RuntimeError):
+            list(pool.map_ordered((pow, (i, 2)) for i in range(2)))
+
+    def test_close_restores_the_thread_count(self, monkeypatch):
+        # As with the native parallel backend, where one intra-op thread count covers the process
+        threads = [4]
+        monkeypatch.setattr(torch, 'get_num_threads', lambda: threads[0])
+        monkeypatch.setattr(torch, 'set_num_threads', lambda n: threads.__setitem__(0, n))
+        with GuidancePool(2, 'cpu') as pool:
+            assert list(pool.map_ordered((abs, (-i,)) for i in range(4))) == [0, 1, 2, 3]
+            assert threads[0] == 2
+        assert threads[0] == 4
+
+    def test_concurrent_gradients_match_sequential(self):
+        torch.manual_seed(0)
+        x = torch.rand(64, requires_grad=True)
+        # A graph every job backpropagates through, like the cut context
+        shared = (x * 2).exp()
+        weights = torch.randn(16, 64)
+
+        def job(i):
+            return torch.autograd.grad((shared * weights[i]).sum(), x, retain_graph=True)[0]
+
+        expected = sum(job(i) for i in range(16))
+        pool = GuidancePool(4, 'cpu')
+        grad = sum(pool.map_ordered((job, (i,)) for i in range(16)))
+        pool.close()
+        assert torch.equal(grad, expected)
@@ -0,0 +1,64 @@
+import torch
+from torch import nn
+from torch.nn import functional as F
+
+from cut_modules.make_cutouts import MakeCutoutsDango
+from helpers.precision import full_precision, mixed_precision, mixed_precision_iter
+
+
+def guidance_grad(denoiser, encoder, target, x, enabled):
+    # cond_fn in miniature: denoise, cut, encode, and take the gradient back to x
+    x = x.detach().requires_grad_()
+    with mixed_precision(x.device, enabled):
+        x_in = denoiser(x).float() * 0.5 + x * 0.5
+    torch.manual_seed(1)
+    cutouts, _ = MakeCutoutsDango(32, Overview=2, InnerCrop=6)(x_in.add(1).div(2))
+    with mixed_precision(x.device, enabled):
+        embeds = encoder(cutouts).float()
+    loss = (F.normalize(embeds, dim=-1) - target).norm(dim=-1).pow(2).sum()
+    x_in_grad = torch.autograd.grad(loss, x_in)[0]
+    return torch.autograd.grad(x_in, x, x_in_grad)[0]
+
+
+class TestMixedPrecision:
+
+    def test_guidance_gradient_matches_fp32(self):
+        torch.manual_seed(0)
+        denoiser = nn.Sequential(nn.Conv2d(3, 16, 3, padding=1), nn.GELU(), nn.Conv2d(16, 3, 3, padding=1))
+        encoder = nn.Sequential(
+            nn.Conv2d(3, 32, 4, stride=4), nn.GELU(), nn.Flatten(), nn.Linear(32 * 8 * 8, 64)
+        ).requires_grad_(False)
+        target = F.normalize(torch.randn(64), dim=-1)
+        x = torch.randn(1, 3, 64, 80)
+        expected = guidance_grad(denoiser, encoder, target, x, False)
+        grad = guidance_grad(denoiser, encoder, target, x, True)
+        assert grad.dtype == torch.float32
+        assert F.cosine_similarity(grad.flatten(), expected.flatten(), dim=0) > 0.99
+        assert (grad.norm() / expected.norm() - 1).abs() < 0.05
+
+    def test_cuts_stay_in_full_precision(self):
+        x = torch.rand(1, 3, 64, 80)
+
+        def cuts():
+            torch.manual_seed(1)
+            return MakeCutoutsDango(32, Overview=2, InnerCrop=6)(x)[0]
+
+        expected = cuts()
+        # As in cond_fn during a mixed precision sampling step
+        with mixed_precision(x.device), full_precision(x.device):
+            assert torch.equal(cuts(), expected)
+            with mixed_precision(x.device):
+                assert (torch.ones(2, 2) @ torch.ones(2, 2)).dtype == torch.bfloat16
+
+    def test_iter_only_autocasts_the_steps(self):
+        def matmul_dtype():
+            return (torch.ones(2, 2) @ torch.ones(2, 2)).dtype
+
+        def steps():
+            for _ in range(2):
+                yield matmul_dtype()
+
+        for step_dtype in mixed_precision_iter(steps(), 'cpu'):
+            assert step_dtype == torch.bfloat16
+            assert matmul_dtype() == torch.float32
+        assert list(mixed_precision_iter(steps(), 'cpu', enabled=False)) == [torch.float32, torch.float32]
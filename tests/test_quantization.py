@@ -0,0 +1,137 @@
+import logging
+import time
+
+import torch
+from torch import nn
+from torch.nn import functional as F
+
+from model_managers.quantization import DynamicInt8Linear, quantize_linear_layers
+
+logger = logging.getLogger(__name__)
+
+
+class Block(nn.Module):
+    # A CLIP residual attention block in miniature
+    def __init__(self, width):
+        super().__init__()
+        self.attn = nn.MultiheadAttention(width, 4)
+        self.ln_1 = nn.LayerNorm(width)
+        self.mlp = nn.Sequential(nn.Linear(width, width * 4), nn.GELU(), nn.Linear(width * 4, width))
+        self.ln_2 = nn.LayerNorm(width)
+
+    def forward(self, x):
+        y = self.ln_1(x)
+        x = x + self.attn(y, y, y, need_weights=False)[0]
+        return x + self.mlp(self.ln_2(x))
+
+
+class AttentionPool2d(nn.Module):
+    # As at the end of the CLIP ResNets, which hand their projections' weights to attention
+    def __init__(self, spacial_dim, embed_dim, num_heads, output_dim):
+        super().__init__()
+        self.positional_embedding = nn.Parameter(torch.randn(spacial_dim ** 2 + 1, embed_dim) / embed_dim ** 0.5)
+        self.k_proj = nn.Linear(embed_dim, embed_dim)
+        self.q_proj = nn.Linear(embed_dim, embed_dim)
+        self.v_proj = nn.Linear(embed_dim, embed_dim)
+        self.c_proj = nn.Linear(embed_dim, output_dim)
+        self.num_heads = num_heads
+
+    def forward(self, x):
+        x = x.flatten(2).permute(2, 0, 1)
+        x = torch.cat([x.mean(dim=0, keepdim=True), x], dim=0)
+        x = x + self.positional_embedding[:, None, :]
+        x, _ = F.multi_head_attention_forward(
+            query=x, key=x, value=x,
+            embed_dim_to_check=x.shape[-1],
+            num_heads=self.num_heads,
+            q_proj_weight=self.q_proj.weight,
+            k_proj_weight=self.k_proj.weight,
+            v_proj_weight=self.v_proj.weight,
+            in_proj_weight=None,
+            in_proj_bias=torch.cat([self.q_proj.bias, self.k_proj.bias, self.v_proj.bias]),
+            bias_k=None,
+            bias_v=None,
+            add_zero_attn=False,
+            dropout_p=0,
+            out_proj_weight=self.c_proj.weight,
+            out_proj_bias=self.c_proj.bias,
+            use_separate_proj_weight=True,
+            training=self.training,
+            need_weights=False
+        )
+        return x[0]
+
+
+def make_encoder(width=64, layers=2):
+    torch.manual_seed(0)
+    encoder = nn.Sequential(*[Block(width) for _ in range(layers)], nn.Linear(width, width, bias=False))
+    return encoder.eval().requires_grad_(False)
+
+
+class TestQuantizeLinearLayers:
+
+    def test_swaps_linears_but_not_attention_projections(self):
+        encoder = make_encoder()
+        freed = quantize_linear_layers(encoder)
+        assert isinstance(encoder[0].mlp[0], DynamicInt8Linear)
+        assert isinstance(encoder[2], DynamicInt8Linear)
+        assert not isinstance(encoder[0].attn.out_proj, DynamicInt8Linear)
+        # 2 blocks of two 64x256 layers and the projection, from 4 bytes a weight to about 1
+        assert freed > 0.7 * 4 * (2 * 2 * 64 * 256 + 64 * 64)
+
+    def test_leaves_attention_pooling_alone(self):
+        torch.manual_seed(0)
+        encoder = nn.Sequential(
+            nn.Conv2d(3, 64, 8, stride=8), AttentionPool2d(4, 64, 4, 32), nn.Linear(32, 32)
+        ).eval().requires_grad_(False)
+        x = torch.rand(2, 3, 32, 32)
+        expected = encoder(x)
+        quantize_linear_layers(encoder)
+        assert not any(isinstance(module, DynamicInt8Linear) for module in encoder[1].children())
+        assert isinstance(encoder[2], DynamicInt8Linear)
+        assert F.cosine_similarity(encoder(x), expected, dim=-1).min() > 0.99
+
+    def test_output_stays_close(self):
+        encoder = make_encoder()
+        x = torch.randn(16, 4, 64)
+        expected = encoder(x)
+        quantize_linear_layers(encoder)
+        embeds = encoder(x)
+        assert F.cosine_similarity(embeds.flatten(1), expected.flatten(1), dim=-1).min() > 0.99
+
+    def test_gradient_reaches_the_input(self):
+        encoder = make_encoder()
+        target = F.normalize(torch.randn(4, 64), dim=-1)
+        x = torch.randn(16, 4, 64)
+
+        def input_grad():
+            x_in = x.detach().requires_grad_()
+            embeds = F.normalize(encoder(x_in).mean(0), dim=-1)
+            return torch.autograd.grad((embeds - target).norm(dim=-1).pow(2).sum(), x_in)[0]
+
+        expected = input_grad()
+        quantize_linear_layers(encoder)
+        grad = input_grad()
+        assert grad.dtype == torch.float32
+        assert F.cosine_similarity(grad.flatten(), expected.flatten(), dim=0) > 0.98
+
+    def test_benchmark(self):
+        """
+        Not a pass/fail check: logs a CLIP-sized linear layer in float32 and int8 on CPU. Run with
+        pytest -s --log-cli-level=INFO to see it.
+        """
+        linear = nn.Linear(768, 3072).requires_grad_(False)
+        quantized = DynamicInt8Linear(linear)
+        x = torch.randn(4 * 50, 768)
+
+        def seconds(layer):
+            layer(x)
+            start = time.perf_counter()
+            for _ in range(10):
+                layer(x)
+            return (time.perf_counter() - start) / 10
+
+        float_time = seconds(linear)
+        int8_time = seconds(quantized)
+        logger.info(f'768 -> 3072 linear on 200 tokens: {float_time * 1000:.1f}ms float32, {int8_time * 1000:.1f}ms int8')
+        assert int8_time > 0
@@ -0,0 +1,77 @@
+import pytest
+import torch
+
+pytest.importorskip('clip')
+pytest.importorskip('open_clip')
+pytest.importorskip('guided_diffusion')
+
+import model_managers.clip_manager as clip_manager_module  # noqa: E402
+from engine.renderer import Renderer, resolve_settings  # noqa: E402
+from test_clip_manager import StubClip  # noqa: E402
+
+
+class TestResolveSettings:
+
+    def test_auto_values_and_schedules(self):
+        settings = resolve_settings({
+            'text_prompts': {'0': ['a castle']},
+            'ViTB32': 1.0,
+            'steps': 50,
+            'set_seed': 42,
+        })
+        assert settings.seed == 42
+        assert settings.clip_models == {'ViTB32': 1.0}
+        assert settings.eta == 0.0
+        assert len(settings.cut_overview) == 1000
+        assert len(settings.clamp_max) == 1000
+        assert len(settings.cutn_batches) == 1000
+
+    def test_requires_clip_model(self):
+        with pytest.raises(ValueError):
+            resolve_settings({'text_prompts': {'0': ['a castle']}})
+
+
+class StubDiffusion:
+    # Samples blank images, making cuts from each step's image the way guidance would
+    num_timesteps = 2
+
+    def __init__(self, clip_managers):
+        self.clip_managers = clip_managers
+        self.heatmaps = []
+
+    def ddim_sample_loop_progressive(self, model, shape, skip_timesteps=0, **kwargs):
+        x = torch.zeros(shape)
+        for _ in range(self.num_timesteps - skip_timesteps):
+            self.heatmaps.append([clip_manager._ensure_heatmap(x) for clip_manager in self.clip_managers])
+            yield {'pred_xstart': x}
+
+
+class TestRenderer:
+
+    @pytest.fixture
+    def renderer(self, monkeypatch):
+        monkeypatch.setattr(clip_manager_module.clip, 'load', lambda *args, **kwargs: (StubClip(), None))
+        monkeypatch.setattr(clip_manager_module.clip, 'tokenize', lambda prompt: torch.tensor([[len(prompt)]]))
+        clip_manager = clip_manager_module.ClipManager('ViTB32', 1, 'cpu', use_cut_heatmap=True)
+        clip_manager.load()
+        renderer = Renderer('cpu')
+        monkeypatch.setattr(renderer, 'load', lambda settings: None)
+        renderer.clip_managers = {'ViTB32': clip_manager}
+        renderer.diffusion = StubDiffusion([clip_manager])
+        return renderer
+
+    @staticmethod
+    def settings(width):
+        return {'text_prompts': {'0': ['a castle']}, 'ViTB32': 1.0, 'steps': 2, 'width': width, 'height': 64, 'set_seed': 1}
+
+    def test_each_render_starts_a_new_heatmap(self, renderer):
+        renderer.render(self.settings(128))
+        first = renderer.diffusion.heatmaps[-1][0]
+        first.add_cut(32, 32, 16)
+        renderer.render(self.settings(128))
+        second = renderer.diffusion.heatmaps[-1][0]
+        assert second is not first
+        assert torch.equal(second.heatmap, torch.ones_like(second.heatmap))
+        # A different size gets a heatmap covering the new image
+        renderer.render(self.settings(64))
+        assert renderer.diffusion.heatmaps[-1][0].side_x == 64
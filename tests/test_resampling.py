@@ -0,0 +1,102 @@
+import logging
+import math
+import time
+
+import torch
+import pytest
+from resize_right import resize
+from torch.nn import functional as F
+
+from cut_modules import resampling
+from cut_modules.resampling import lanczos, resampling_matrix, resize_separable
+
+logger = logging.getLogger(__name__)
+
+
+def reference_ramp(ratio, width):
+    n = math.ceil(width / ratio + 1)
+    out = torch.empty([n])
+    cur = 0
+    for i in range(out.shape[0]):
+        out[i] = cur
+        cur += ratio
+    return torch.cat([-out[1:].flip([0]), out])[1:-1]
+
+
+def reference_resample(input, size, align_corners=True):
+    # make_cutouts.resample before its kernels were cached
+    n, c, h, w = input.shape
+    dh, dw = size
+    input = input.reshape([n * c, 1, h, w])
+    if dh < h:
+        kernel_h = lanczos(reference_ramp(dh / h, 2), 2).to(input.device, input.dtype)
+        pad_h = (kernel_h.shape[0] - 1) // 2
+        input = F.pad(input, (0, 0, pad_h, pad_h), 'reflect')
+        input = F.conv2d(input, kernel_h[None, None, :, None])
+    if dw < w:
+        kernel_w = lanczos(reference_ramp(dw / w, 2), 2).to(input.device, input.dtype)
+        pad_w = (kernel_w.shape[0] - 1) // 2
+        input = F.pad(input, (pad_w, pad_w, 0, 0), 'reflect')
+        input = F.conv2d(input, kernel_w[None, None, None, :])
+    input = input.reshape([n, c, h, w])
+    return F.interpolate(input, size, mode='bicubic', align_corners=align_corners)
+
+
+def best_time(fn, repeats=5):
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+class TestResampling:
+
+    @pytest.mark.parametrize('in_size,out_size', [((300, 400), (224, 224)), ((100, 125), (224, 224))])
+    def test_cubic_matches_resize_right(self, in_size, out_size):
+        image = torch.rand((1, 3) + in_size)
+        expected = resize(image, out_shape=(1, 3) + out_size)
+        assert torch.allclose(resize_separable(image, out_size), expected, atol=1e-5)
+
+    @pytest.mark.parametrize('in_size,out_size', [((300, 400), (224, 224)), ((100, 125), (224, 224))])
+    def test_lanczos_matches_old_resample(self, in_size, out_size):
+        image = torch.rand((2, 3) + in_size)
+        expected = reference_resample(image, out_size)
+        assert torch.allclose(resize_separable(image, out_size, method='lanczos'), expected, atol=1e-5)
+
+    def test_ramp_matches_loop(self):
+        for ratio in (224 / 300, 224 / 1000, 0.5):
+            assert torch.allclose(resampling.ramp(ratio, 2), reference_ramp(ratio, 2))
+
+    def test_matrices_are_cached(self):
+        first = resampling_matrix(300, 224, 'lanczos')
+        assert resampling_matrix(300, 224, 'lanczos') is first
+        assert resampling_matrix(300, 224, 'cubic') is not first
+        with pytest.raises(ValueError):
+            resampling_matrix(300, 224, 'nearest')
+
+    def test_benchmark(self):
+        """
+        Not a pass/fail check: logs what a cut-sized resize costs with and without cached matrices.
+        Run with pytest -s --log-cli-level=INFO to see it.
+        """
+        image = torch.rand((1, 3, 1024, 1024))
+        cases = {
+            'resize_right': (
+                lambda: resize(image, out_shape=(1, 3, 224, 224)),
+                lambda: resize_separable(image, (224, 224))
+            ),
+            'lanczos resample': (
+                lambda: reference_resample(image, (224, 224)),
+                lambda: resize_separable(image, (224, 224), method='lanczos')
+            ),
+        }
+        for name, (before, after) in cases.items():
+            after()  # fill the cache
+            before_time = best_time(before)
+            after_time = best_time(after)
+            logger.info(
+                f'{name} 1024 -> 224: {before_time * 1000:.1f}ms before, {after_time * 1000:.1f}ms with cached matrices'
+            )
+            assert after_time > 0
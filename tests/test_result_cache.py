@@ -0,0 +1,48 @@
+import os
+import time
+
+from helpers.result_cache import ResultCache
+
+
+def make_image(path, size=1000):
+    with open(path, 'wb') as f:
+        f.write(os.urandom(size))
+    return str(path)
+
+
+class TestResultCache:
+
+    def test_fingerprint(self):
+        settings = {'batch_name': 'a', 'steps': 50, 'text_prompts': {'0': ['a castle']}}
+        key = ResultCache.fingerprint(settings, {'diffusion_model': 'abc'}, 42)
+        assert key == ResultCache.fingerprint(dict(settings, batch_name='b'), {'diffusion_model': 'abc'}, 42)
+        assert key != ResultCache.fingerprint(dict(settings, steps=51), {'diffusion_model': 'abc'}, 42)
+        assert key != ResultCache.fingerprint(settings, {'diffusion_model': 'def'}, 42)
+        assert key != ResultCache.fingerprint(settings, {'diffusion_model': 'abc'}, 43)
+        gpu = ResultCache.fingerprint(settings, {'diffusion_model': 'abc'}, 42, {'device': 'cuda', 'cpu_quantize': False})
+        assert gpu != ResultCache.fingerprint(settings, {'diffusion_model': 'abc'}, 42, {'device': 'cpu', 'cpu_quantize': True})
+
+    def test_round_trip(self, tmp_path):
+        image = make_image(tmp_path / 'out.png')
+        cache = ResultCache(str(tmp_path / 'cache'))
+        assert cache.get('key') is None
+        cache.put('key', [image])
+        # A new instance reads the index back from disk
+        cached = ResultCache(str(tmp_path / 'cache')).get('key')
+        assert len(cached) == 1
+        with open(cached[0], 'rb') as a, open(image, 'rb') as b:
+            assert a.read() == b.read()
+
+    def test_eviction_policies(self, tmp_path):
+        for policy, survivor in (('lru', 'first'), ('fifo', 'second')):
+            cache = ResultCache(str(tmp_path / policy), max_bytes=2500, policy=policy)
+            cache.put('first', [make_image(tmp_path / 'first.png')])
+            time.sleep(0.01)
+            cache.put('second', [make_image(tmp_path / 'second.png')])
+            time.sleep(0.01)
+            assert cache.get('first') is not None
+            cache.put('third', [make_image(tmp_path / 'third.png')])
+            assert cache.total_bytes <= cache.max_bytes
+            assert cache.get(survivor) is not None
+            assert cache.get('third') is not None
+            assert len(cache.index) == 2
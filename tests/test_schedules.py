@@ -0,0 +1,51 @@
+import json
+
+import pytest
+
+from helpers.schedules import Schedule
+
+
+class TestSchedule:
+
+    def test_parse_piecewise(self):
+        schedule = Schedule.parse('[12]*400+[4]*600')
+        assert len(schedule) == 1000
+        assert schedule[0] == 12
+        assert schedule[399] == 12
+        assert schedule[400] == 4
+        assert type(schedule[0]) is int
+        assert schedule.max() == 12
+
+    def test_parse_number_and_final(self):
+        assert list(Schedule.parse(0.05)) == [0.05] * 1000
+        schedule = Schedule.parse(1, 10)
+        assert schedule[0] == 1
+        assert 9 <= schedule[999] <= 10
+        assert type(schedule[500]) is int
+        assert Schedule.parse({'start': 1, 'end': 10}) == schedule
+
+    def test_rejects_bad_strings(self):
+        with pytest.raises(ValueError):
+            Schedule.parse('__import__("os")')
+        with pytest.raises(ValueError):
+            Schedule.parse('[5]*10')
+
+    def test_to_json_round_trip(self):
+        for value in ('[5]*200+[3]*30+[1]*770', {'start': 1000.0, 'end': 50.0}, 4):
+            schedule = Schedule.parse(value)
+            assert Schedule.parse(schedule.to_json()) == schedule
+        smoothed = Schedule.parse('[5]*500+[1]*500').smoothed()
+        assert Schedule.parse(smoothed.to_json()) == smoothed
+
+    def test_settings_file_round_trip(self):
+        # As get_settings saves cut_overview, cut_innercut and cut_icgray_p, for every form they take
+        for value in ('[12]*400+[4]*600', {'start': 1, 'end': 10}, 0.2, [3] * 1000):
+            saved = json.loads(json.dumps(Schedule.parse(value).to_json()))
+            assert Schedule.parse(saved) == Schedule.parse(value)
+
+    def test_smoothed(self):
+        smoothed = Schedule.parse('[10]*500+[0]*500').smoothed()
+        assert smoothed[474] == 10
+        assert smoothed[524] == 0
+        assert 0 < smoothed[500] < 10
+        assert all(a >= b for a, b in zip(smoothed, list(smoothed)[1:]))
@@ -0,0 +1,74 @@
+import json
+import logging
+import os
+import re
+import subprocess
+import sys
+import time
+
+import pytest
+
+logger = logging.getLogger(__name__)
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY_MODULES = ('torch', 'lpips', 'timm', 'pandas', 'cv2', 'clip', 'open_clip', 'guided_diffusion')
+
+# Runs prd.py with the given arguments and reports which heavy modules ended up imported
+IMPORTS_SCRIPT = '''
+import runpy
+import sys
+sys.argv = ['prd.py'] + {args!r}
+try:
+    runpy.run_path('prd.py', run_name='__main__')
+except SystemExit as e:
+    if e.code:
+        raise
+print('HEAVY:' + ','.join(m for m in {heavy_modules!r} if m in sys.modules))
+'''
+
+
+def heavy_imports(*args):
+    result = subprocess.run(
+        [sys.executable, '-c', IMPORTS_SCRIPT.format(args=list(args), heavy_modules=HEAVY_MODULES)],
+        cwd=ROOT_DIR,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+    )
+    assert result.returncode == 0, result.stderr
+    return result.stdout.strip().splitlines()
+
+
+class TestStartup:
+
+    def test_help_skips_heavy_imports(self):
+        start = time.perf_counter()
+        output = heavy_imports('--help')
+        elapsed = time.perf_counter() - start
+        logger.info(f'Time to argparse (--help): {elapsed:.2f}s')
+        assert output[-1] == 'HEAVY:'
+
+    def test_estimate_skips_heavy_imports(self, tmp_path):
+        settings = tmp_path / 'settings.json'
+        settings.write_text(json.dumps({'text_prompts': {'0': ['a castle']}, 'ViTB32': 1.0, 'RN50': 1.0, 'steps': 50}))
+        output = heavy_imports('-s', str(settings), '--estimate')
+        assert output[-2].startswith('Settings OK. Estimated peak VRAM use is')
+        assert output[-1] == 'HEAVY:'
+
+    @pytest.mark.skipif(
+        not os.environ.get('PRD_RUN_BENCHMARKS'),
+        reason='Renders an image; set PRD_RUN_BENCHMARKS=1 to run.'
+    )
+    def test_time_to_first_step(self):
+        result = subprocess.run(
+            [sys.executable, 'prd.py', '-s', 'settings/validate.json', '--log_level', 'DEBUG'],
+            cwd=ROOT_DIR,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            universal_newlines=True,
+        )
+        assert result.returncode == 0, result.stdout
+        timings = dict(re.findall(r'Startup: (.+?) after ([0-9.]+)s', result.stdout))
+        logger.info(f"Time to argparse: {timings['settings parsed']}s")
+        logger.info(f"Time to first step: {timings['first step finished']}s")
+        assert float(timings['settings parsed']) < float(timings['first step finished'])
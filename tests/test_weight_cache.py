@@ -0,0 +1,62 @@
+import os
+import time
+
+import torch
+from torch import nn
+
+from model_managers.weight_cache import WeightCache
+
+
+def make_model(seed=0):
+    torch.manual_seed(seed)
+    model = nn.Sequential(nn.Conv2d(3, 8, 3), nn.BatchNorm2d(8), nn.Flatten(), nn.Linear(8, 4))
+    model.requires_grad_(False).eval()
+    # A converted model: mixed dtypes and only some parameters trainable, like the diffusion model
+    model[0].half()
+    model[3].weight.requires_grad_()
+    return model
+
+
+class TestWeightCache:
+
+    def test_round_trip(self, tmp_path):
+        cache = WeightCache(str(tmp_path))
+        source = make_model()
+        cache.save(source, 'test', 'checkpoint')
+        model = make_model(seed=1)
+        model[0].float()
+        assert cache.load(model, 'test', 'checkpoint')
+        for (name, expected), (_, tensor) in zip(source.state_dict().items(), model.state_dict().items()):
+            assert tensor.dtype == expected.dtype, name
+            assert torch.equal(tensor, expected), name
+        assert [p.requires_grad for p in model.parameters()] == [p.requires_grad for p in source.parameters()]
+        assert isinstance(model[0].weight, nn.Parameter)
+
+    def test_weights_are_mapped(self, tmp_path):
+        cache = WeightCache(str(tmp_path))
+        cache.save(make_model(), 'test', 'checkpoint')
+        model = make_model()
+        cache.load(model, 'test', 'checkpoint')
+        # Writes go to private copies of the mapped pages, never back to the file
+        model[3].weight.data.zero_()
+        assert cache.state_dict('test', 'checkpoint')['3.weight'].abs().sum() > 0
+
+    def test_key_includes_source_and_options(self, tmp_path):
+        cache = WeightCache(str(tmp_path))
+        checkpoint = tmp_path / 'model.pt'
+        checkpoint.write_bytes(b'weights')
+        cache.save(make_model(), 'test', str(checkpoint), device='cpu')
+        assert cache.state_dict('test', str(checkpoint), device='cpu') is not None
+        assert cache.state_dict('test', str(checkpoint), device='cuda') is None
+        assert cache.state_dict('other', str(checkpoint), device='cpu') is None
+        # A changed checkpoint file is a different source
+        os.utime(checkpoint, (time.time() + 10, time.time() + 10))
+        assert cache.state_dict('test', str(checkpoint), device='cpu') is None
+
+    def test_mismatched_model_is_left_alone(self, tmp_path):
+        cache = WeightCache(str(tmp_path))
+        cache.save(make_model(), 'test', 'checkpoint')
+        model = nn.Linear(8, 4)
+        weight = model.weight.detach().clone()
+        assert not cache.load(model, 'test', 'checkpoint')
+        assert torch.equal(model.weight, weight)
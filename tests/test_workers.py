@@ -0,0 +1,44 @@
+import os
+from types import SimpleNamespace
+
+from PIL import Image
+
+from engine.workers import parse_workers, prd_device_args, render_point
+
+
+class FakeRenderer:
+    device = 'cpu'
+
+    def render(self, settings):
+        if settings.get('fail'):
+            raise RuntimeError('render failed')
+        self.last_settings = SimpleNamespace(seed=42)
+        return [Image.new('RGB', (8, 8))]
+
+
+class TestWorkers:
+
+    def test_parse_workers(self):
+        specs = parse_workers('0, 1')
+        assert [spec['device'] for spec in specs] == ['cuda:0', 'cuda:1']
+        specs = parse_workers('cpu,cpu', cpu_threads=3)
+        assert specs == [{'device': 'cpu', 'threads': 3}] * 2
+        assert all(spec['threads'] >= 1 for spec in parse_workers('cpu,cpu,cpu'))
+
+    def test_prd_device_args(self):
+        assert prd_device_args({'device': 'cuda:1', 'threads': None}) == '--cuda 1'
+        assert prd_device_args({'device': 'cpu', 'threads': 3}) == '-c 3'
+        # A thread count of 0 would have prd.py pick the GPU
+        assert prd_device_args({'device': 'cpu', 'threads': None}) == f'-c {os.cpu_count() or 1}'
+
+    def test_render_point(self, tmp_path):
+        entry = render_point(FakeRenderer(), 3, {'batch_name': 'grid'}, str(tmp_path), 'run')
+        assert entry['status'] == 'done'
+        assert entry['seed'] == 42
+        assert all(os.path.exists(image) for image in entry['images'])
+        assert os.path.exists(tmp_path / 'grid' / 'grid(explorer-run)_0003_settings.json')
+
+    def test_render_point_failure(self, tmp_path):
+        entry = render_point(FakeRenderer(), 0, {'fail': True}, str(tmp_path), 'run')
+        assert entry['status'] == 'failed'
+        assert 'render failed' in entry['error']